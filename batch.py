@@ -0,0 +1,185 @@
+"""
+batch.py
+
+NumPy engine for Model A (model.Composer) that runs many stochastic
+derivations in lockstep. Lexical Arrays, Workspaces and the tree
+projections the Ursatz Filter reads (projecting, leftmost and left
+daughter Stufen) are kept as integer arrays with one row per derivation,
+so every Select/Merge coin flip and Filter check is one vector operation
+over the whole batch. Trees are only walked to spell out the hits.
+
+Each step picks uniformly among remaining Stufen (Select) or among
+ordered pairs in the Workspace (Merge), exactly as Composer.derive does,
+so both engines produce the same distribution of outcomes.
+"""
+
+import numpy as np
+
+
+class BatchComposer:
+    """
+    Model A, vectorized over a batch of derivations.
+    """
+    def __init__(self, seed=None, tonic=0):
+        """
+        default ctor
+        :param seed: int or np.random.Generator
+        :param tonic: int, see Composer
+        """
+        self.rng = np.random.default_rng(seed)
+        self.tonic = tonic
+
+    def filter(self, c5, rows, proj, leftmost, lproj, so1, so2):
+        """
+        Vectorized Composer.filter for the new SO's [so1, so2]: tonic
+        at the root, dominant heading the right daughter and tonic as
+        the first Stufe.
+
+        :param c5: c5 value of every Stufe in the Lexical Array
+        :param rows: derivations that are Merging
+        :param proj, leftmost, lproj: node tables
+        :param so1, so2: node ids being Merged, one per row
+        :return: np.ndarray of bool
+        """
+        head = lproj[rows, so2]
+        return ((c5[proj[rows, so2]] == self.tonic)
+                & (head >= 0)
+                & (c5[np.maximum(head, 0)] == self.tonic + 1)
+                & (c5[leftmost[rows, so1]] == self.tonic))
+
+    def derive(self, la, k=1024):
+        """
+        Executes k derivations starting with LexicalArray la.
+        Every SO generated that passes Filter will be spelled out.
+
+        :param la: collection of Stufe objs
+        :param k: number of derivations
+        :return: list of lists of surfaces (str), np.ndarray of bool
+        """
+        la = list(la)
+        n = len(la)
+        if n < 2:
+            print("Error: You need more than 2 Stufen to compose")
+            return list()
+
+        rng = self.rng
+        c5 = np.array([s.c5 for s in la])
+        nodes = 2 * n - 1
+        every = np.arange(k)
+
+        # node tables; ids 0..n-1 are the Stufen of la,
+        # ids n.. are SO's in order of Merge
+        proj = np.zeros((k, nodes), dtype=np.int32)
+        leftmost = np.zeros((k, nodes), dtype=np.int32)
+        lproj = np.full((k, nodes), -1, dtype=np.int32)
+        left = np.full((k, nodes), -1, dtype=np.int32)
+        right = np.full((k, nodes), -1, dtype=np.int32)
+        proj[:, :n] = np.arange(n)
+        leftmost[:, :n] = np.arange(n)
+        passes = np.zeros((k, nodes), dtype=bool)
+
+        # Lexical Array and Workspace as arrays + sizes (swap-remove)
+        lex = np.tile(np.arange(n, dtype=np.int32), (k, 1))
+        la_size = np.full(k, n)
+        ws = np.zeros((k, n), dtype=np.int32)
+        ws_size = np.zeros(k, dtype=np.int64)
+        merged = np.zeros(k, dtype=np.int64)
+
+        # set up (select 2)
+        self._select(every, lex, la_size, ws, ws_size)
+        self._select(every, lex, la_size, ws, ws_size)
+
+        # derivation
+        active = (la_size > 0) | (ws_size != 1)
+        while active.any():
+            flip = rng.integers(0, 2, size=k).astype(bool)
+            do_select = active & flip & (la_size > 0)
+            do_merge = active & ~flip & (ws_size != 1)
+
+            rows = np.nonzero(do_select)[0]
+            if len(rows):
+                self._select(rows, lex, la_size, ws, ws_size)
+
+            rows = np.nonzero(do_merge)[0]
+            if len(rows):
+                w = ws_size[rows]
+                i = (rng.random(len(rows)) * w).astype(np.int64)
+                j = (rng.random(len(rows)) * (w - 1)).astype(np.int64)
+                j += j >= i
+                so1 = ws[rows, i]
+                so2 = ws[rows, j]
+
+                new = n + merged[rows]
+                merged[rows] += 1
+                left[rows, new] = so1
+                right[rows, new] = so2
+                # latter object projects syntactic features
+                proj[rows, new] = proj[rows, so2]
+                leftmost[rows, new] = leftmost[rows, so1]
+                lproj[rows, new] = proj[rows, so1]
+                passes[rows, new] = self.filter(c5, rows, proj, leftmost,
+                                                lproj, so1, so2)
+
+                # remove so1 and so2, higher slot first, then add new SO
+                hi = np.maximum(i, j)
+                lo = np.minimum(i, j)
+                ws[rows, hi] = ws[rows, w - 1]
+                ws[rows, lo] = ws[rows, w - 2]
+                ws[rows, w - 2] = new
+                ws_size[rows] = w - 1
+
+            active = (la_size > 0) | (ws_size != 1)
+
+        # end of derivation
+        success = passes[every, ws[:, 0]]
+        names = [s.name for s in la]
+        surfaces = [list() for _ in range(k)]
+        for row, node in zip(*np.nonzero(passes)):
+            surfaces[row].append(self._spell_out(row, node, n, left, right,
+                                                 names))
+        return surfaces, success
+
+    def _select(self, rows, lex, la_size, ws, ws_size):
+        """
+        Moves a random Stufe from the LexicalArray to the Workspace
+        in each of rows.
+        """
+        size = la_size[rows]
+        j = (self.rng.random(len(rows)) * size).astype(np.int64)
+        item = lex[rows, j]
+        lex[rows, j] = lex[rows, size - 1]
+        la_size[rows] = size - 1
+        ws[rows, ws_size[rows]] = item
+        ws_size[rows] += 1
+
+    def _spell_out(self, row, node, n, left, right, names) -> str:
+        """
+        Surface chords of one SO, left to right.
+        """
+        leaves = list()
+        stack = [node]
+        while stack:
+            current = stack.pop()
+            if current < n:
+                leaves.append(names[current])
+            else:
+                stack.append(right[row, current])
+                stack.append(left[row, current])
+        return ' '.join(leaves)
+
+    def search(self, la, target, k=1024) -> (list, int):
+        """
+        Generates batches of surfaces until target is found.
+
+        :param la: collection of Stufe objs
+        :param target: str
+        :param k: derivations per batch
+        :return: list of surfaces of the hit, number of attempts
+        """
+        count = 0
+        while True:
+            surfaces, success = self.derive(la, k)
+            for spelled in surfaces:
+                count += 1
+                if target in spelled:
+                    return spelled, count
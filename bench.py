@@ -0,0 +1,443 @@
+"""
+bench.py
+
+Benchmarks for the derivation hot paths: Composer.derive,
+ComposerB.derive, ComposerB.get_mergables, Composer.filter,
+SyntacticObject.spell_out and tebe/dissertation Model.generate_v3 and
+Model.generate_batch.
+Each runs on synthetic Lexical Arrays of 10 to 10,000 Stufen built from
+fixed seeds, and reports operations/sec, hits/sec and peak memory.
+
+Results can be saved as a JSON baseline and later runs compared against
+it, flagging throughput drops and memory growth beyond a tolerance:
+
+    python bench.py --save bench_baseline.json
+    python bench.py --baseline bench_baseline.json
+
+Throughput is compared relative to a fixed pure-Python reference op
+timed in the same run, so that a baseline saved on one machine can gate
+another; the comparison only runs when a baseline is given.
+"""
+
+import argparse
+import contextlib
+import gc
+import io
+import json
+import random
+import signal
+import sys
+import time
+import tracemalloc
+
+from model import Composer, Stufe, SyntacticObject
+from modelB import ComposerB
+from tebe import dissertation
+
+SIZES = (10, 100, 1000, 10000)
+# results key of the reference op (see case_reference)
+REFERENCE = "reference/1000"
+
+
+class Timeout(Exception):
+    pass
+
+
+@contextlib.contextmanager
+def time_limit(seconds):
+    """
+    Aborts the body after seconds (some ops never return, e.g. a
+    generate_v3 that never finds a filter-passing SO).
+    """
+    def expire(signum, frame):
+        raise Timeout(f"no result after {seconds}s")
+
+    previous = signal.signal(signal.SIGALRM, expire)
+    signal.setitimer(signal.ITIMER_REAL, seconds)
+    try:
+        yield
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous)
+
+
+def synthetic_la(n, seed) -> list:
+    """
+    n random Stufen around C major / A minor.
+
+    :param n: int
+    :param seed: int
+    :return: list of Stufe
+    """
+    rng = random.Random(seed)
+    return [Stufe(c5=rng.randint(-1, 6), major=rng.random() < 0.7,
+                  dim=rng.random() < 0.3) for _ in range(n)]
+
+
+def random_tree(la, rng):
+    """
+    Merges random pairs of la until one SO is left.
+
+    :param la: list of Stufe
+    :param rng: random.Random
+    :return: SyntacticObject
+    """
+    workspace = list(la)
+    while len(workspace) > 1:
+        i, j = rng.sample(range(len(workspace)), 2)
+        so = SyntacticObject(workspace[i], workspace[j])
+        for k in sorted((i, j), reverse=True):
+            workspace[k] = workspace[-1]
+            workspace.pop()
+        workspace.append(so)
+    return workspace[0]
+
+
+def mid_derivation(model, la, rng):
+    """
+    Stage half way through a derivation's Selects, by the same
+    coin flips as derive().
+
+    :param model: ComposerB
+    :param la: list of Stufe
+    :param rng: random.Random
+    :return: ComposerB.Stage
+    """
+    stage = ComposerB.Stage(la=la)
+    while len(stage.la) > len(la) // 2:
+        if rng.random() < 0.5 or len(stage.workspace) < 2:
+            stage = model.select(rng.choice(stage.la), stage)
+        else:
+            pair = model.sample_mergable(stage)
+            if pair is not None:
+                model.merge(*pair, stage)
+    return stage
+
+
+def case_derive(model_cls):
+    def setup(n, seed):
+        model = model_cls()
+        la = synthetic_la(n, seed)
+
+        def op():
+            derivations, success = model.derive(la, verbose=False)
+            return len(derivations) > 0
+        return op
+    return setup
+
+
+def case_get_mergables(n, seed):
+    model = ComposerB()
+    stage = mid_derivation(model, synthetic_la(n, seed), random.Random(seed))
+
+    def op():
+        success, mergables = model.get_mergables(stage)
+        return success
+    return op
+
+
+def case_filter(n, seed):
+    model = Composer()
+    rng = random.Random(seed)
+    la = synthetic_la(n, seed)
+    trees = [random_tree(la, rng) for _ in range(8)]
+    cycle = iter(range(1 << 62))
+
+    def op():
+        return model.filter(trees[next(cycle) % len(trees)])
+    return op
+
+
+def case_spell_out(n, seed):
+    rng = random.Random(seed)
+    la = synthetic_la(n, seed)
+
+    def op():
+        # a fresh tree every call so no surface is cached yet
+        tree = random_tree(la, rng)
+        start = time.perf_counter()
+        tree.spell_out()
+        return time.perf_counter() - start
+    op.self_timed = True
+    return op
+
+
+def case_generate_v3(n, seed):
+    rng = random.Random(seed)
+    model = dissertation.Model()
+    lexicon = [dissertation.Stufe(cf, cf) for cf in
+               (rng.randint(-12, 12) for _ in range(n))]
+
+    def op():
+        # one op is a walk of up to 1000 steps, as it may never end
+        return len(model.generate_v3(n=1, lexicon=lexicon, max_steps=1000)) > 0
+    return op
+
+
+def case_generate_batch(n, seed):
+    rng = random.Random(seed)
+    model = dissertation.Model()
+    lexicon = [dissertation.Stufe(cf, cf) for cf in
+               (rng.randint(-12, 12) for _ in range(n))]
+    walks = iter(range(1 << 62))
+
+    def op():
+        # one op is 1024 walks of 100 steps
+        return len(model.generate_batch(n=1, walks=1024, max_steps=100,
+                                        lexicon=lexicon,
+                                        seed=seed + next(walks))) > 0
+    return op
+
+
+def case_reference(n, seed):
+    """
+    Fixed pure-Python work, much like Merge's (objects with slots,
+    attribute reads, tuple keys into a dict), that no change to the
+    models affects: the unit throughputs are compared in.
+    """
+    class Node:
+        __slots__ = ('left', 'right', 'c5')
+
+        def __init__(self, left, right, c5):
+            self.left = left
+            self.right = right
+            self.c5 = c5
+
+    rng = random.Random(seed)
+    values = [rng.randint(-1, 6) for _ in range(n)]
+
+    def op():
+        counts = dict()
+        nodes = [Node(None, None, c5) for c5 in values]
+        while len(nodes) > 1:
+            merged = list()
+            for a, b in zip(nodes[::2], nodes[1::2]):
+                key = (a.c5, b.c5)
+                counts[key] = counts.get(key, 0) + 1
+                merged.append(Node(a, b, b.c5))
+            if len(nodes) % 2:
+                merged.append(nodes[-1])
+            nodes = merged
+        return len(counts) > 0
+    return op
+
+
+CASES = {
+    "Composer.derive": case_derive(Composer),
+    "ComposerB.derive": case_derive(ComposerB),
+    "ComposerB.get_mergables": case_get_mergables,
+    "Composer.filter": case_filter,
+    "SyntacticObject.spell_out": case_spell_out,
+    "Model.generate_v3": case_generate_v3,
+    "Model.generate_batch": case_generate_batch,
+}
+
+
+def run_case(setup, n, seed=0, budget=1.0, timeout=30.0, rounds=5) -> dict:
+    """
+    Repeats one op for budget seconds, split into rounds, then once
+    more under tracemalloc for peak memory. Throughput is that of the
+    fastest round, as other load on the machine only ever slows a
+    round down.
+
+    :param setup: callable (n, seed) -> op
+    :param n: Lexical Array size
+    :param seed: int
+    :param budget: seconds of timed repetitions
+    :param timeout: seconds before a single op is abandoned
+    :param rounds: int
+    :return: dict
+    """
+    result = {"n": n, "seed": seed, "ops": 0, "hits": 0}
+    best = 0.0
+    elapsed = 0.0
+    try:
+        with contextlib.redirect_stdout(io.StringIO()), time_limit(timeout):
+            random.seed(seed)
+            op = setup(n, seed)
+            self_timed = getattr(op, "self_timed", False)
+            for _ in range(rounds):
+                ops = 0
+                spent = 0.0
+                start = time.perf_counter()
+                while time.perf_counter() - start < budget / rounds:
+                    before = time.perf_counter()
+                    out = op()
+                    if self_timed:
+                        spent += out
+                    else:
+                        spent += time.perf_counter() - before
+                        result["hits"] += bool(out)
+                    ops += 1
+                result["ops"] += ops
+                elapsed += spent
+                if spent:
+                    best = max(best, ops / spent)
+
+            # a fresh op, the same every run, over an intern table
+            # holding no dead SO's, so peaks compare across runs
+            random.seed(seed)
+            op = setup(n, seed)
+            gc.collect()
+            SyntacticObject.sweep()
+            tracemalloc.start()
+            op()
+            result["peak_bytes"] = tracemalloc.get_traced_memory()[1]
+    except Exception as e:
+        result["error"] = f"{type(e).__name__}: {e}"
+        return result
+    finally:
+        tracemalloc.stop()
+
+    result["secs"] = elapsed
+    result["ops_per_sec"] = best
+    result["hits_per_sec"] = best * result["hits"] / result["ops"]
+    return result
+
+
+def run(sizes=SIZES, cases=None, seed=0, budget=1.0, timeout=30.0) -> dict:
+    """
+    Runs the cases, and the reference op before and after them, keeping
+    its faster run.
+
+    :return: dict, "name/n" -> run_case() result
+    """
+    size = int(REFERENCE.rsplit("/", 1)[1])
+    reference = run_case(case_reference, size, seed=seed, budget=budget,
+                         timeout=timeout)
+    results = dict()
+    for name, setup in CASES.items():
+        if cases and name not in cases:
+            continue
+        for n in sizes:
+            results[f"{name}/{n}"] = run_case(setup, n, seed=seed,
+                                              budget=budget, timeout=timeout)
+    again = run_case(case_reference, size, seed=seed, budget=budget,
+                     timeout=timeout)
+    results[REFERENCE] = max(reference, again,
+                             key=lambda r: r.get("ops_per_sec", 0.0))
+    return results
+
+
+def relative(results, key) -> float:
+    """
+    Throughput of a case as a multiple of the reference op's in the
+    same run.
+
+    :param results: dict from run()
+    :param key: str, "name/n"
+    :return: float
+    """
+    return results[key]["ops_per_sec"] / results[REFERENCE]["ops_per_sec"]
+
+
+def retime(results, baseline, tolerance=0.25, seed=0, budget=1.0,
+           timeout=30.0):
+    """
+    Runs again every case slower than the baseline allows, keeping the
+    faster of its two runs: a single slow run is most often other load
+    on the machine.
+
+    :param results: dict from run(), updated in place
+    :param baseline: dict from run()
+    :param tolerance: float
+    :param seed: int
+    :param budget: seconds per case
+    :param timeout: seconds before a single op is abandoned
+    """
+    for key, old in baseline.items():
+        new = results.get(key)
+        if key == REFERENCE or new is None or "error" in old or "error" in new:
+            continue
+        if relative(results, key) < relative(baseline, key) * (1 - tolerance):
+            name, n = key.rsplit("/", 1)
+            again = run_case(CASES[name], int(n), seed=seed, budget=budget,
+                             timeout=timeout)
+            if "error" not in again and again["ops_per_sec"] > new["ops_per_sec"]:
+                results[key] = again
+
+
+def compare(results, baseline, tolerance=0.25) -> list:
+    """
+    Regressions against a baseline: throughput relative to the
+    reference op below (1 - tolerance) of the baseline's, peak memory
+    above (1 + tolerance), or an op that used to work and now fails.
+
+    :param results: dict from run()
+    :param baseline: dict from run()
+    :param tolerance: float
+    :return: list of str
+    """
+    flagged = list()
+    for key, old in baseline.items():
+        new = results.get(key)
+        if key == REFERENCE or new is None or "error" in old:
+            continue
+        if "error" in new:
+            flagged.append(f"{key}: now fails ({new['error']})")
+            continue
+        now, then = relative(results, key), relative(baseline, key)
+        if now < then * (1 - tolerance):
+            flagged.append(f"{key}: {now:.4g} x reference, "
+                           f"baseline {then:.4g} x")
+        if new["peak_bytes"] > old["peak_bytes"] * (1 + tolerance):
+            flagged.append(f"{key}: peak {new['peak_bytes']} B, "
+                           f"baseline {old['peak_bytes']} B")
+    return flagged
+
+
+def print_table(results):
+    print(f"{'case':<36}{'ops/s':>12}{'hits/s':>12}{'peak KiB':>12}")
+    for key, r in results.items():
+        if "error" in r:
+            print(f"{key:<36}  {r['error']}")
+        else:
+            print(f"{key:<36}{r['ops_per_sec']:>12.1f}"
+                  f"{r['hits_per_sec']:>12.1f}{r['peak_bytes'] / 1024:>12.1f}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    parser.add_argument("--sizes", type=int, nargs="+", default=SIZES)
+    parser.add_argument("--cases", nargs="+", choices=CASES)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--budget", type=float, default=1.0,
+                        help="seconds per case")
+    parser.add_argument("--timeout", type=float, default=30.0,
+                        help="seconds before a single op is abandoned")
+    parser.add_argument("--baseline", help="JSON baseline to compare with, "
+                        "e.g. bench_baseline.json")
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    parser.add_argument("--save", help="write results as a JSON baseline")
+    args = parser.parse_args(argv)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if REFERENCE not in baseline:
+            parser.error(f"{args.baseline} has no {REFERENCE}; save it again")
+
+    results = run(args.sizes, args.cases, args.seed, args.budget, args.timeout)
+    if baseline is not None:
+        retime(results, baseline, args.tolerance, args.seed, args.budget,
+               args.timeout)
+    print_table(results)
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if baseline is not None:
+        flagged = compare(results, baseline, args.tolerance)
+        if flagged:
+            print("\nRegressions\n===========")
+            print(*flagged, sep="\n")
+            return 1
+        print("\nNo regressions")
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,380 @@
+"""
+cache.py
+
+Persistent cache of derivation results in a local SQLite database, so
+rerunning a derivation, search or sampling run with the same lexicon,
+model and seed returns instantly instead of redoing the work.
+
+An entry is keyed by
+    - the operation and its arguments (target, n, ...)
+    - the model class (Composer, ComposerB, dissertation.Model)
+    - the model's parameters (e.g. dissertation.Model's western)
+    - the canonical lexical array: its Stufen as plain features,
+      sorted, so equal multisets share entries
+    - the RNG seed
+and tagged with a hash of the source of the model's modules, so results
+of older model code are never returned: they're dropped on lookup, or in
+bulk with invalidate(). The database is bounded by entry count and total
+size, evicting least recently used entries first.
+
+A cached run derives from the canonical (sorted) lexical array, so its
+result depends only on the key; it can differ from an uncached run with
+the same seed but another ordering of the same Stufen.
+
+Derivations and searches are also keyed modulo transposition: the
+lexical array is taken relative to the model's tonic, and results are
+stored in C and relabeled for the model's key (see transpose.py), so a
+sweep over the 12 keys derives once. Where the shift would change Model
+B's Agree, the key stays absolute.
+
+    with ResultCache() as cache:
+        result = cache.search(Composer(), tebe_lexical_array(), TEBE, seed=1)
+"""
+
+import hashlib
+import inspect
+import json
+import pickle
+import random
+import sqlite3
+
+import corpus
+import search
+import transpose
+from stats import MonteCarlo
+
+DEFAULT_PATH = "glam_cache.sqlite"
+# bump when the layout of cached values changes
+FORMAT = 1
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS results (
+    key     TEXT PRIMARY KEY,
+    spec    TEXT NOT NULL,
+    model   TEXT NOT NULL,
+    version TEXT NOT NULL,
+    value   BLOB NOT NULL,
+    size    INTEGER NOT NULL,
+    used    INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS results_used ON results (used);
+"""
+
+
+def model_name(model) -> str:
+    return f"{type(model).__module__}.{type(model).__qualname__}"
+
+
+def model_params(model) -> dict:
+    """
+    Public plain-valued attributes of a model, i.e. its parameters
+    (derivation counters like stage_i aside).
+
+    :param model: Composer, ComposerB or dissertation.Model
+    :return: dict
+    """
+    return {k: v for k, v in sorted(vars(model).items())
+            if isinstance(v, (bool, int, float, str))
+            and not k.startswith('_') and k != 'stage_i'}
+
+
+def code_version(model) -> str:
+    """
+    Hash of the source of every module the model's class hierarchy
+    is defined in.
+
+    :param model: Composer, ComposerB or dissertation.Model
+    :return: str
+    """
+    digest = hashlib.blake2b(str(FORMAT).encode(), digest_size=16)
+    seen = set()
+    for cls in type(model).__mro__:
+        module = inspect.getmodule(cls)
+        if module is None or module.__name__ in seen \
+                or module.__name__ == 'builtins':
+            continue
+        seen.add(module.__name__)
+        digest.update(module.__name__.encode())
+        digest.update(inspect.getsource(module).encode())
+    return digest.hexdigest()
+
+
+def reseed(model, seed):
+    """
+    :param model: Composer, ComposerB or dissertation.Model
+    :param seed: int
+    """
+    if hasattr(model, 'seed'):
+        model.seed(seed)
+    else:
+        random.seed(seed)
+
+
+def features(stufe, tonic=0) -> tuple:
+    """
+    :param stufe: Stufe of model A/B or of the dissertation model
+    :param tonic: int, c5 taken relative to it
+    :return: tuple, the Stufe's syntactic features
+    """
+    if hasattr(stufe, 'c5'):
+        return 'c5', stufe.c5 - tonic, stufe.is_major, stufe.is_dim
+    return 'cf', stufe.cf, stufe.ct
+
+
+def canonical(la) -> list:
+    """
+    :param la: collection of Stufe objs
+    :return: list of Stufe, sorted by features
+    """
+    return sorted(la, key=features)
+
+
+class ResultCache:
+    """
+    SQLite-backed cache of derive, search, sampling and generate_v3
+    results.
+    """
+    def __init__(self, path=DEFAULT_PATH, max_entries=10000, max_bytes=64 << 20):
+        """
+        default ctor
+        :param path: str, database file (":memory:" for a throwaway cache)
+        :param max_entries: int, entries kept before evicting
+        :param max_bytes: int, total size of cached values kept before evicting
+        """
+        self.path = path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.db = sqlite3.connect(path)
+        self.db.executescript(_SCHEMA)
+        self._versions = dict()
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return self.db.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+
+    def _version(self, model) -> str:
+        cls = type(model)
+        if cls not in self._versions:
+            self._versions[cls] = code_version(model)
+        return self._versions[cls]
+
+    def _shift(self, model, la) -> int:
+        """
+        :return: int, transposition from the model's key to C under
+                 which results can be stored, 0 if Agree isn't
+                 invariant under it
+        """
+        tonic = getattr(model, 'tonic', 0)
+        if tonic and transpose.invariant(model, la, -tonic):
+            return tonic
+        return 0
+
+    def _spec(self, op, model, la, seed, shift=0, **args) -> str:
+        params = model_params(model)
+        if 'tonic' in params:
+            params['tonic'] -= shift
+        return json.dumps({
+            "op": op,
+            "model": model_name(model),
+            "params": params,
+            "rng": type(getattr(model, 'rng', None)).__name__,
+            "la": None if la is None else [features(s, shift) for s in la],
+            "seed": seed,
+            "args": args,
+        }, sort_keys=True)
+
+    def get(self, spec, model):
+        """
+        :param spec: str, from _spec
+        :param model: the model the entry was computed with
+        :return: the cached value, or None on a miss
+        """
+        key = hashlib.blake2b(spec.encode(), digest_size=16).hexdigest()
+        row = self.db.execute("SELECT version, value FROM results WHERE key = ?",
+                              (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        version, value = row
+        if version != self._version(model):
+            # computed by older model code
+            with self.db:
+                self.db.execute("DELETE FROM results WHERE key = ?", (key,))
+            self.misses += 1
+            return None
+        with self.db:
+            self.db.execute("UPDATE results SET used = "
+                            "(SELECT COALESCE(MAX(used), 0) + 1 FROM results) "
+                            "WHERE key = ?", (key,))
+        self.hits += 1
+        return pickle.loads(value)
+
+    def put(self, spec, model, value):
+        """
+        :param spec: str, from _spec
+        :param model: the model the entry was computed with
+        :param value: picklable
+        """
+        key = hashlib.blake2b(spec.encode(), digest_size=16).hexdigest()
+        blob = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        with self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO results VALUES "
+                "(?, ?, ?, ?, ?, ?, (SELECT COALESCE(MAX(used), 0) + 1 FROM results))",
+                (key, spec, model_name(model), self._version(model), blob, len(blob)))
+            self._evict()
+
+    def _evict(self):
+        count, size = self.db.execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM results").fetchone()
+        if count <= self.max_entries and size <= self.max_bytes:
+            return
+        # least recently used first
+        doomed = list()
+        for key, entry_size in self.db.execute(
+                "SELECT key, size FROM results ORDER BY used"):
+            if count <= self.max_entries and size <= self.max_bytes:
+                break
+            doomed.append((key,))
+            count -= 1
+            size -= entry_size
+        self.db.executemany("DELETE FROM results WHERE key = ?", doomed)
+
+    def invalidate(self, model=None) -> int:
+        """
+        Drops entries computed by other versions of the model's code,
+        or every entry if model is None.
+
+        :param model: Composer, ComposerB or dissertation.Model
+        :return: int, entries dropped
+        """
+        with self.db:
+            if model is None:
+                cursor = self.db.execute("DELETE FROM results")
+            else:
+                cursor = self.db.execute(
+                    "DELETE FROM results WHERE model = ? AND version != ?",
+                    (model_name(model), self._version(model)))
+        return cursor.rowcount
+
+    def derive(self, model, la, seed):
+        """
+        Cached Composer.derive under a seed.
+
+        :param model: Composer or ComposerB
+        :param la: collection of Stufe objs
+        :param seed: int
+        :return: collection of derivations, bool
+        """
+        la = canonical(la)
+        shift = self._shift(model, la)
+        spec = self._spec("derive", model, la, seed, shift)
+        value = self.get(spec, model)
+        if value is None:
+            reseed(model, seed)
+            derivations, success = model.derive(la)
+            value = {"trees": [corpus.encode(transpose.transpose(so, -shift))
+                               for so in derivations],
+                     "success": success}
+            self.put(spec, model, value)
+        return ([transpose.transpose(corpus.decode(t)[0], shift)
+                 for t in value["trees"]], value["success"])
+
+    def search(self, model, la, target, seed) -> search.SearchResult:
+        """
+        Cached sequential search (tebe_search) for target under a seed.
+
+        :param model: Composer or ComposerB
+        :param la: collection of Stufe objs
+        :param target: str, spelled out surface to look for
+        :param seed: int
+        :return: search.SearchResult, with the search's seed and its
+                 number of attempts
+        """
+        la = canonical(la)
+        shift = self._shift(model, la)
+        spec = self._spec("search", model, la, seed, shift,
+                          target=transpose.transpose(target, -shift))
+        value = self.get(spec, model)
+        if value is None:
+            reseed(model, seed)
+            for count, derivation in enumerate(model.attempts(la), 1):
+                new = list(derivation)
+                spelled = [d.spell_out() for d in new]
+                if target in spelled:
+                    break
+            value = {"attempts": count,
+                     "spelled": transpose.transpose(spelled, -shift),
+                     "trees": [corpus.encode(transpose.transpose(so, -shift))
+                               for so in new]}
+            self.put(spec, model, value)
+        return search.SearchResult(
+            seed, value["attempts"], transpose.transpose(value["spelled"], shift),
+            [transpose.transpose(corpus.decode(t)[0], shift)
+             for t in value["trees"]])
+
+    def sample(self, model, la, n, seed, target=None, cap=10000) -> MonteCarlo:
+        """
+        Cached Monte Carlo run of n derivations under a seed.
+
+        :param model: Composer or ComposerB
+        :param la: collection of Stufe objs
+        :param n: int, derivations
+        :param seed: int
+        :param target: str, see MonteCarlo
+        :param cap: int, see MonteCarlo
+        :return: MonteCarlo, with counts and surface histogram of the run
+        """
+        # keyed in the model's own key: a histogram past its cap holds
+        # a count-min sketch of surfaces, which can't be relabeled
+        la = canonical(la)
+        spec = self._spec("sample", model, la, seed, n=n, target=target, cap=cap)
+        value = self.get(spec, model)
+        if value is None:
+            reseed(model, seed)
+            run = MonteCarlo(model, la, target=target, cap=cap)
+            for _ in run.run(n, every=n):
+                pass
+            value = {"attempts": run.attempts, "crashes": run.crashes,
+                     "hits": run.hits, "histogram": run.histogram}
+            self.put(spec, model, value)
+        run = MonteCarlo(model, la, target=target, cap=cap)
+        run.attempts = value["attempts"]
+        run.crashes = value["crashes"]
+        run.hits = value["hits"]
+        run.histogram = value["histogram"]
+        return run
+
+    def generate(self, model, n, seed, lexicon=None, max_steps=10000) -> list:
+        """
+        Cached dissertation.Model.generate_v3 under a seed.
+
+        :param model: dissertation.Model
+        :param n: int, see generate_v3
+        :param seed: int
+        :param lexicon: collection of Stufe; the model's stufen if None
+        :param max_steps: int, see generate_v3; None for no limit, which
+                          may never return, as its Filter may never pass
+        :return: list of SyntacticObject
+        """
+        lexicon = canonical(lexicon or model.stufen)
+        spec = self._spec("generate", model, lexicon, seed, n=n,
+                          max_steps=max_steps)
+        value = self.get(spec, model)
+        if value is None:
+            reseed(model, seed)
+            completed = model.generate_v3(n, lexicon=lexicon,
+                                          max_steps=max_steps)
+            value = {"trees": [corpus.encode(so) for so in completed]}
+            self.put(spec, model, value)
+        return [corpus.decode(t)[0] for t in value["trees"]]
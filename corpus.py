@@ -0,0 +1,252 @@
+"""
+corpus.py
+
+Binary on-disk corpus of derivation trees, for output of model A, model B
+and the dissertation model. A corpus is two files:
+
+    <path>      magic, then every tree as a prefix (Polish) opcode string
+    <path>.idx  magic, then the byte offset of every tree as uint64
+
+Opcodes, one tree being a Merge followed by its two daughters:
+
+    0x00                 Merge
+    0x10 | flags, c5     model.Stufe leaf; flags bit 0 major, bit 1 dim
+    0x20, cf, ct         dissertation Stufe leaf
+
+with c5/cf/ct as signed bytes. Trees are self-delimiting, so only their
+start offsets are indexed.
+
+CorpusWriter appends as derivations stream in (and reopens an existing
+corpus to keep appending). Corpus maps both files with mmap, giving
+zero-copy random access to the i-th tree, so multi-gigabyte corpora can
+be scanned without loading them.
+"""
+
+import mmap
+import os
+import struct
+
+from model import Stufe, SyntacticObject
+
+MAGIC = b"GLAMCRP1"
+INDEX_MAGIC = b"GLAMIDX1"
+
+MERGE = 0x00
+LEAF = 0x10
+MAJOR = 0x01
+DIM = 0x02
+LEAF_DISSERTATION = 0x20
+
+_OFFSET = struct.Struct('<Q')
+
+
+def encode(so) -> bytes:
+    """
+    Prefix opcode encoding of a tree, without recursion.
+
+    :param so: SyntacticObject or Stufe (of any model)
+    :return: bytes
+    """
+    out = bytearray()
+    stack = [so]
+    while stack:
+        node = stack.pop()
+        if hasattr(node, 'items'):
+            out.append(MERGE)
+            stack.append(node.items[1])
+            stack.append(node.items[0])
+        elif isinstance(node, Stufe):
+            flags = (MAJOR if node.is_major else 0) | (DIM if node.is_dim else 0)
+            out.append(LEAF | flags)
+            out += struct.pack('<b', node.c5)
+        else:
+            out.append(LEAF_DISSERTATION)
+            out += struct.pack('<bb', node.cf, node.ct)
+    return bytes(out)
+
+
+def decode(data):
+    """
+    Tree from its prefix opcode encoding, without recursion.
+
+    :param data: bytes-like (e.g. a memoryview into the corpus)
+    :return: SyntacticObject or Stufe, and the number of bytes read
+    """
+    # daughters collected so far for each open Merge
+    stack = list()
+    i = 0
+    while True:
+        op = data[i]
+        if op == MERGE:
+            stack.append(list())
+            i += 1
+            continue
+        if op & 0xF0 == LEAF:
+            node = Stufe(c5=struct.unpack_from('<b', data, i + 1)[0],
+                         major=bool(op & MAJOR), dim=bool(op & DIM))
+            merge = SyntacticObject
+            i += 2
+        elif op == LEAF_DISSERTATION:
+            from tebe import dissertation
+            cf, ct = struct.unpack_from('<bb', data, i + 1)
+            node = dissertation.Stufe(cf, ct)
+            merge = dissertation.SyntacticObject
+            i += 3
+        else:
+            raise ValueError(f"bad opcode {op:#x} at byte {i}")
+
+        while stack:
+            stack[-1].append(node)
+            if len(stack[-1]) < 2:
+                break
+            m1, m2 = stack.pop()
+            node = merge(m1, m2)
+        if not stack:
+            return node, i
+
+
+def names(data) -> list:
+    """
+    Surface chord names straight from an encoded tree, without
+    building it.
+
+    :param data: bytes-like
+    :return: list of str
+    """
+    out = list()
+    open_merges = 0
+    i = 0
+    while True:
+        op = data[i]
+        if op == MERGE:
+            open_merges += 1
+            i += 1
+            continue
+        if op == LEAF_DISSERTATION:
+            cf = struct.unpack_from('<b', data, i + 1)[0]
+            out.append(Stufe.FIFTHS_NAMES[cf % 12])
+            i += 3
+        else:
+            out.append(Stufe(c5=struct.unpack_from('<b', data, i + 1)[0],
+                             major=bool(op & MAJOR), dim=bool(op & DIM)).name)
+            i += 2
+        # a leaf closes one open Merge, n Merges have n + 1 leaves
+        if open_merges == 0:
+            return out
+        open_merges -= 1
+
+
+class CorpusWriter:
+    """
+    Appends trees to a corpus, creating it if needed.
+    """
+    def __init__(self, path):
+        """
+        default ctor
+        :param path: str, corpus data file; the index is path + ".idx"
+        """
+        self.path = path
+        new = not os.path.exists(path)
+        self.data = open(path, 'ab')
+        self.index = open(path + ".idx", 'ab')
+        if new:
+            self.data.write(MAGIC)
+            self.index.write(INDEX_MAGIC)
+        self.offset = self.data.tell()
+
+    def append(self, so) -> int:
+        """
+        :param so: SyntacticObject or Stufe (of any model)
+        :return: int, bytes written
+        """
+        record = encode(so)
+        self.data.write(record)
+        self.index.write(_OFFSET.pack(self.offset))
+        self.offset += len(record)
+        return len(record)
+
+    def extend(self, sos):
+        """
+        Appends trees as they are produced, e.g. a lazy
+        Composer.iter_derive or generate_v3's output.
+
+        :param sos: iterable of SyntacticObject
+        """
+        for so in sos:
+            self.append(so)
+
+    def flush(self):
+        self.data.flush()
+        self.index.flush()
+
+    def close(self):
+        self.data.close()
+        self.index.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class Corpus:
+    """
+    Read-only, memory-mapped view of a corpus.
+    """
+    def __init__(self, path):
+        """
+        default ctor
+        :param path: str, corpus data file
+        """
+        with open(path, 'rb') as f:
+            self._data_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        with open(path + ".idx", 'rb') as f:
+            self._index_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._data_map[:len(MAGIC)] != MAGIC \
+                or self._index_map[:len(INDEX_MAGIC)] != INDEX_MAGIC:
+            raise ValueError(f"{path} is not a corpus")
+
+        self.data = memoryview(self._data_map)
+        self._index = memoryview(self._index_map)
+        # ignore a partially written last offset
+        end = len(self._index) - (len(self._index) - len(INDEX_MAGIC)) % _OFFSET.size
+        self._entries = self._index[len(INDEX_MAGIC):end]
+        self.offsets = self._entries.cast('Q')
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def raw(self, i) -> memoryview:
+        """
+        Zero-copy view of the i-th tree's encoding (up to the start
+        of the next tree).
+
+        :param i: int
+        :return: memoryview
+        """
+        start = self.offsets[i]
+        end = self.offsets[i + 1] if i + 1 < len(self.offsets) else len(self.data)
+        return self.data[start:end]
+
+    def __getitem__(self, i):
+        return decode(self.raw(i))[0]
+
+    def spell_out(self, i) -> str:
+        return ' '.join(names(self.raw(i)))
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def close(self):
+        for view in (self.offsets, self._entries, self._index, self.data):
+            view.release()
+        self._data_map.close()
+        self._index_map.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
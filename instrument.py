@@ -0,0 +1,214 @@
+"""
+instrument.py
+
+Operation counters and timing for the composer models (model.Composer,
+modelB.ComposerB and tebe/dissertation Model). While enabled, each
+operation (Select, Merge, Agree, Filter, spell-out, ...) records its
+number of calls and cumulative (inclusive) time, and derivations record
+crashes and Filter hits. Optionally a cProfile or a statistical sampling
+profiler runs over the same span.
+
+Nothing is patched while disabled, so a model that isn't being
+instrumented runs at full speed:
+
+    with Instruments(model, profile="sample") as inst:
+        tebe_search(model)
+    print(inst.to_json())
+"""
+
+import cProfile
+import collections
+import json
+import signal
+import time
+
+import model as model_a
+
+# operations wrapped on the model instance when it defines them
+OPS = ('select', 'select_at', 'select_random', 'merge', 'merge_at',
+       'merge_random', 'filter', 'agree', 'get_mergables',
+       'count_mergables', 'sample_mergable', 'get_possible_merges')
+
+
+class Sampler:
+    """
+    Statistical profiler: samples the Python stack on a CPU timer and
+    counts collapsed stacks ("outer;inner;leaf"), the input format of
+    flame graph tools.
+    """
+    def __init__(self, interval=0.001):
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self._previous = None
+
+    def _sample(self, signum, frame):
+        names = list()
+        while frame is not None:
+            code = frame.f_code
+            names.append(f"{code.co_name} ({code.co_filename}:{code.co_firstlineno})")
+            frame = frame.f_back
+        self.stacks[';'.join(reversed(names))] += 1
+
+    def enable(self):
+        self._previous = signal.signal(signal.SIGPROF, self._sample)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def disable(self):
+        signal.setitimer(signal.ITIMER_PROF, 0)
+        signal.signal(signal.SIGPROF, self._previous)
+
+    def collapsed(self) -> str:
+        return '\n'.join(f"{stack} {n}" for stack, n in self.stacks.items())
+
+
+class Instruments:
+    """
+    Per-operation counters for one model instance.
+    """
+    def __init__(self, model, profile=None, interval=0.001):
+        """
+        default ctor
+        :param model: Composer, ComposerB or dissertation.Model
+        :param profile: None, "cprofile" or "sample"
+        :param interval: seconds between samples for "sample"
+        """
+        self.model = model
+        self.calls = collections.Counter()
+        self.seconds = collections.Counter()
+        self.derivations = 0
+        self.crashes = 0
+        self.filter_hits = 0
+        self.enabled = False
+
+        if profile is None:
+            self.profiler = None
+        elif profile == "cprofile":
+            self.profiler = cProfile.Profile()
+        elif profile == "sample":
+            self.profiler = Sampler(interval)
+        else:
+            raise ValueError(f"unknown profiler: {profile}")
+
+        self._spell_out = None
+
+    def _wrap(self, name, method):
+        calls = self.calls
+        seconds = self.seconds
+        clock = time.perf_counter
+
+        def timed(*args, **kwargs):
+            start = clock()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                seconds[name] += clock() - start
+                calls[name] += 1
+        return timed
+
+    def _wrap_filter(self, method):
+        timed = self._wrap('filter', method)
+
+        def counted(*args, **kwargs):
+            passed = timed(*args, **kwargs)
+            if passed:
+                self.filter_hits += 1
+            return passed
+        return counted
+
+    def _wrap_steps(self, method):
+        def counted(*args, **kwargs):
+            # every derivation, eager or lazy, runs this generator;
+            # it counts once the derivation runs to its end
+            success = yield from method(*args, **kwargs)
+            self.derivations += 1
+            self.crashes += not success
+            return success
+        return counted
+
+    def _wrap_generate(self, method):
+        timed = self._wrap('generate_v3', method)
+
+        def counted(*args, **kwargs):
+            out = timed(*args, **kwargs)
+            self.derivations += 1
+            # generate_v3 returns early when it crashes
+            wanted = kwargs.get('n', args[0] if args else 10)
+            self.crashes += len(out) < wanted
+            return out
+        return counted
+
+    def start(self):
+        """
+        Installs the counters on the model instance (and spell_out on
+        model.SyntacticObject) and starts the profiler, if any.
+        """
+        if self.enabled:
+            return
+        m = self.model
+        for name in OPS:
+            if hasattr(m, name):
+                method = getattr(m, name)
+                if name == 'filter':
+                    setattr(m, name, self._wrap_filter(method))
+                else:
+                    setattr(m, name, self._wrap(name, method))
+        if hasattr(m, 'derive'):
+            m.derive = self._wrap('derive', m.derive)
+        if hasattr(m, '_derive_steps'):
+            m._derive_steps = self._wrap_steps(m._derive_steps)
+        if hasattr(m, 'generate_v3'):
+            m.generate_v3 = self._wrap_generate(m.generate_v3)
+
+        self._spell_out = model_a.SyntacticObject.spell_out
+        model_a.SyntacticObject.spell_out = self._wrap('spell_out',
+                                                       self._spell_out)
+        if self.profiler is not None:
+            self.profiler.enable()
+        self.enabled = True
+
+    def stop(self):
+        """
+        Removes every wrapper, leaving the model as it was.
+        """
+        if not self.enabled:
+            return
+        if self.profiler is not None:
+            self.profiler.disable()
+        for name in OPS + ('derive', '_derive_steps', 'generate_v3'):
+            self.model.__dict__.pop(name, None)
+        model_a.SyntacticObject.spell_out = self._spell_out
+        self.enabled = False
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def report(self) -> dict:
+        return {
+            "model": type(self.model).__name__,
+            "derivations": self.derivations,
+            "crashes": self.crashes,
+            "filter_hits": self.filter_hits,
+            "ops": {name: {"calls": self.calls[name],
+                           "seconds": self.seconds[name]}
+                    for name in sorted(self.calls)},
+        }
+
+    def to_json(self, **kwargs) -> str:
+        return json.dumps(self.report(), **kwargs)
+
+    def dump_profile(self, path):
+        """
+        Writes the profiler session: pstats for cProfile, collapsed
+        stacks for the sampler.
+
+        :param path: str
+        """
+        if isinstance(self.profiler, cProfile.Profile):
+            self.profiler.dump_stats(path)
+        elif isinstance(self.profiler, Sampler):
+            with open(path, "w") as f:
+                f.write(self.profiler.collapsed())
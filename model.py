@@ -27,35 +27,79 @@ October 6, 2019
 Done in work for undergraduate Honors Thesis
 """
 
+import ast
+import itertools
 import random
+import weakref
+
+import search
+from tracer import PrintTracer, Tracer
 
 
 class Stufe:
     """Musical equivalent of "Lexical Item"
-    Chromatic edition"""
+    Chromatic edition
+
+    Stufen are hash-consed and never modified once built: constructing
+    an equivalent Stufe returns the live instance, so name and c3 are
+    computed once and == is identity. Distinct tokens of one Stufe in a
+    Lexical Array or Workspace are kept apart by position (see
+    Composer.Stage)."""
     # Circle of Fifths in sharps, octave equivalence
     FIFTHS_NAMES = ['C', 'G', 'D', 'A', 'E', 'B',
                     'F#', 'C#', 'G#', 'D#', 'A#', 'F']
     FIFTHS_NAMES_MINOR = ['a', 'e', 'b', 'f#', 'c#', 'g#',
                           'd#', 'a#', 'f', 'c', 'g', 'd']
 
-    def __init__(self, c5=0, major=True, dim=False):
+    __slots__ = ('is_major', 'is_dim', 'c5', 'c3', 'name', 'leaves', 'size',
+                 'leftmost_c5', 'right_left_c5', 'ursatz', '__weakref__')
+    # hash-cons table, one live instance per distinct Stufe
+    _interned = weakref.WeakValueDictionary()
+
+    def __new__(cls, c5=0, major=True, dim=False):
         # default ctor
-        self.is_major = major
+        major = bool(major)
         # setting to Major overrides diminished
-        self.is_dim = dim if not major else False
+        dim = bool(dim) and not major
+        key = (cls, c5, major, dim)
+        self = cls._interned.get(key)
+        if self is not None:
+            return self
+
+        self = super().__new__(cls)
+        setattr_ = object.__setattr__
+        setattr_(self, 'is_major', major)
+        setattr_(self, 'is_dim', dim)
         # circle of fifths value
-        self.c5 = c5
+        setattr_(self, 'c5', c5)
         # circle of thirds value represents the c5 value
         # that this chord would have after a "covert progression"
         # (Mukherji, 2014: 358) down a minor third.
-        if self.is_dim:
-            self.c3 = (c5 + 8) % 12
+        if dim:
+            setattr_(self, 'c3', (c5 + 8) % 12)
         else:
             # minor and major have same c3
-            self.c3 = (c5 + 3) % 12
+            setattr_(self, 'c3', (c5 + 3) % 12)
+
+        setattr_(self, 'name', self.get_name())
+        # surface and what Filter reads, as for SyntacticObject
+        setattr_(self, 'leaves', (self,))
+        setattr_(self, 'size', 1)
+        setattr_(self, 'leftmost_c5', c5)
+        setattr_(self, 'right_left_c5', None)
+        setattr_(self, 'ursatz', False)
+        cls._interned[key] = self
+        return self
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"{type(self).__name__} is immutable")
+
+    def __delattr__(self, name):
+        raise AttributeError(f"{type(self).__name__} is immutable")
 
-        self.name = self.get_name()
+    def __reduce__(self):
+        # re-intern on unpickling
+        return type(self), (self.c5, self.is_major, self.is_dim)
 
     def get_name(self):
         # should work for negative cf too
@@ -69,25 +113,157 @@ class Stufe:
     def __str__(self):
         return f"{self.name}: c5 = {self.c5}"
 
+    def spell_out(self):
+        return self.name
+
 
 class SyntacticObject:
-    def __init__(self, m1, m2):
+    """
+    Hash-consed output of Merge, never modified once built. Merging
+    the same two (interned) objects again returns the live SO, so
+    identical subtrees are shared across derivations and == is an O(1)
+    identity check.
+
+    Everything an SO carries is read off its daughters at Merge,
+    including its leaves. In large-scale mode (see large_scale) Merge is
+    O(1) instead: leaves and surface are built without recursion when
+    asked for and not kept.
+
+    Unlike Stufe, an SO has no guard against assignment: Merge sets its
+    slots directly, since going through object.__setattr__ would nearly
+    double its cost. Never assign to an SO's attributes after Merge; a
+    live SO is shared by every derivation that built it.
+    """
+    __slots__ = ('items', 'c5', 'c3', 'size', 'leftmost_c5', 'right_left_c5',
+                 'ursatz', '_leaves', '_surface', '__weakref__')
+    # hash-cons table, (id(m1), id(m2)) -> weak reference to the live
+    # SO. A live SO keeps its daughters alive, so while an entry's SO
+    # is alive its key names them; entries of dead SO's are overwritten
+    # or swept out once the table doubles (see sweep).
+    _interned = dict()
+    _sweep_at = 1 << 16
+    # whether leaves are built at Merge and kept, with the surface
+    keep_leaves = True
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        # a table per class, so a subclass never returns another's SO's
+        cls._interned = dict()
+
+    def __new__(cls, m1, m2):
         """
         Represents the output of Merge.
 
         :param m1: a Stufe or SyntacticObject
         :param m2: a Stufe or SyntacticObject
         """
-
+        key = (id(m1), id(m2))
+        ref = cls._interned.get(key)
+        if ref is not None:
+            self = ref()
+            if self is not None:
+                return self
+
+        self = object.__new__(cls)
         self.items = (m1, m2)
 
         # Latter object projects syntactic features
         self.c5 = m2.c5
         self.c3 = m2.c3
 
+        # number of surface Stufen, and the Stufen themselves unless
+        # in large-scale mode, where a tuple per SO would be O(n^2)
+        # over a deep tree
+        self.size = m1.size + m2.size
+        self._leaves = m1.leaves + m2.leaves if cls.keep_leaves else None
+        self._surface = None
+
+        # what Filter reads, computed once here so it never walks the
+        # tree: c5 of the first Stufe, c5 projected by the right
+        # daughter's left daughter (None if the right daughter is a
+        # Stufe), and whether the SO has the Ursatz in the key of its
+        # own projection
+        self.leftmost_c5 = m1.leftmost_c5
+        right_left_c5 = m2.items[0].c5 if m2.size > 1 else None
+        self.right_left_c5 = right_left_c5
+        self.ursatz = m1.leftmost_c5 == m2.c5 and right_left_c5 == m2.c5 + 1
+
+        interned = cls._interned
+        interned[key] = weakref.ref(self)
+        if len(interned) >= cls._sweep_at:
+            cls.sweep()
+        return self
+
+    @classmethod
+    def sweep(cls):
+        """
+        Drops the hash-cons entries of dead SO's, rebuilding the table
+        so that its memory shrinks with them.
+        """
+        cls._interned = {key: ref for key, ref in cls._interned.items()
+                         if ref() is not None}
+        cls._sweep_at = max(2 * len(cls._interned), 1 << 16)
+
+    def __reduce__(self):
+        # re-intern on unpickling; flattened, since pickling nested
+        # SO's would recurse once per level
+        return _unflatten, (type(self), self.postorder())
+
     def __str__(self):
-        # recursively access contained stufen
-        return f"[{str(self.items[0])}, {str(self.items[1])}]"
+        parts = list()
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            if isinstance(node, str):
+                parts.append(node)
+            elif isinstance(node, SyntacticObject):
+                stack.extend(("]", node.items[1], ", ", node.items[0], "["))
+            else:
+                parts.append(str(node))
+        return ''.join(parts)
+
+    def postorder(self) -> tuple:
+        """
+        The tree as its Stufen in order, each Merge written as None
+        after its daughters.
+
+        :return: tuple of Stufe and None
+        """
+        out = list()
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            if node is None or isinstance(node, Stufe):
+                out.append(node)
+            else:
+                stack.extend((None, node.items[1], node.items[0]))
+        return tuple(out)
+
+    @property
+    def leaves(self) -> tuple:
+        """
+        Surface Stufen in order. In large-scale mode, walks down to
+        the daughters that already have theirs.
+
+        :return: tuple of Stufe
+        """
+        leaves = self._leaves
+        if leaves is None:
+            out = list()
+            stack = [self]
+            while stack:
+                node = stack.pop()
+                if isinstance(node, Stufe):
+                    out.append(node)
+                elif node._leaves is not None:
+                    out.extend(node._leaves)
+                else:
+                    stack.append(node.items[1])
+                    stack.append(node.items[0])
+            leaves = tuple(out)
+            if self.keep_leaves:
+                self._leaves = leaves
+        return leaves
 
     def spell_out(self):
         """
@@ -96,19 +272,59 @@ class SyntacticObject:
 
         :return: str
         """
-        return self._spell_out_helper(self)[:-1]
-
-    def _spell_out_helper(self, so):
+        surface = self._surface
+        if surface is None:
+            surface = ' '.join(s.name for s in self.leaves)
+            if self.keep_leaves:
+                self._surface = surface
+        return surface
+
+    def spells(self, target) -> bool:
         """
-        Recursively access string of surface chord
-        :param so: SyntacticObject
-        :return: str
+        Whether this SO's surface is target.
+
+        :param target: str or sequence of Stufe
+        :return: bool
         """
-        if isinstance(so, Stufe):
-            return so.name + ' '
+        if isinstance(target, str):
+            return (self.size == target.count(' ') + 1
+                    and self.spell_out() == target)
+        target = tuple(target)
+        # Stufen are interned, so this compares identities
+        return self.size == len(target) and self.leaves == target
+
+    def leaf_count(self) -> int:
+        return self.size
+
+
+def _unflatten(cls, postorder):
+    """
+    Inverse of SyntacticObject.postorder.
+
+    :param cls: SyntacticObject or a subclass
+    :param postorder: tuple of Stufe and None
+    :return: SyntacticObject
+    """
+    stack = list()
+    for item in postorder:
+        if item is None:
+            m2 = stack.pop()
+            stack[-1] = cls(stack[-1], m2)
         else:
-            return self._spell_out_helper(so.items[0]) \
-                   + self._spell_out_helper(so.items[1])
+            stack.append(item)
+    return stack[0]
+
+
+def large_scale(enabled=True):
+    """
+    Large-lexicon mode, for derivations over many thousands of Stufen.
+    SO's built meanwhile don't keep their leaves or surface, so Merge
+    is O(1) and memory stays linear in the number of Merges however
+    deep the trees grow; each spell out walks the SO again instead.
+
+    :param enabled: bool
+    """
+    SyntacticObject.keep_leaves = not enabled
 
 """
 class LexicalArray:
@@ -132,30 +348,158 @@ class Workspace:
 """
 
 
+def randbelow(rng, n) -> int:
+    """
+    Uniformly random int in [0, n).
+
+    :param rng: random.Random, numpy.random.Generator, or None for
+                the global random module (seeded by random.seed)
+    :param n: int
+    :return: int
+    """
+    if rng is None:
+        return random.randrange(n)
+    if hasattr(rng, 'integers'):
+        # numpy Generator
+        return int(rng.integers(n))
+    return rng.randrange(n)
+
+
+def pick2(rng, n) -> tuple:
+    """
+    Uniformly random ordered pair of distinct positions in [0, n).
+
+    :param rng: see randbelow
+    :param n: int, at least 2
+    :return: tuple of int
+    """
+    i = randbelow(rng, n)
+    j = randbelow(rng, n - 1)
+    j += j >= i
+    return i, j
+
+
+def sample2(rng, items) -> tuple:
+    """
+    Uniformly random ordered pair of items at distinct positions,
+    as random.sample(items, 2).
+
+    :param rng: see randbelow
+    :param items: list
+    :return: tuple
+    """
+    i, j = pick2(rng, len(items))
+    return items[i], items[j]
+
+
+def swap_pop(items, i):
+    """
+    Removes and returns items[i] in O(1) by moving the last item into
+    its place. Lexical Arrays and Workspaces are unordered, so only
+    the positions of tokens change.
+
+    :param items: list
+    :param i: int
+    :return: the removed item
+    """
+    item = items[i]
+    last = items.pop()
+    if i < len(items):
+        items[i] = last
+    return item
+
+
+# attributes of a Stufe or SO that Filter expressions may read, set
+# once at Merge
+FILTER_ATTRIBUTES = ('c5', 'c3', 'leftmost_c5', 'right_left_c5', 'ursatz')
+# expression -> compiled Filter
+_filters = dict()
+
+
+def compile_filter(expr):
+    """
+    Compiles a Filter written as a Python expression over
+    FILTER_ATTRIBUTES of the new SO and the key's tonic, once per
+    distinct expression, into a function reading only those attributes:
+    O(1) per Merge instead of a walk over the tree. The Ursatz is
+    "ursatz and c5 == tonic", i.e.
+
+        "c5 == tonic and right_left_c5 == tonic + 1 and leftmost_c5 == tonic"
+
+    :param expr: str
+    :return: callable (so, tonic) -> bool
+    :raise ValueError: if expr isn't an expression over those names
+    """
+    if expr in _filters:
+        return _filters[expr]
+    try:
+        tree = ast.parse(expr.strip(), mode='eval')
+    except SyntaxError as e:
+        raise ValueError(f"invalid filter {expr!r}: {e.msg}") from None
+    names = set()
+    for node in ast.walk(tree):
+        if isinstance(node, (ast.Attribute, ast.Call, ast.Lambda,
+                             ast.NamedExpr, ast.comprehension)):
+            raise ValueError(f"filter {expr!r} may only compare attributes")
+        if isinstance(node, ast.Name):
+            names.add(node.id)
+    unknown = names - set(FILTER_ATTRIBUTES) - {'tonic', 'None', 'True', 'False'}
+    if unknown:
+        raise ValueError(f"filter {expr!r} reads unknown names "
+                         f"{', '.join(sorted(unknown))}")
+
+    loads = ''.join(f"    {name} = so.{name}\n"
+                    for name in FILTER_ATTRIBUTES if name in names)
+    source = f"def _filter(so, tonic):\n{loads}    return bool({ast.unparse(tree)})\n"
+    namespace = {'__builtins__': {'bool': bool}}
+    exec(compile(source, f"<filter {expr!r}>", 'exec'), namespace)
+    _filters[expr] = namespace['_filter']
+    return _filters[expr]
+
+
+class Derivation:
+    """
+    A derivation in progress (see Composer.iter_derive). Iterating runs
+    it; success is set once it has run to the end.
+    """
+    def __init__(self, steps):
+        self._steps = steps
+        self.success = None
+
+    def __iter__(self):
+        self.success = yield from self._steps
+
+
 class Composer:
     """
     Model A:
     Stochastic Free-Merge composer dispensing with Agree, indexing,
     and internal Merge (transformations). SpellOuts SyntacticObjects
-    that pass Ursatz Filter. For simplicity, derivations are completed
-    in C Major/A minor (WLOG to other keys).
+    that pass Ursatz Filter. Derivations are completed in the key
+    of tonic, C Major/A minor by default (WLOG to other keys, see
+    transpose.py).
     """
     class Stage:
         # For Select to operate on, to be consistent with C&S 2011
-        def __init__(self, la=set(), workspace=set()):
+        def __init__(self, la=None, workspace=None):
             """
             default ctor
-            :param la: set of Stufe objs
-            :param w: set of SyntacticObject and Stufe objs
+            :param la: collection of Stufe objs
+            :param w: collection of SyntacticObject and Stufe objs
             """
-            # Lexical Array
-            self.la = la
-            # Workspace
-            self.workspace = workspace
+            # Lexical Array and Workspace are lists of tokens: Stufen
+            # and SO's are interned, so equivalent tokens are the same
+            # object and are only told apart by position
+            self.la = list(la or ())
+            self.workspace = list(workspace or ())
 
         def __str__(self):
             return f"<{str(self.la)}, {str(self.workspace)}>"
 
+        def snapshot(self):
+            # copy of this stage, unaffected by later operations
+            return type(self)(la=self.la, workspace=self.workspace)
+
         def print(self):
             # print stage contents nicely
             print("<{", end='')
@@ -164,41 +508,311 @@ class Composer:
             # workspace
             print(*self.workspace, sep=', ', end='}>\n')
 
-    def __init__(self):
-        self.stage_i = 0
-
-    def filter(self, so) -> bool:
+    class Chart:
         """
-        Returns true if so is "fully interpretable." In this case,
-        whether it exhibits the Ursatz at the root.
-
-        :param so: SyntacticObject
-        :return: bool
+        Memo table over the sub-multisets of a Lexical Array, used for
+        exhaustive enumeration. Equivalent Stufen (same c5, quality) are
+        collapsed into one type, and every sub-multiset is tabulated once
+        by (leftmost Stufe, projecting Stufe) signature, so constituents
+        shared by different bracketings are only derived once.
         """
+        def __init__(self, composer, la, cache_limit=1 << 16):
+            """
+            default ctor
+            :param composer: Composer (supplies can_merge and filter)
+            :param la: collection of Stufe objs
+            :param cache_limit: largest cell whose trees are kept in memory
+            """
+            self.composer = composer
+            self.cache_limit = cache_limit
+            # one representative Stufe per distinct type
+            self.stufen = list()
+            index = dict()
+            counts = list()
+            for s in la:
+                key = (s.c5, s.is_major, s.is_dim)
+                if key not in index:
+                    index[key] = len(self.stufen)
+                    self.stufen.append(s)
+                    counts.append(0)
+                counts[index[key]] += 1
+            self.root = tuple(counts)
+
+            # Filter only reads the root's leftmost and projecting Stufen
+            # and the right daughter's left daughter, so it is decided
+            # once per (leftmost, right daughter's left daughter's proj,
+            # proj) on representative SO's; None for a leaf right daughter
+            types = range(len(self.stufen))
+            self.accepted = set()
+            for l in types:
+                for p3 in (None, *types):
+                    for p4 in types:
+                        right = self.stufen[p4]
+                        if p3 is not None:
+                            right = SyntacticObject(self.stufen[p3], right)
+                        if composer.filter(SyntacticObject(self.stufen[l], right)):
+                            self.accepted.add((l, p3, p4))
+            self.firsts = {l for l, p3, p4 in self.accepted}
+            self.needed = {(p3, p4) for l, p3, p4 in self.accepted}
+
+            # sub-multiset -> {(leftmost, proj): number of trees}
+            self._cells = dict()
+            # sub-multiset -> {proj: number of trees}
+            self._proj = dict()
+            # sub-multiset -> {(left daughter's proj, proj): number of
+            # trees Filter may accept as a right daughter}
+            self._tails = dict()
+            self._splits = dict()
+            self._ok = dict()
+            self._trees = dict()
+
+        def submultisets(self, m):
+            return itertools.product(*[range(c + 1) for c in m])
+
+        def splits(self, m):
+            """
+            Ordered splits of m into two non-empty sub-multisets.
 
-        is_tonic = (so.c5 == 0)
-        has_dominant = False
-        starts_with_tonic = False
+            :param m: tuple of counts
+            :return: list of (tuple, tuple, bool) with right-is-leaf flag
+            """
+            if m not in self._splits:
+                n = sum(m)
+                found = list()
+                for a in self.submultisets(m):
+                    if 0 < sum(a) < n:
+                        b = tuple(x - y for x, y in zip(m, a))
+                        found.append((a, b, sum(b) == 1))
+                self._splits[m] = found
+            return self._splits[m]
+
+        def ok(self, left_proj, right_proj, right_is_leaf) -> bool:
+            """
+            Memoized can_merge on representative SO's of two signatures.
+            """
+            key = (left_proj, right_proj, right_is_leaf)
+            if key not in self._ok:
+                so1 = SyntacticObject(self.stufen[left_proj],
+                                      self.stufen[left_proj])
+                so2 = self.stufen[right_proj]
+                if not right_is_leaf:
+                    so2 = SyntacticObject(so2, so2)
+                self._ok[key] = self.composer.can_merge(so1, so2)
+            return self._ok[key]
+
+        def cell(self, m) -> dict:
+            """
+            Counts of trees over exactly m by (leftmost, proj) signature.
+
+            :param m: tuple of counts
+            :return: dict
+            """
+            if m in self._cells:
+                return self._cells[m]
+
+            cell = dict()
+            if sum(m) == 1:
+                i = m.index(1)
+                cell[(i, i)] = 1
+            else:
+                for a, b, leaf in self.splits(m):
+                    right = self.proj(b)
+                    for (l, p1), n1 in self.cell(a).items():
+                        for p2, n2 in right.items():
+                            if self.ok(p1, p2, leaf):
+                                cell[(l, p2)] = cell.get((l, p2), 0) + n1 * n2
+
+            self._cells[m] = cell
+            proj = dict()
+            for (l, p), n in cell.items():
+                proj[p] = proj.get(p, 0) + n
+            self._proj[m] = proj
+            return cell
+
+        def proj(self, m) -> dict:
+            self.cell(m)
+            return self._proj[m]
+
+        def tails(self, m) -> dict:
+            """
+            Counts of trees over m that some accepted root could have
+            as its right daughter, by (proj of their left daughter,
+            proj); a single Stufe has no left daughter (None).
+
+            :param m: tuple of counts
+            :return: dict
+            """
+            if m in self._tails:
+                return self._tails[m]
+
+            tails = dict()
+            if sum(m) == 1:
+                i = m.index(1)
+                if (None, i) in self.needed:
+                    tails[(None, i)] = 1
+            else:
+                for a, b, leaf in self.splits(m):
+                    left = self.proj(a)
+                    for p4, n2 in self.proj(b).items():
+                        for p3, n1 in left.items():
+                            if (p3, p4) in self.needed and self.ok(p3, p4, leaf):
+                                tails[(p3, p4)] = tails.get((p3, p4), 0) + n1 * n2
+
+            self._tails[m] = tails
+            return tails
+
+        def count_filtered(self, m) -> int:
+            """
+            Number of trees over exactly m that pass Filter.
+
+            :param m: tuple of counts
+            :return: int
+            """
+            total = 0
+            for a, b, leaf in self.splits(m):
+                right = self.tails(b)
+                if not right:
+                    continue
+                for (l, p1), n1 in self.cell(a).items():
+                    if l not in self.firsts:
+                        continue
+                    for (p3, p4), n2 in right.items():
+                        if (l, p3, p4) in self.accepted and self.ok(p1, p4, leaf):
+                            total += n1 * n2
+            return total
+
+        def trees(self, m, l, p):
+            """
+            Yields every tree over exactly m with signature (l, p).
+            Small cells are materialized once and shared.
 
-        if isinstance(so.items[1], SyntacticObject):
-            has_dominant = (so.items[1].items[0].c5 == 1)
+            :param m: tuple of counts
+            :param l: leftmost Stufe type
+            :param p: projecting Stufe type
+            :return: generator of Stufe or SyntacticObject
+            """
+            key = (m, l, p)
+            if key in self._trees:
+                yield from self._trees[key]
+                return
+
+            n = self.cell(m).get((l, p), 0)
+            if n == 0:
+                return
+            if sum(m) == 1:
+                self._trees[key] = (self.stufen[l],)
+                yield self.stufen[l]
+                return
+
+            built = list() if n <= self.cache_limit else None
+            for a, b, leaf in self.splits(m):
+                right = self.cell(b)
+                for (l1, p1) in self.cell(a):
+                    if l1 != l:
+                        continue
+                    for (l2, p2) in right:
+                        if p2 != p or not self.ok(p1, p2, leaf):
+                            continue
+                        for so1 in self.trees(a, l1, p1):
+                            for so2 in self.trees(b, l2, p2):
+                                so = SyntacticObject(so1, so2)
+                                if built is not None:
+                                    built.append(so)
+                                yield so
+            if built is not None:
+                self._trees[key] = tuple(built)
+
+        def filtered(self, m):
+            """
+            Yields every tree over exactly m that passes Filter.
 
-        if is_tonic and has_dominant:
-            starts_with_tonic = self._filter_helper(so.items[0])
+            :param m: tuple of counts
+            :return: generator of SyntacticObject
+            """
+            accepted = self.accepted
+            for a, b, leaf in self.splits(m):
+                if not self.tails(b):
+                    continue
+                if leaf:
+                    p4 = b.index(1)
+                    for (l, p1) in self.cell(a):
+                        if (l, None, p4) in accepted and self.ok(p1, p4, True):
+                            for so1 in self.trees(a, l, p1):
+                                yield SyntacticObject(so1, self.stufen[p4])
+                    continue
+                for (l, p1) in self.cell(a):
+                    if l not in self.firsts:
+                        continue
+                    for b1, b2, leaf2 in self.splits(b):
+                        for (l3, p3) in self.cell(b1):
+                            for (l4, p4) in self.cell(b2):
+                                if not ((l, p3, p4) in accepted
+                                        and self.ok(p3, p4, leaf2)
+                                        and self.ok(p1, p4, False)):
+                                    continue
+                                for so3 in self.trees(b1, l3, p3):
+                                    for so4 in self.trees(b2, l4, p4):
+                                        so2 = SyntacticObject(so3, so4)
+                                        for so1 in self.trees(a, l, p1):
+                                            yield SyntacticObject(so1, so2)
+
+    def __init__(self, tracer=None, rng=None, tonic=0, filter_expr=None):
+        """
+        default ctor
+        :param tracer: tracer.Tracer receiving derivation events,
+                       silent if None
+        :param rng: random.Random or numpy.random.Generator drawing
+                    Select and Merge; the global random module if None
+        :param tonic: int, c5 of the key's tonic Filter looks for
+                      (0 for C major/A minor)
+        :param filter_expr: str, Filter in place of the Ursatz, see
+                            compile_filter
+        """
+        self.stage_i = 0
+        self.tracer = tracer or Tracer()
+        self.rng = rng
+        self.tonic = tonic
+        # kept as source (compiled functions don't pickle to workers)
+        self.filter_expr = filter_expr
+        self._filter = None if filter_expr is None else compile_filter(filter_expr)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_filter']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._filter = None if self.filter_expr is None \
+            else compile_filter(self.filter_expr)
+
+    def seed(self, seed):
+        """
+        Reseeds the model's RNG, so that derivations can be replayed.
 
-        return is_tonic and has_dominant and starts_with_tonic
+        :param seed: int
+        """
+        if self.rng is None:
+            random.seed(seed)
+        elif hasattr(self.rng, 'bit_generator'):
+            # numpy Generator, reseeded with the same bit generator
+            self.rng = type(self.rng)(type(self.rng.bit_generator)(seed))
+        else:
+            self.rng.seed(seed)
 
-    def _filter_helper(self, so) -> bool:
+    def filter(self, so) -> bool:
         """
-        recursively check for tonic Stufe in left branches
+        Returns true if so is "fully interpretable." In this case,
+        whether it exhibits the Ursatz at the root.
 
-        :param so: SyntacticObject or Stufe
+        :param so: SyntacticObject
         :return: bool
         """
-        if isinstance(so, Stufe):
-            return so.c5 == 0
-        else:
-            return self._filter_helper(so.items[0])
+        if self._filter is not None:
+            return self._filter(so, self.tonic)
+        # tonic at the root, dominant heading the right daughter and
+        # tonic first, read off attributes set at Merge
+        return so.ursatz and so.c5 == self.tonic
 
     def select(self, item: Stufe, stage: Stage) -> Stage:
         """
@@ -210,10 +824,17 @@ class Composer:
         :param stage: Stage
         :return: Stage
         """
-        stage.la = stage.la - {item}
-        # Stufe doesn't have == overloaded, so workspace
-        # will store distinct copies of otherwise equivalent stufen
-        stage.workspace.add(item)
+        return self.select_at(stage.la.index(item), stage)
+
+    def select_at(self, i: int, stage: Stage) -> Stage:
+        """
+        Select of the token at position i of stage.la, in O(1).
+
+        :param i: int
+        :param stage: Stage
+        :return: Stage
+        """
+        stage.workspace.append(swap_pop(stage.la, i))
         return stage
 
     def select_random(self, stage: Stage) -> Stage:
@@ -225,9 +846,7 @@ class Composer:
         :param stage: Composer.Stage
         :return: Composer.Stage
         """
-        # oof TODO: consider not using hash tables
-        item = random.choice(tuple(stage.la))
-        return self.select(item, stage)
+        return self.select_at(randbelow(self.rng, len(stage.la)), stage)
 
     def merge(self, so1, so2, stage: Stage) -> SyntacticObject:
         """
@@ -241,9 +860,29 @@ class Composer:
         :param stage: Composer.Stage
         :return: SyntacticObject
         """
-        stage.workspace = ((stage.workspace - {so1}) - {so2})
+        workspace = stage.workspace
+        i = workspace.index(so1)
+        # two tokens of one interned SO sit at different positions
+        j = workspace.index(so2, i + 1) if so2 is so1 else workspace.index(so2)
+        return self.merge_at(i, j, stage)
+
+    def merge_at(self, i: int, j: int, stage: Stage) -> SyntacticObject:
+        """
+        Merge of the tokens at positions i and j (i != j) of
+        stage.workspace, in O(1).
+
+        :param i: int
+        :param j: int
+        :param stage: Composer.Stage
+        :return: SyntacticObject
+        """
+        workspace = stage.workspace
+        so1, so2 = workspace[i], workspace[j]
+        # the later position first, so the earlier one stays put
+        swap_pop(workspace, max(i, j))
+        swap_pop(workspace, min(i, j))
         new_so = SyntacticObject(so1, so2)
-        stage.workspace.add(new_so)
+        workspace.append(new_so)
         return new_so
 
     def merge_random(self, stage: Stage) -> SyntacticObject:
@@ -253,33 +892,69 @@ class Composer:
         :param stage: Stage
         :return: stage
         """
-        # oof TODO: consider not using hash tables
-        so1, so2 = random.sample(tuple(stage.workspace), 2)
-        return self.merge(so1, so2, stage)
+        i, j = pick2(self.rng, len(stage.workspace))
+        return self.merge_at(i, j, stage)
 
-    def derive(self, la, verbose=True):
+    def derive(self, la, verbose=False):
         """
         Executes a derivation starting with LexicalArray la.
         Every SO generated that passes Filter will be spelled out.
 
         :param la: collection of Stufe objs
+        :param verbose: bool, print every stage regardless of self.tracer
         :return: collection of derivations, bool
         """
-
         if len(la) < 2:
             print("Error: You need more than 2 Stufen to compose")
             return list()
 
+        derivation = self.iter_derive(la, verbose=verbose)
+        derivations = list(derivation)
+        return derivations, derivation.success
+
+    def iter_derive(self, la, stages=False, verbose=False) -> Derivation:
+        """
+        Lazy derive(): nothing runs until the result is iterated, and
+        each SO that passes Filter is yielded as soon as Merge builds
+        it. With stages, yields ('stage', Stage snapshot) after every
+        step and ('transfer', SO) instead.
+
+        :param la: collection of Stufe objs
+        :param stages: bool
+        :param verbose: bool, print every stage regardless of self.tracer
+        :return: Derivation
+        """
+        tracer = PrintTracer() if verbose else self.tracer
+        return Derivation(self._derive_steps(la, stages, tracer))
+
+    def attempts(self, la, stages=False):
+        """
+        Endless stream of lazy derivations from la, for search and
+        statistics pipelines. Bound it with itertools.islice or stop
+        consuming; an attempt that is never iterated never runs.
+
+        :param la: collection of Stufe objs
+        :param stages: bool, see iter_derive
+        :return: generator of Derivation
+        """
+        while True:
+            yield self.iter_derive(la, stages=stages)
+
+    def _derive_steps(self, la, stages, tracer):
+        """
+        The derivation loop behind iter_derive.
+
+        :return: generator of SO's (or events); returns success
+        """
         # set up (select 2)
-        derivations = list()
-        current = Composer.Stage(la=set(la), workspace=set())
+        current = self.Stage(la=la)
         current = self.select_random(current)
         current = self.select_random(current)
         self.stage_i = 2
 
         # derivation
         while len(current.la) > 0 or len(current.workspace) != 1:
-            flip = random.choice([0,1])
+            flip = randbelow(self.rng, 2)
             if flip and len(current.la) > 0:
                 # Select
                 current = self.select_random(current)
@@ -289,22 +964,172 @@ class Composer:
                 # Filter and spell out
                 if self.filter(new_so):
                     # found a valid derivation!
-                    derivations.append(new_so)
+                    if tracer.enabled:
+                        tracer.emit('transfer', i=self.stage_i, so=new_so)
+                    yield ('transfer', new_so) if stages else new_so
 
             self.stage_i += 1
-            if verbose:
-                print(f"Stage #{self.stage_i}:")
-                print(current)
-                print()
+            if tracer.enabled:
+                tracer.emit('stage', i=self.stage_i, stage=current)
+            if stages:
+                yield 'stage', current.snapshot()
 
         # end of derivation
-        if self.filter(list(current.workspace)[0]):  # awk
-            print("Derivation finished")
-            return derivations, True
-        else:
-            # derivation crashed
-            print("Derivation crashed")
-            return derivations, False
+        success = self.filter(list(current.workspace)[0])  # awk
+        if tracer.enabled:
+            # crashed unless success
+            tracer.emit('end', i=self.stage_i, success=success)
+        return success
+
+    def can_merge(self, so1, so2) -> bool:
+        """
+        Returns whether so1 and so2 may be Merged in the order
+        specified. Model A has free Merge, so always true.
+
+        :param so1: Stufe or SyntacticObject
+        :param so2: Stufe or SyntacticObject
+        :return: bool
+        """
+        return True
+
+    def count_mergables(self, stage: Stage) -> int:
+        """
+        Number of ordered pairs in stage.workspace that may Merge.
+
+        :param stage: Stage
+        :return: int
+        """
+        n = len(stage.workspace)
+        return n * (n - 1)
+
+    def sample_mergable(self, stage: Stage):
+        """
+        Uniformly random ordered pair of SO's in stage.workspace
+        that may Merge.
+
+        :param stage: Stage
+        :return: tuple of SO's, or None if no Merge is possible
+        """
+        if len(stage.workspace) < 2:
+            return None
+        return sample2(self.rng, stage.workspace)
+
+    def derive_target(self, la, target, guided=True):
+        """
+        Executes a derivation starting with LexicalArray la that
+        gives up as soon as it can no longer spell out target: every
+        Merge has to build a contiguous, in-order segment of target.
+        target must spell out all of la, as the Tebe poem does, so
+        a derivation reaching it never builds any other SO.
+
+        guided=False samples Merges like derive() and restarts at the
+        first one off target, so hits (and attempt counts) have exactly
+        derive()'s distribution, minus the wasted steps.
+        guided=True only proposes Merges on target. The returned weight
+        is the likelihood ratio to derive(), so weighted hits stay fair
+        and the mean weight over attempts estimates P(target).
+
+        :param la: collection of Stufe objs
+        :param target: str, spelled out surface
+        :param guided: bool
+        :return: SyntacticObject or None, float
+        """
+        target = tuple(target.split())
+        if sorted(target) != sorted(s.name for s in la):
+            raise ValueError("target must spell out the whole Lexical Array")
+
+        # SO -> positions in target where its leaves start
+        starts = dict()
+
+        def fits(so1, so2):
+            for so in (so1, so2):
+                if so not in starts:
+                    n = so.size
+                    names = tuple(s.name for s in so.leaves)
+                    starts[so] = {i for i in range(len(target) - n + 1)
+                                  if target[i:i + n] == names}
+            n = so1.size
+            return any(i + n in starts[so2] for i in starts[so1])
+
+        weight = 1.0
+        current = self.Stage(la=la)
+        current = self.select_random(current)
+        current = self.select_random(current)
+
+        while len(current.la) > 0 or len(current.workspace) != 1:
+            flip = randbelow(self.rng, 2)
+            if flip and len(current.la) > 0:
+                # Select
+                current = self.select_random(current)
+            elif not flip and len(current.workspace) != 1:
+                # Merge
+                total = self.count_mergables(current)
+                if total == 0:
+                    # no operation, or crash
+                    if len(current.la) == 0:
+                        return None, 0.0
+                    continue
+                if guided:
+                    on_target = [(so1, so2) for so1, so2
+                                 in itertools.permutations(current.workspace, 2)
+                                 if self.can_merge(so1, so2) and fits(so1, so2)]
+                    if not on_target:
+                        return None, 0.0
+                    weight *= len(on_target) / total
+                    so1, so2 = on_target[randbelow(self.rng, len(on_target))]
+                else:
+                    so1, so2 = self.sample_mergable(current)
+                    if not fits(so1, so2):
+                        return None, 0.0
+                new_so = self.merge(so1, so2, current)
+                if new_so.size == len(target):
+                    if self.filter(new_so):
+                        return new_so, weight
+                    return None, 0.0
+
+        return None, 0.0
+
+    def count_derivations(self, la) -> int:
+        """
+        Exact number of distinct SO's that pass Filter over all
+        derivations starting with LexicalArray la, i.e. every tree
+        derive() can spell out. Equivalent Stufen are not distinguished.
+
+        :param la: collection of Stufe objs
+        :return: int
+        """
+        chart = Composer.Chart(self, la)
+        return sum(chart.count_filtered(m)
+                   for m in chart.submultisets(chart.root) if sum(m) > 1)
+
+    def enumerate_derivations(self, la, cache_limit=1 << 16):
+        """
+        Lazily yields every distinct SO that passes Filter over all
+        derivations starting with LexicalArray la. Sub-derivations
+        are memoized per sub-multiset of la and shared between trees.
+
+        :param la: collection of Stufe objs
+        :param cache_limit: largest memo cell kept in memory
+        :return: generator of SyntacticObject
+        """
+        chart = Composer.Chart(self, la, cache_limit=cache_limit)
+        for m in chart.submultisets(chart.root):
+            if sum(m) > 1:
+                yield from chart.filtered(m)
+
+
+# all stufen hypothesized to be in Bortniansky's Tebe Poem
+TEBE_LEXICON = [(0, True), (0, True), (-1, True),
+                (2, True), (1, True), (4, True), (0, False),
+                (6, True), (1, True), (0, True)]
+TEBE = "C C F D G E a F# G C"
+
+
+def tebe_lexical_array() -> list:
+    """
+    :return: list of Stufe in the Tebe poem
+    """
+    return [Stufe(c5=c5, major=is_major) for c5, is_major in TEBE_LEXICON]
 
 
 def tebe_search(model: Composer) -> (int, int, list):
@@ -313,43 +1138,37 @@ def tebe_search(model: Composer) -> (int, int, list):
     :param model: Composer
     :return: SyntacticObject
     """
-    # all stufen hypothesized to be in Bortniansky's Tebe Poem
-    lexicon = [(0, True), (0, True), (-1, True),
-               (2, True), (1, True), (4, True), (0, False),
-               (6, True), (1, True), (0, True)]
-    TEBE = "C C F D G E a F# G C"
-    lexical_array = list()
-
-    for c5, is_major in lexicon:
-        lexical_array.append(Stufe(c5=c5, major=is_major))
-
-    #all_derivations = list()
-    spelled = list()
-    count = 0
+    lexical_array = tebe_lexical_array()
 
     # check for tebe, derive again if necessary
-    while TEBE not in spelled:
-        count += 1
-        new, success = model.derive(lexical_array, verbose=False)
+    for count, derivation in enumerate(model.attempts(lexical_array), 1):
+        new = list(derivation)
         spelled = [ d.spell_out() for d in new ]
-        #all_derivations.extend(new)
+        if TEBE in spelled:
+            return spelled, count, new
 
-    return spelled, count, new
+
+def parallel_tebe_search(model: Composer, workers=None, seed=None):
+    """
+    tebe_search spread over a pool of worker processes. Stops
+    every worker at the first hit.
+
+    :param model: Composer
+    :param workers: number of processes, defaults to all cores
+    :param seed: int, master seed
+    :return: search.SearchResult (winning seed, total attempts,
+             spelled surfaces, derivations)
+    """
+    return search.parallel_search(model, tebe_lexical_array(), TEBE,
+                                  workers=workers, seed=seed)
 
 
 def main():
     # tebe testing
-    # all stufen hypothesized to be in Bortniansky's Tebe Poem
-    lexicon = [(0, True), (0, True), (-1, True),
-               (2, True), (1, True), (4, True), (0, False),
-               (6, True), (1, True), (0, True)]
-    lexical_array = list()
-
-    for c5, is_major in lexicon:
-        lexical_array.append(Stufe(c5=c5, major=is_major))
+    lexical_array = tebe_lexical_array()
 
     model = Composer()
-    derivations, success = model.derive(lexical_array)
+    derivations, success = model.derive(lexical_array, verbose=True)
 
     print("All Derivations\n===============")
     print(derivations)
@@ -28,14 +28,86 @@ July 26, 2020
 Done in work for undergraduate Honors Thesis
 """
 
-import random
-import itertools
+import search
 
-from model import Composer, Stufe, SyntacticObject
+from model import Composer, Stufe, SyntacticObject, randbelow, swap_pop
+
+
+def _add(items, where, item):
+    # appends item, recording its position in where
+    where.setdefault(item, set()).add(len(items))
+    items.append(item)
+
+
+def _discard(items, where, item):
+    """
+    Removes a token of item from items in O(1), by moving the last
+    token into its place. where maps each item to the set of its
+    positions in items and is kept up to date.
+    """
+    positions = where[item]
+    i = positions.pop()
+    if not positions:
+        del where[item]
+    last = len(items) - 1
+    if i != last:
+        moved = items[last]
+        items[i] = moved
+        positions = where[moved]
+        positions.remove(last)
+        positions.add(i)
+    items.pop()
 
 
 class ComposerB(Composer):
     # Mukherji (2014) model
+    class Stage(Composer.Stage):
+        """
+        Stage whose Workspace is also bucketed by Agree signature.
+        Agree only reads c5, c3 and (for Stufen) quality, so every item
+        in a bucket agrees with the same others. ComposerB's select and
+        merge keep the buckets, which of them agree, and the number of
+        ordered pairs of SO's that agree up to date as they go.
+        """
+        def __init__(self, la=None, workspace=None):
+            super().__init__(la=la, workspace=workspace)
+            # token -> its positions in the workspace, and in its bucket,
+            # so that Merge removes SO's in O(1)
+            self.where = dict()
+            for i, so in enumerate(self.workspace):
+                self.where.setdefault(so, set()).add(i)
+            self.slots = dict()
+            # signature -> workspace tokens
+            self.buckets = dict()
+            for so in self.workspace:
+                _add(self.buckets.setdefault(self.signature(so), list()),
+                     self.slots, so)
+            # signature -> signatures of the buckets it agrees with as
+            # the first of a pair (after) and as the second (before),
+            # signature -> number of agreeing ordered pairs of tokens
+            # whose first is in its bucket (rows), and their total;
+            # built by ComposerB when a Workspace is given
+            self.after = None if self.buckets else dict()
+            self.before = None if self.buckets else dict()
+            self.rows = None if self.buckets else dict()
+            self.total = 0
+
+        @staticmethod
+        def signature(so):
+            # Stufen are interned, so a Stufe is its own signature
+            if isinstance(so, Stufe):
+                return so
+            return so.c5, so.c3
+
+    def __init__(self, tracer=None, rng=None, tonic=0, filter_expr=None):
+        """
+        default ctor, see Composer
+        """
+        super().__init__(tracer=tracer, rng=rng, tonic=tonic,
+                         filter_expr=filter_expr)
+        # (signature, signature) -> whether they agree in that order
+        self._agree = dict()
+
     def agree(self, so1, so2) -> bool:
         """
         Stufen-based Agree. Returns whether so1 and
@@ -54,86 +126,280 @@ class ComposerB(Composer):
                        and (0 <= so1.c5 - so2.c3 <= 1)
         return do_agree
 
-    def get_mergables(self, stage: Composer.Stage) -> (bool, list):
+    def can_merge(self, so1, so2) -> bool:
+        # Merge is driven by Agree
+        return self.agree(so1, so2)
+
+    def _index(self, stage: Stage) -> Stage:
+        """
+        Fills in which buckets agree, and how many pairs, for a Stage
+        that was built with a Workspace.
+        """
+        if stage.after is None:
+            buckets = stage.buckets
+            stage.buckets = dict()
+            stage.slots = dict()
+            stage.after = dict()
+            stage.before = dict()
+            stage.rows = dict()
+            stage.total = 0
+            for bucket in buckets.values():
+                for so in bucket:
+                    self._file(stage, so)
+        return stage
+
+    def _file(self, stage: Stage, so):
+        """
+        Adds so to its bucket, counting the pairs it agrees in.
+        """
+        sig = stage.signature(so)
+        buckets = stage.buckets
+        bucket = buckets.get(sig)
+        if bucket is None:
+            if stage.after is None:
+                _add(buckets.setdefault(sig, list()), stage.slots, so)
+                return
+            after, before = stage.after, stage.before
+            bucket = buckets[sig] = list()
+            stage.rows[sig] = 0
+            mine = after[sig] = dict()
+            theirs = before[sig] = dict()
+            agree = self._agree
+            for other, b in buckets.items():
+                rep = b[0] if b else so
+                key = (sig, other)
+                found = agree.get(key)
+                if found is None:
+                    found = agree[key] = self.agree(so, rep)
+                if found:
+                    mine[other] = None
+                    before[other][sig] = None
+                if other != sig:
+                    key = (other, sig)
+                    found = agree.get(key)
+                    if found is None:
+                        found = agree[key] = self.agree(rep, so)
+                    if found:
+                        after[other][sig] = None
+                        theirs[other] = None
+        elif stage.after is None:
+            _add(bucket, stage.slots, so)
+            return
+
+        self._count(stage, sig, len(bucket), 1)
+        _add(bucket, stage.slots, so)
+
+    def _unfile(self, stage: Stage, so):
+        """
+        Removes so from its bucket, uncounting the pairs it agreed in.
+        """
+        sig = stage.signature(so)
+        bucket = stage.buckets[sig]
+        _discard(bucket, stage.slots, so)
+        if stage.after is not None:
+            self._count(stage, sig, len(bucket), -1)
+        if not bucket:
+            del stage.buckets[sig]
+            if stage.after is not None:
+                del stage.rows[sig]
+                for other in stage.after.pop(sig):
+                    stage.before[other].pop(sig, None)
+                for other in stage.before.pop(sig):
+                    stage.after[other].pop(sig, None)
+
+    @staticmethod
+    def _count(stage: Stage, sig, n, step):
+        """
+        Counts in (step 1) or out (step -1) the agreeing pairs of one
+        token of sig, alongside n others.
+        """
+        buckets = stage.buckets
+        rows = stage.rows
+        pairs = 0
+        for other in stage.after[sig]:
+            # n (n - 1) ordered pairs within the bucket become (n + 1) n
+            pairs += 2 * n if other == sig else len(buckets[other])
+        rows[sig] += step * pairs
+        for other in stage.before[sig]:
+            if other != sig:
+                theirs = len(buckets[other])
+                rows[other] += step * theirs
+                pairs += theirs
+        stage.total += step * pairs
+
+    def select_at(self, i: int, stage: Stage) -> Stage:
+        item = swap_pop(stage.la, i)
+        _add(stage.workspace, stage.where, item)
+        self._file(stage, item)
+        return stage
+
+    def merge(self, so1, so2, stage: Stage) -> SyntacticObject:
+        # O(1) by the positions the stage keeps, rather than searching
+        for so in (so1, so2):
+            _discard(stage.workspace, stage.where, so)
+            self._unfile(stage, so)
+        new_so = SyntacticObject(so1, so2)
+        _add(stage.workspace, stage.where, new_so)
+        self._file(stage, new_so)
+        return new_so
+
+    def merge_at(self, i: int, j: int, stage: Stage) -> SyntacticObject:
+        return self.merge(stage.workspace[i], stage.workspace[j], stage)
+
+    def agreeing_buckets(self, stage: Stage) -> list:
+        """
+        Ordered pairs of Workspace buckets whose signatures agree,
+        with the number of SO pairs each contributes.
+
+        :param stage: ComposerB.Stage
+        :return: list of (int, list, list)
+        """
+        self._index(stage)
+        buckets = stage.buckets
+        found = list()
+        for sig, partners in stage.after.items():
+            b1 = buckets[sig]
+            for other in partners:
+                b2 = buckets[other]
+                # an SO can't Merge with itself
+                weight = len(b1) * (len(b2) - (b1 is b2))
+                if weight:
+                    found.append((weight, b1, b2))
+        return found
+
+    def count_mergables(self, stage: Stage) -> int:
+        """
+        Number of ordered pairs in stage.workspace that agree.
+
+        :param stage: ComposerB.Stage
+        :return: int
+        """
+        return self._index(stage).total
+
+    def sample_mergable(self, stage: Stage):
+        """
+        Uniformly random ordered pair of agreeing SO's in
+        stage.workspace, in time proportional to the number of
+        signatures rather than workspace pairs.
+
+        :param stage: ComposerB.Stage
+        :return: tuple of SO's, or None if no Merge is possible
+        """
+        total = self._index(stage).total
+        if total == 0:
+            return None
+
+        r = randbelow(self.rng, total)
+        # the first SO's bucket, then the second's
+        for sig, row in stage.rows.items():
+            if r < row:
+                break
+            r -= row
+        buckets = stage.buckets
+        b1 = buckets[sig]
+        for other in stage.after[sig]:
+            b2 = buckets[other]
+            weight = len(b1) * (len(b2) - (b1 is b2))
+            if r < weight:
+                break
+            r -= weight
+
+        i = randbelow(self.rng, len(b1))
+        if b1 is b2:
+            j = randbelow(self.rng, len(b2) - 1)
+            j += j >= i
+        else:
+            j = randbelow(self.rng, len(b2))
+        return b1[i], b2[j]
+
+    def get_mergables(self, stage: Stage) -> (bool, list):
         """
         Checks if a merge is possible with items in stage.workspace.
         Returns false if no possible merges exist. Returns a list of
         SO pairs if true.
 
-        :param stage: Composer.Stage
+        :param stage: ComposerB.Stage
         :return: bool, list of tuples
         """
 
-        success = False
         merges_possible = list()
         # order matters
-        for so1, so2 in itertools.permutations(stage.workspace, r=2):
-            if self.agree(so1, so2):
-                # TODO: stop at first pair found?
-                success = True
-                merges_possible.append( (so1, so2) )
+        for weight, b1, b2 in self.agreeing_buckets(stage):
+            for i, so1 in enumerate(b1):
+                for j, so2 in enumerate(b2):
+                    if b1 is not b2 or i != j:
+                        merges_possible.append( (so1, so2) )
 
-        return success, merges_possible
+        return len(merges_possible) > 0, merges_possible
 
-    def derive(self, la, verbose=True):
+    def _derive_steps(self, la, stages, tracer):
         """
         Executes a derivation starting with Lexical Array la.
         Flips a coin to decide whether to Select or to Merge.
         If Merging, merges agreeing SO's if possible, otherwise
         makes no operation. Every SO generated that passes Filter
-        will be spelled out.
+        is yielded (see Composer.iter_derive).
 
-        :param la: collection of Stufe objs
-        :param verbose: bool
-        :return: collection of derivations, bool
+        :return: generator of SO's (or events); returns success
         """
-
-        if len(la) < 2:
-            print("Error: You need more than 2 Stufen to compose")
-            return list()
-
         # set up (select 2)
-        derivations = list()
-        current = Composer.Stage(la=set(la), workspace=set())
+        current = self.Stage(la=la)
         current = self.select_random(current)
         current = self.select_random(current)
         self.stage_i = 2
 
         # derivation
         while len(current.la) > 0 or len(current.workspace) != 1:
-            flip = random.choice([0,1])
+            flip = randbelow(self.rng, 2)
             if flip and len(current.la) > 0:
                 # Select
                 current = self.select_random(current)
             elif not flip and len(current.workspace) != 1:
                 # Merge
-                merge_possible, mergeables = self.get_mergables(current)
-                if merge_possible:
-                    so1, so2 = random.choice(mergeables)
+                pair = self.sample_mergable(current)
+                if pair is not None:
+                    so1, so2 = pair
                     new_so = self.merge(so1, so2, current)
                     # Filter and spell out
                     if self.filter(new_so):
                         # found a valid derivation!
-                        derivations.append(new_so)
+                        if tracer.enabled:
+                            tracer.emit('transfer', i=self.stage_i, so=new_so)
+                        yield ('transfer', new_so) if stages else new_so
                 else:
                     # crash clause
                     if len(current.la) == 0:
                         break
 
             self.stage_i += 1
-            if verbose:
-                print(f"Stage #{self.stage_i}:")
-                current.print()
-                print()
+            if tracer.enabled:
+                tracer.emit('stage', i=self.stage_i, stage=current)
+            if stages:
+                yield 'stage', current.snapshot()
 
         # end of derivation
-        if len(current.workspace) > 1 or not self.filter(list(current.workspace)[0]):  # awk
-            # derivation crashed
-            print("Derivation crashed")
-            return derivations, False
-        else:
-            print("Derivation finished")
-            return derivations, True
+        # crashed unless success
+        success = len(current.workspace) == 1 \
+                  and self.filter(list(current.workspace)[0])  # awk
+        if tracer.enabled:
+            tracer.emit('end', i=self.stage_i, success=success)
+        return success
+
+
+# all stufen hypothesized to be in Bortniansky's Tebe Poem
+TEBE_LEXICON = [(0, True, False), (0, True, False), (-1, True, False),
+                (2, True, False), (1, True, False), (4, True, False),
+                (0, False, False), (6, False, True), (1, True, False),
+                (0, True, False)]
+TEBE = "C C F D G E a F#-dim G C"
+
+
+def tebe_lexical_array() -> list:
+    """
+    :return: list of Stufe in the Tebe poem
+    """
+    return [Stufe(c5=c5, major=is_major, dim=is_dim)
+            for c5, is_major, is_dim in TEBE_LEXICON]
 
 
 def tebe_search(model: ComposerB) -> (int, int, list):
@@ -142,43 +408,37 @@ def tebe_search(model: ComposerB) -> (int, int, list):
     :param model: Composer
     :return: SyntacticObject
     """
-    # all stufen hypothesized to be in Bortniansky's Tebe Poem
-    lexicon = [(0, True, False), (0, True, False), (-1, True, False),
-               (2, True, False), (1, True, False), (4, True, False), (0, False, False),
-               (6, False, True), (1, True, False), (0, True, False)]
-    TEBE = "C C F D G E a F#-dim G C"
-    lexical_array = list()
-
-    for c5, is_major, is_dim in lexicon:
-        lexical_array.append(Stufe(c5=c5, major=is_major, dim=is_dim))
-
-    #all_derivations = list()
-    spelled = list()
-    count = 0
+    lexical_array = tebe_lexical_array()
 
     # check for tebe, derive again if necessary
-    while TEBE not in spelled:
-        count += 1
-        new, success = model.derive(lexical_array, verbose=False)
+    for count, derivation in enumerate(model.attempts(lexical_array), 1):
+        new = list(derivation)
         spelled = [ d.spell_out() for d in new ]
-        #all_derivations.extend(new)
+        if TEBE in spelled:
+            return spelled, count, new
 
-    return spelled, count, new
+
+def parallel_tebe_search(model: ComposerB, workers=None, seed=None):
+    """
+    tebe_search spread over a pool of worker processes. Stops
+    every worker at the first hit.
+
+    :param model: ComposerB
+    :param workers: number of processes, defaults to all cores
+    :param seed: int, master seed
+    :return: search.SearchResult (winning seed, total attempts,
+             spelled surfaces, derivations)
+    """
+    return search.parallel_search(model, tebe_lexical_array(), TEBE,
+                                  workers=workers, seed=seed)
 
 
 def main():
     # tebe testing
-    # all stufen hypothesized to be in Bortniansky's Tebe Poem
-    lexicon = [(0, True, False), (0, True, False), (-1, True, False),
-               (2, True, False), (1, True, False), (4, True, False), (0, False, False),
-               (6, False, True), (1, True, False), (0, True, False)]
-    lexical_array = list()
-
-    for c5, is_major, is_dim in lexicon:
-        lexical_array.append(Stufe(c5=c5, major=is_major, dim=is_dim))
+    lexical_array = tebe_lexical_array()
 
     model = ComposerB()
-    derivations, success = model.derive(lexical_array)
+    derivations, success = model.derive(lexical_array, verbose=True)
 
     print("All Derivations\n===============")
     print(derivations)
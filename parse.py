@@ -0,0 +1,451 @@
+"""
+parse.py
+
+CKY chart parser deciding whether a surface (a sequence of Stufen) is
+derivable by a model, and returning a witness SyntacticObject if so.
+Forest packs every derivable tree for a surface, to count them, sample
+them uniformly or iterate over them lazily in order of cost.
+
+An SO projects the features of its rightmost Stufe (the latter object
+projects), so whether a span of the surface can be built only depends
+on its ends: a span is derivable iff it splits into two derivable
+spans whose Merge Agrees. A surface is derivable iff its whole span
+splits as [L, [M, R]] with Filter passing at the root. Each surface
+takes O(n^3) Agree lookups, memoized across surfaces by Stufe pair.
+
+Files of progressions, one per line as chord names, can be parsed in
+batch from the command line, writing JSON lines:
+
+    python parse.py progressions.txt --model B
+"""
+
+import argparse
+import heapq
+import json
+import sys
+
+from model import Composer, Stufe, SyntacticObject, randbelow
+from modelB import ComposerB
+from transpose import NAMES
+
+
+def surface_stufen(surface, tonic=0) -> list:
+    """
+    Stufen of a surface given as chord names. Names only fix c5 mod
+    12, so each is placed within a fifth of the tonic, from tonic - 5
+    to tonic + 6 (as in the Tebe lexicon, where F is -1 and F# is 6).
+
+    :param surface: str, e.g. "C C F D G E a F#-dim G C"
+    :param tonic: int
+    :return: list of Stufe
+    :raise KeyError: for a token that isn't a chord name
+    """
+    out = list()
+    for name in surface.split():
+        c5, major, dim = NAMES[name]
+        c5 = (c5 - tonic + 5) % 12 - 5 + tonic
+        out.append(Stufe(c5, major, dim))
+    return out
+
+
+class Parser:
+    """
+    Chart parser over one model's Agree and Filter.
+    """
+    def __init__(self, model=None):
+        """
+        default ctor
+        :param model: Composer or ComposerB; ComposerB() if None
+        """
+        self.model = model if model is not None else ComposerB()
+        self._ok = dict()
+        self._accepts = dict()
+
+    def ok(self, left, right, right_is_leaf) -> bool:
+        """
+        Memoized can_merge of spans projecting Stufen left and right.
+        """
+        key = (left, right, right_is_leaf)
+        if key not in self._ok:
+            so2 = right if right_is_leaf else SyntacticObject(right, right)
+            self._ok[key] = self.model.can_merge(left, so2)
+        return self._ok[key]
+
+    def accepts(self, first, middle, last) -> bool:
+        """
+        Memoized Filter on a root [L, [M, R]] where L starts with first,
+        M projects middle and R projects last, or on [L, R] with R the
+        Stufe last if middle is None. Filter reads nothing else.
+        """
+        key = (first, middle, last)
+        if key not in self._accepts:
+            right = last if middle is None else SyntacticObject(middle, last)
+            self._accepts[key] = self.model.filter(SyntacticObject(first, right))
+        return self._accepts[key]
+
+    def chart(self, s) -> list:
+        """
+        split[i][j]: a split point k making span [i, j) derivable,
+        0 if there is none (spans of one Stufe are always derivable).
+
+        :param s: sequence of Stufe
+        :return: list of lists of int
+        """
+        n = len(s)
+        split = [[0] * (n + 1) for _ in range(n + 1)]
+        for length in range(2, n + 1):
+            for i in range(n - length + 1):
+                j = i + length
+                for k in range(i + 1, j):
+                    if (k - i == 1 or split[i][k]) and (j - k == 1 or split[k][j]) \
+                            and self.ok(s[k - 1], s[j - 1], j - k == 1):
+                        split[i][j] = k
+                        break
+        return split
+
+    def parse(self, surface):
+        """
+        A witness SO for surface: every Merge in it Agrees and it
+        passes Filter.
+
+        :param surface: str of chord names or sequence of Stufe
+        :return: SyntacticObject, or None if surface isn't derivable
+        """
+        if isinstance(surface, str):
+            surface = surface_stufen(surface, getattr(self.model, 'tonic', 0))
+        s = list(surface)
+        n = len(s)
+        if n < 2:
+            return None
+
+        split = self.chart(s)
+
+        def spans(i, j):
+            return j - i == 1 or split[i][j]
+
+        # root [L, R] with R a Stufe: L = [0, n - 1)
+        if spans(0, n - 1) and self.ok(s[n - 2], s[n - 1], True) \
+                and self.accepts(s[0], None, s[n - 1]):
+            return SyntacticObject(self.build(s, split, 0, n - 1), s[n - 1])
+
+        # root [L, [M, R]]: L = [0, k), M = [k, m), R = [m, n)
+        for k in range(1, n - 1):
+            if not spans(0, k) or not self.ok(s[k - 1], s[n - 1], False):
+                continue
+            for m in range(k + 1, n):
+                if spans(k, m) and spans(m, n) \
+                        and self.ok(s[m - 1], s[n - 1], n - m == 1) \
+                        and self.accepts(s[0], s[m - 1], s[n - 1]):
+                    right = SyntacticObject(self.build(s, split, k, m),
+                                            self.build(s, split, m, n))
+                    return SyntacticObject(self.build(s, split, 0, k), right)
+        return None
+
+    def build(self, s, split, i, j):
+        """
+        Tree over span [i, j) from the chart, without recursion.
+
+        :return: SyntacticObject or Stufe
+        """
+        built = dict()
+        stack = [(i, j)]
+        while stack:
+            a, b = stack[-1]
+            if b - a == 1:
+                built[(a, b)] = s[a]
+                stack.pop()
+                continue
+            k = split[a][b]
+            if (a, k) in built and (k, b) in built:
+                built[(a, b)] = SyntacticObject(built[(a, k)], built[(k, b)])
+                stack.pop()
+            else:
+                stack.extend(span for span in ((k, b), (a, k))
+                             if span not in built)
+        return built[(i, j)]
+
+    def forest(self, surface):
+        """
+        :param surface: str of chord names or sequence of Stufe
+        :return: Forest of every witness SO for surface
+        """
+        if isinstance(surface, str):
+            surface = surface_stufen(surface, getattr(self.model, 'tonic', 0))
+        return Forest(self, surface)
+
+    def derivable(self, surface) -> bool:
+        return self.parse(surface) is not None
+
+    def parse_many(self, surfaces):
+        """
+        :param surfaces: iterable of str or sequences of Stufe
+        :return: generator of (surface, witness SO or None)
+        """
+        for surface in surfaces:
+            yield surface, self.parse(surface)
+
+
+def left_branching(i, k, j) -> int:
+    """
+    Default Forest cost of Merging spans [i, k) and [k, j): 1 if the
+    left daughter is an SO, so the most right-branching trees come first.
+    """
+    return int(k - i > 1)
+
+
+class Forest:
+    """
+    Shared-packed forest of the trees a model derives for one surface.
+    Nodes are spans [i, j) of the surface plus the root; a node's
+    hyperedges are the ways to Merge it from smaller spans, shared by
+    every tree containing that span. Trees are counted exactly (Python
+    ints) without being built.
+    """
+    ROOT = 'root'
+
+    def __init__(self, parser, surface, cost=left_branching):
+        """
+        default ctor
+        :param parser: Parser
+        :param surface: sequence of Stufe
+        :param cost: callable (i, k, j) -> number, cost of Merging
+                     [i, k) with [k, j), summed over a tree for best()
+        """
+        s = self.surface = list(surface)
+        n = len(s)
+        # node -> list of (cost, tails)
+        self.edges = dict()
+        self.count = dict()
+
+        for i in range(n):
+            self.edges[(i, i + 1)] = [(0, ())]
+            self.count[(i, i + 1)] = 1
+        for length in range(2, n + 1):
+            for i in range(n - length + 1):
+                j = i + length
+                edges = list()
+                total = 0
+                for k in range(i + 1, j):
+                    left, right = self.count.get((i, k)), self.count.get((k, j))
+                    if left and right and parser.ok(s[k - 1], s[j - 1], j - k == 1):
+                        edges.append((cost(i, k, j), ((i, k), (k, j))))
+                        total += left * right
+                if edges:
+                    self.edges[(i, j)] = edges
+                    self.count[(i, j)] = total
+
+        edges = list()
+        total = 0
+        # root [L, R] with R a Stufe: L = [0, n - 1)
+        if n > 1 and (0, n - 1) in self.count \
+                and parser.ok(s[n - 2], s[n - 1], True) \
+                and parser.accepts(s[0], None, s[n - 1]):
+            tails = ((0, n - 1), (n - 1, n))
+            edges.append((cost(0, n - 1, n), tails))
+            total += self.count[tails[0]]
+        # root [L, [M, R]]: L = [0, k), M = [k, m), R = [m, n)
+        for k in range(1, n - 1):
+            if (0, k) not in self.count or not parser.ok(s[k - 1], s[n - 1], False):
+                continue
+            for m in range(k + 1, n):
+                if (k, m) in self.count and (m, n) in self.count \
+                        and parser.ok(s[m - 1], s[n - 1], n - m == 1) \
+                        and parser.accepts(s[0], s[m - 1], s[n - 1]):
+                    tails = ((0, k), (k, m), (m, n))
+                    edges.append((cost(0, k, n) + cost(k, m, n), tails))
+                    total += self.count[tails[0]] * self.count[tails[1]] \
+                        * self.count[tails[2]]
+        self.edges[self.ROOT] = edges
+        self.count[self.ROOT] = total
+
+        # lazy k-best state per node: derivations found so far in
+        # order of cost, candidate heap, candidates ever pushed, and
+        # how many found derivations had their successors pushed
+        self._best = dict()
+        self._candidates = dict()
+        self._seen = dict()
+        self._expanded = dict()
+
+    @property
+    def total(self) -> int:
+        """
+        :return: int, number of distinct trees
+        """
+        return self.count[self.ROOT]
+
+    def _weight(self, tails) -> int:
+        weight = 1
+        for tail in tails:
+            weight *= self.count[tail]
+        return weight
+
+    def _build(self, root, choose):
+        """
+        Builds a tree top-down, without recursion. A key names one
+        occurrence of a node in the tree; equal keys share a subtree.
+
+        :param root: key of the root, (node, ...)
+        :param choose: callable key -> (edge index, keys of its tails)
+        :return: SyntacticObject or Stufe
+        """
+        built = dict()
+        chosen = dict()
+        stack = [root]
+        while stack:
+            key = stack[-1]
+            if key in built:
+                stack.pop()
+                continue
+            if key not in chosen:
+                chosen[key] = choose(key)
+            e, tail_keys = chosen[key]
+            missing = [t for t in tail_keys if t not in built]
+            if missing:
+                stack.extend(reversed(missing))
+                continue
+            stack.pop()
+            tails = [built[t] for t in tail_keys]
+            if not tails:
+                built[key] = self.surface[key[0][0]]
+            elif len(tails) == 2:
+                built[key] = SyntacticObject(*tails)
+            else:
+                l, m, r = tails
+                built[key] = SyntacticObject(l, SyntacticObject(m, r))
+        return built[root]
+
+    def sample(self, rng=None):
+        """
+        Uniformly random tree of the forest.
+
+        :param rng: random.Random, or None for the global random
+                    module (counts can exceed a numpy Generator's range)
+        :return: SyntacticObject, or None if the forest is empty
+        """
+        if not self.total:
+            return None
+
+        def choose(key):
+            node, path = key
+            edges = self.edges[node]
+            e = 0
+            if len(edges) > 1:
+                r = randbelow(rng, self.count[node])
+                for e, (c, tails) in enumerate(edges):
+                    weight = self._weight(tails)
+                    if r < weight:
+                        break
+                    r -= weight
+            # occurrences are told apart by their path from the root
+            return e, [(tail, path + (i,)) for i, tail in enumerate(edges[e][1])]
+
+        return self._build((self.ROOT, ()), choose)
+
+    def _kth(self, node, k) -> bool:
+        """
+        Lazily extends the node's derivations in order of cost
+        (Huang & Chiang, 2005, Algorithm 3) up to the k-th. A
+        derivation is (cost, edge index, rank of each tail's derivation).
+
+        :param node: span or ROOT
+        :param k: int
+        :return: bool, whether the node has a k-th derivation
+        """
+        if node not in self._candidates:
+            heap = list()
+            for e, (c, tails) in enumerate(self.edges.get(node, ())):
+                if all(self._kth(t, 0) for t in tails):
+                    heap.append((c + sum(self._best[t][0][0] for t in tails),
+                                 e, (0,) * len(tails)))
+            heapq.heapify(heap)
+            self._best[node] = list()
+            self._candidates[node] = heap
+            self._seen[node] = {(e, ranks) for c, e, ranks in heap}
+            self._expanded[node] = 0
+
+        best = self._best[node]
+        heap = self._candidates[node]
+        while len(best) <= k:
+            # successors of the last derivation found become candidates
+            if self._expanded[node] < len(best):
+                self._expanded[node] += 1
+                self._successors(node, best[-1])
+            if not heap:
+                return False
+            best.append(heapq.heappop(heap))
+        return True
+
+    def _successors(self, node, derivation):
+        c, e, ranks = derivation
+        edge_cost, tails = self.edges[node][e]
+        for i, tail in enumerate(tails):
+            next_ranks = ranks[:i] + (ranks[i] + 1,) + ranks[i + 1:]
+            if (e, next_ranks) in self._seen[node] \
+                    or not self._kth(tail, next_ranks[i]):
+                continue
+            self._seen[node].add((e, next_ranks))
+            cost = edge_cost + sum(self._best[t][r][0]
+                                   for t, r in zip(tails, next_ranks))
+            heapq.heappush(self._candidates[node], (cost, e, next_ranks))
+
+    def best(self):
+        """
+        Lazily iterates over the trees in order of increasing cost;
+        the k-th tree costs O(k log k) work beyond the first.
+
+        :return: generator of (cost, SyntacticObject)
+        """
+        def choose(key):
+            node, rank = key
+            c, e, ranks = self._best[node][rank]
+            return e, list(zip(self.edges[node][e][1], ranks))
+
+        k = 0
+        while self._kth(self.ROOT, k):
+            # ranked subtrees are shared, so a key is (node, rank)
+            yield self._best[self.ROOT][k][0], self._build((self.ROOT, k), choose)
+            k += 1
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(
+        description="Decide which progressions a model can derive.")
+    ap.add_argument("files", nargs="*", help="one progression per line "
+                    "(default: stdin)")
+    ap.add_argument("--model", choices=("A", "B"), default="B")
+    ap.add_argument("--tonic", type=int, default=0)
+    args = ap.parse_args(argv)
+
+    if args.model == "A":
+        model = Composer(tonic=args.tonic)
+    else:
+        model = ComposerB(tonic=args.tonic)
+    parser = Parser(model)
+
+    def lines():
+        for path in args.files or ["-"]:
+            f = sys.stdin if path == "-" else open(path)
+            with f:
+                for line in f:
+                    if line.strip():
+                        yield line.strip()
+
+    found = 0
+    for surface in lines():
+        try:
+            witness = parser.parse(surface)
+        except KeyError as e:
+            # a bad line shouldn't abort the rest of the batch
+            print(f"skipping {surface!r}: unknown chord name {e.args[0]!r}",
+                  file=sys.stderr)
+            continue
+        found += witness is not None
+        print(json.dumps({"surface": surface,
+                          "derivable": witness is not None,
+                          "witness": None if witness is None else str(witness)}))
+    print(f"{found} derivable", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,301 @@
+"""
+runner.py
+
+Command-line runner for long searches, streaming results as JSON lines
+and checkpointing so a run killed partway resumes where it stopped.
+
+Attempts are drawn as in server.py: every attempt runs under its own
+seed from one master stream, in units of `chunk` attempts spread over a
+pool of workers, and units are consumed in order. A checkpoint holds the
+master stream's state after the last unit consumed, the accumulated
+statistics (crashes, hits, surface histogram) and how much output was
+written, so a resumed run draws the same seeds, reaches the same hits
+and writes the same lines as one that was never interrupted. A run
+stops at the first budget it exhausts: hits, attempts (over all resumed
+runs) or wall-clock time (of this run).
+
+Lines written, one JSON object each:
+    {"event": "start", ...}     the run's model, seed and where it resumes
+    {"event": "hit", ...}       attempt number, seed and spelled surfaces
+    {"event": "progress", ...}  MonteCarlo report, at every checkpoint
+    {"event": "end", ...}       why it stopped, and the final report
+
+    python runner.py --model A --workers 8 --time 3600 \\
+        --checkpoint tebe.ckpt --out tebe.jsonl
+    python runner.py --checkpoint tebe.ckpt --out tebe.jsonl --resume
+"""
+
+import argparse
+import collections
+import json
+import os
+import pickle
+import random
+import signal
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import server
+from stats import MonteCarlo
+
+
+def _init_worker():
+    # the runner handles Ctrl-C and checkpoints; workers just stop
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    server.warm()
+
+
+def _unit(kind, tonic, la, seeds, target):
+    """
+    Runs one unit of attempts.
+
+    :return: crashes, hits as (index in unit, seed, spelled), surface
+             counts (once per attempt, as MonteCarlo.update counts)
+    """
+    crashes = 0
+    hits = list()
+    counts = collections.Counter()
+    for i, seed in enumerate(seeds):
+        success, spelled = server.attempt(kind, tonic, la, seed)
+        crashes += not success
+        counts.update(set(spelled))
+        if (target in spelled) if target is not None else spelled:
+            hits.append((i, seed, spelled))
+    return crashes, hits, dict(counts)
+
+
+class Run:
+    """
+    State of a run that survives being killed: the job, the master
+    seed stream and everything accumulated so far.
+    """
+    def __init__(self, spec, cap=10000):
+        """
+        default ctor
+        :param spec: dict, from server.job_spec
+        :param cap: histogram memory cap, see SurfaceHistogram
+        """
+        self.spec = spec
+        self.stream = random.Random(spec["seed"])
+        self.stats = MonteCarlo(None, None, target=spec["target"], cap=cap)
+        # seconds over all resumed runs
+        self.elapsed = 0.0
+        # bytes of output written up to the last checkpoint
+        self.offset = 0
+
+    def units(self, chunk, max_attempts=None):
+        """
+        Draws units of seeds from the master stream.
+
+        :param chunk: int, attempts per unit
+        :param max_attempts: int, total over resumed runs
+        :return: generator of (args of _unit, stream state after it)
+        """
+        drawn = self.stats.attempts
+        spec = self.spec
+        while max_attempts is None or drawn < max_attempts:
+            size = chunk if max_attempts is None else min(chunk, max_attempts - drawn)
+            drawn += size
+            seeds = [self.stream.getrandbits(64) for _ in range(size)]
+            yield ((spec["model"], spec["tonic"], spec["la"], seeds, spec["target"]),
+                   self.stream.getstate())
+
+    def update(self, size, crashes, hits, counts):
+        stats = self.stats
+        stats.attempts += size
+        stats.crashes += crashes
+        stats.hits += len(hits)
+        for surface, n in counts.items():
+            stats.histogram.add(surface, n)
+
+    def save(self, path, state):
+        """
+        Atomically writes a checkpoint.
+
+        :param path: str
+        :param state: master stream state after the last unit consumed
+        """
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as f:
+            pickle.dump({"spec": self.spec, "state": state,
+                         "stats": self.stats, "elapsed": self.elapsed,
+                         "offset": self.offset},
+                        f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "rb") as f:
+            saved = pickle.load(f)
+        run = cls(saved["spec"])
+        run.stream.setstate(saved["state"])
+        run.stats = saved["stats"]
+        run.elapsed = saved["elapsed"]
+        run.offset = saved["offset"]
+        return run
+
+
+def _report(stats) -> dict:
+    report = stats.report()
+    del report["surfaces"]
+    report["top"] = [(s["surface"], s["count"]) for s in stats.report(5)["surfaces"]]
+    return report
+
+
+def run(args, out):
+    """
+    Runs (or resumes) a search as configured by the command line.
+
+    :param args: argparse.Namespace, see main
+    :param out: text file JSON lines are written to, args.out opened
+                for reading and writing if given
+    :return: str, why the run stopped
+    """
+    if args.resume and args.checkpoint and os.path.exists(args.checkpoint):
+        current = Run.load(args.checkpoint)
+        resumed = True
+        if args.out:
+            # drop lines written after the checkpoint; they'll be redone
+            out.seek(current.offset)
+            out.truncate()
+    else:
+        body = {"model": args.model, "tonic": args.tonic, "seed": args.seed}
+        if args.lexicon:
+            with open(args.lexicon) as f:
+                text = f.read().split()
+            if args.model == "dissertation":
+                try:
+                    body["la"] = [int(cf) for cf in text]
+                except ValueError:
+                    raise ValueError(f"{args.lexicon}: cf values must be "
+                                     f"integers") from None
+            else:
+                body["la"] = ' '.join(text)
+        if args.any:
+            body["target"] = None
+        elif args.target is not None:
+            body["target"] = args.target
+        current = Run(server.job_spec(body), cap=args.cap)
+        resumed = False
+        if args.out:
+            out.seek(0)
+            out.truncate()
+
+    def emit(line):
+        out.write(json.dumps(line) + "\n")
+
+    spec = current.spec
+    stats = current.stats
+    emit({"event": "start", "model": spec["model"], "tonic": spec["tonic"],
+          "seed": spec["seed"], "target": spec["target"], "resumed": resumed,
+          "attempts": stats.attempts})
+
+    start = time.monotonic()
+    elapsed = current.elapsed
+    last_checkpoint = start
+    state = current.stream.getstate()
+    units = current.units(args.chunk, args.max_attempts)
+    pending = collections.deque()
+    reason = "attempts"
+
+    def checkpoint():
+        current.elapsed = elapsed + time.monotonic() - start
+        out.flush()
+        if args.out:
+            current.offset = out.tell()
+        if args.checkpoint:
+            current.save(args.checkpoint, state)
+
+    try:
+        with ProcessPoolExecutor(args.workers, initializer=_init_worker) as pool:
+            try:
+                while True:
+                    # keep two units per worker in flight
+                    for unit, after in units:
+                        pending.append((pool.submit(_unit, *unit), len(unit[3]), after))
+                        if len(pending) >= 2 * args.workers:
+                            break
+                    if not pending:
+                        break
+                    future, size, after = pending.popleft()
+                    crashes, hits, counts = future.result()
+                    for i, seed, spelled in hits:
+                        emit({"event": "hit", "attempt": stats.attempts + i + 1,
+                              "seed": seed, "spelled": spelled})
+                    current.update(size, crashes, hits, counts)
+                    state = after
+
+                    now = time.monotonic()
+                    if args.hits and stats.hits >= args.hits:
+                        reason = "hits"
+                        break
+                    if args.time is not None and now - start >= args.time:
+                        reason = "time"
+                        break
+                    if now - last_checkpoint >= args.every:
+                        last_checkpoint = now
+                        emit(dict(event="progress", **_report(stats)))
+                        checkpoint()
+            finally:
+                for future, size, after in pending:
+                    future.cancel()
+    except KeyboardInterrupt:
+        reason = "interrupted"
+
+    checkpoint()
+    emit(dict(event="end", reason=reason, elapsed=current.elapsed,
+              **_report(stats)))
+    out.flush()
+    return reason
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(
+        description="Search for a surface with a time and attempt budget, "
+                    "checkpointing so the run can be resumed.")
+    ap.add_argument("--model", choices=server.MODELS, default="B")
+    ap.add_argument("--lexicon", help="file of chord names (cf values for "
+                    "the dissertation model); default: the Tebe poem")
+    ap.add_argument("--tonic", type=int, default=0)
+    ap.add_argument("--target", help="surface to search for; default: "
+                    "the Tebe poem")
+    ap.add_argument("--any", action="store_true",
+                    help="count any spelled out surface as a hit")
+    ap.add_argument("--seed", type=int, help="master seed; random if omitted")
+    ap.add_argument("--workers", type=server.positive_int,
+                    default=os.cpu_count() or 1)
+    ap.add_argument("--chunk", type=server.positive_int, default=100,
+                    help="attempts per unit")
+    ap.add_argument("--hits", type=int, default=1,
+                    help="stop after this many hits (0: never)")
+    ap.add_argument("--max-attempts", type=int,
+                    help="attempt budget, over all resumed runs")
+    ap.add_argument("--time", type=float, help="seconds budget for this run")
+    ap.add_argument("--checkpoint", help="checkpoint file")
+    ap.add_argument("--every", type=float, default=60.0,
+                    help="seconds between checkpoints")
+    ap.add_argument("--resume", action="store_true",
+                    help="resume from --checkpoint if it exists, with "
+                    "its model, lexicon, target and seed")
+    ap.add_argument("--cap", type=int, default=10000,
+                    help="distinct surfaces counted exactly")
+    ap.add_argument("--out", help="JSONL output file (default: stdout)")
+    args = ap.parse_args(argv)
+
+    # a kill with SIGTERM checkpoints like Ctrl-C
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    try:
+        if args.out:
+            mode = "r+" if args.resume and os.path.exists(args.out) else "w"
+            with open(args.out, mode) as out:
+                reason = run(args, out)
+        else:
+            reason = run(args, sys.stdout)
+    except (OSError, ValueError) as e:
+        ap.error(str(e))
+    return 0 if reason != "interrupted" else 130
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,137 @@
+"""
+search.py
+
+Parallel search for a target surface (e.g. Bortniansky's Tebe poem)
+with any of the composer models. Derivations are spread over a pool of
+worker processes, each drawing from its own seeded RNG stream, and the
+whole pool stops as soon as one worker finds the target.
+
+Every attempt is run under its own seed, so a hit can be reproduced
+exactly with replay().
+"""
+
+import multiprocessing
+import os
+import random
+from collections import namedtuple
+
+# seed: seed of the winning attempt, attempts: summed over all workers
+SearchResult = namedtuple("SearchResult",
+                          ["seed", "attempts", "spelled", "derivations"])
+
+# derivation: the hit, weight: its likelihood ratio to derive(),
+# estimate: mean weight over attempts, i.e. estimated P(target)
+TargetResult = namedtuple("TargetResult",
+                          ["attempts", "derivation", "weight", "estimate"])
+
+# set in each worker process by _init_worker
+_stop = None
+
+
+def _init_worker(stop):
+    global _stop
+    _stop = stop
+
+
+def _search_worker(model, la, target, seed):
+    """
+    Derives from la until target is spelled out or another worker
+    signals a hit.
+
+    :param model: Composer
+    :param la: collection of Stufe objs
+    :param target: str
+    :param seed: int, seeds this worker's attempt stream
+    :return: int, (int, list, list) or None
+    """
+    stream = random.Random(seed)
+    attempts = 0
+    while not _stop.is_set():
+        attempt_seed = stream.getrandbits(64)
+        model.seed(attempt_seed)
+        attempts += 1
+        derivations, success = model.derive(la, verbose=False)
+        spelled = [d.spell_out() for d in derivations]
+        if target in spelled:
+            _stop.set()
+            return attempts, (attempt_seed, spelled, derivations)
+    return attempts, None
+
+
+def worker_seeds(seed, workers) -> list:
+    """
+    Independent seeds for each worker's RNG stream.
+
+    :param seed: int
+    :param workers: int
+    :return: list of int
+    """
+    master = random.Random(seed)
+    return [master.getrandbits(64) for _ in range(workers)]
+
+
+def parallel_search(model, la, target, workers=None, seed=None) -> SearchResult:
+    """
+    Continuously generates surfaces on a pool of worker processes
+    until target is found.
+
+    :param model: Composer (any picklable model with derive())
+    :param la: collection of Stufe objs
+    :param target: str, spelled out surface to look for
+    :param workers: number of processes, defaults to all cores
+    :param seed: int, master seed; random if None
+    :return: SearchResult
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if seed is None:
+        seed = random.getrandbits(64)
+
+    ctx = multiprocessing.get_context()
+    stop = ctx.Event()
+    with ctx.Pool(workers, initializer=_init_worker,
+                  initargs=(stop,)) as pool:
+        pending = [pool.apply_async(_search_worker,
+                                    (model, la, target, worker_seed))
+                   for worker_seed in worker_seeds(seed, workers)]
+        outcomes = [p.get() for p in pending]
+
+    attempts = sum(n for n, hit in outcomes)
+    # several workers can hit on the same round; keep the first
+    hit = next(hit for n, hit in outcomes if hit is not None)
+    attempt_seed, spelled, derivations = hit
+    return SearchResult(attempt_seed, attempts, spelled, derivations)
+
+
+def replay(model, la, seed):
+    """
+    Reruns the single derivation of a search attempt.
+
+    :param model: Composer
+    :param la: collection of Stufe objs, as passed to the search
+    :param seed: int, SearchResult.seed
+    :return: collection of derivations, bool
+    """
+    model.seed(seed)
+    return model.derive(la, verbose=False)
+
+
+def target_search(model, la, target, guided=True) -> TargetResult:
+    """
+    Continuously runs target-directed derivations (Composer.derive_target)
+    until target is found.
+
+    :param model: Composer
+    :param la: collection of Stufe objs
+    :param target: str, spelled out surface covering all of la
+    :param guided: bool, see Composer.derive_target
+    :return: TargetResult
+    """
+    attempts = 0
+    total_weight = 0.0
+    while True:
+        attempts += 1
+        so, weight = model.derive_target(la, target, guided=guided)
+        total_weight += weight
+        if so is not None:
+            return TargetResult(attempts, so, weight, total_weight / attempts)
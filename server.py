@@ -0,0 +1,697 @@
+"""
+server.py
+
+Local derivation service, so notebooks and scripts share one warm pool
+of worker processes instead of each starting cold derivation loops.
+An asyncio front end speaks plain HTTP/1.1 on localhost or on a Unix
+socket; jobs run on a process pool whose workers keep their models
+(and the dissertation model's precomputed lexicons) between requests.
+
+Jobs, posted as JSON, for models "A" (Composer), "B" (ComposerB) and
+"dissertation" (one generate_batch walk set per attempt):
+
+    POST /derive  {"model", "la", "tonic", "n", "seed"}
+        one line per derivation: its seed, success and surfaces
+    POST /search  {"model", "la", "tonic", "target", "seed", "max_attempts"}
+        progress lines, then the first attempt spelling out target
+    POST /stats   {"model", "la", "tonic", "target", "n", "seed", "every"}
+        a MonteCarlo report every `every` attempts
+    DELETE /jobs/<id>
+        cancels a running job
+    GET /health
+
+A Lexical Array is given as chord names ("C G C") placed around the
+tonic as parse.surface_stufen does, or for the dissertation model as a
+list of cf values; it defaults to the Tebe poem (the whole lexicon for
+the dissertation model). Every attempt is run under its own seed drawn
+from the job's seed, so any derivation can be replayed exactly with
+search.replay().
+
+Results are streamed back as JSON lines (chunked), the first naming
+the job. Jobs are cut into units of at most `chunk` attempts; small
+units from concurrent requests are batched into one worker call, and a
+job is cancelled between units, by DELETE or by closing the connection.
+
+    python server.py --port 8765
+    curl -N -d '{"model": "A", "n": 3, "seed": 1}' localhost:8765/derive
+"""
+
+import argparse
+import asyncio
+import collections
+import contextlib
+import itertools
+import json
+import os
+import random
+import signal
+from concurrent.futures import ProcessPoolExecutor
+
+import corpus
+import model
+import modelB
+from model import Composer, Stufe
+from modelB import ComposerB
+from parse import surface_stufen
+from stats import MonteCarlo
+from tebe import dissertation
+from transpose import transpose
+
+MODELS = ("A", "B", "dissertation")
+# generate_batch per dissertation attempt
+DISSERTATION_WALKS = 64
+DISSERTATION_STEPS = 1000
+
+# model kind and tonic -> model, per worker process
+_models = dict()
+
+
+def _model(kind, tonic):
+    key = (kind, tonic)
+    if key not in _models:
+        if kind == "A":
+            _models[key] = Composer(tonic=tonic)
+        elif kind == "B":
+            _models[key] = ComposerB(tonic=tonic)
+        else:
+            _models[key] = dissertation.Model()
+    return _models[key]
+
+
+def _lexical_array(kind, la):
+    """
+    :param la: tuple of Stufe features, or of cf values (None for the
+               whole lexicon) for the dissertation model
+    :return: Lexical Array of the model's Stufe objs
+    """
+    if kind == "dissertation":
+        return None if la is None else [dissertation.Stufe(cf, cf) for cf in la]
+    return [Stufe(c5, major, dim) for c5, major, dim in la]
+
+
+def attempt(kind, tonic, la, seed):
+    """
+    One derivation under a seed.
+
+    :param kind: "A", "B" or "dissertation"
+    :param tonic: int
+    :param la: Lexical Array as plain features, see job_spec
+    :param seed: int
+    :return: bool success, list of spelled out surfaces
+    """
+    composer = _model(kind, tonic)
+    la = _lexical_array(kind, la)
+    if kind == "dissertation":
+        completed = composer.generate_batch(
+            n=1, walks=DISSERTATION_WALKS, max_steps=DISSERTATION_STEPS,
+            lexicon=la, seed=seed)
+        return (len(completed) > 0,
+                [' '.join(corpus.names(corpus.encode(so))) for so in completed])
+    composer.seed(seed)
+    derivations, success = composer.derive(la, verbose=False)
+    return success, [d.spell_out() for d in derivations]
+
+
+def _derive_unit(kind, tonic, la, seeds):
+    return [(seed,) + attempt(kind, tonic, la, seed) for seed in seeds]
+
+
+def _search_unit(kind, tonic, la, seeds, target):
+    """
+    :return: attempts made, (seed, spelled) of the first hit or None
+    """
+    for attempts, seed in enumerate(seeds, 1):
+        success, spelled = attempt(kind, tonic, la, seed)
+        if (target in spelled) if target is not None else spelled:
+            return attempts, (seed, spelled)
+    return len(seeds), None
+
+
+def _stats_unit(kind, tonic, la, seeds, target):
+    """
+    :return: attempts, crashes, hits and surface counts, counted as
+             MonteCarlo.update does
+    """
+    crashes = hits = 0
+    counts = collections.Counter()
+    for seed in seeds:
+        success, spelled = attempt(kind, tonic, la, seed)
+        crashes += not success
+        spelled = set(spelled)
+        counts.update(spelled)
+        if target is None:
+            hits += len(spelled) > 0
+        else:
+            hits += target in spelled
+    return len(seeds), crashes, hits, dict(counts)
+
+
+_UNITS = {"derive": _derive_unit, "search": _search_unit, "stats": _stats_unit}
+
+
+def _run(units) -> list:
+    """
+    Runs a batch of units in one worker call.
+
+    :param units: list of (op, args)
+    :return: list of results, one per unit
+    """
+    return [_UNITS[op](*args) for op, args in units]
+
+
+def warm():
+    """
+    Pool initializer: builds every model and precomputes the
+    dissertation lexicon, so a worker's first attempt isn't cold.
+    """
+    for kind in MODELS:
+        _model(kind, 0)
+    composer = _model("dissertation", 0)
+    composer.transitions(composer.lexicon())
+
+
+def attempt_seeds(seed):
+    """
+    Endless stream of attempt seeds, as search workers draw them.
+
+    :param seed: int
+    :return: generator of int
+    """
+    stream = random.Random(seed)
+    while True:
+        yield stream.getrandbits(64)
+
+
+def _integer(body, name, default, minimum=None):
+    """
+    An integer field of a job request.
+
+    :param body: dict, decoded JSON request
+    :param name: str, field
+    :param default: value if the field is missing
+    :param minimum: int, smallest value allowed, if any
+    :return: int, or default if the field is missing
+    :raise ValueError: if the value isn't an integer or is below minimum
+    """
+    value = body.get(name)
+    if value is None:
+        return default
+    # JSON true/false would otherwise pass as 1/0
+    if isinstance(value, bool) or not isinstance(value, (int, str)):
+        raise ValueError(f"{name} must be an integer")
+    try:
+        value = int(value)
+    except ValueError:
+        raise ValueError(f"{name} must be an integer") from None
+    if minimum is not None and value < minimum:
+        raise ValueError(f"{name} must be at least {minimum}")
+    return value
+
+
+def positive_int(text) -> int:
+    """
+    argparse type for counts that must be at least 1.
+
+    :param text: str
+    :return: int
+    """
+    try:
+        value = int(text)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid int value: {text!r}") from None
+    if value < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, not {value}")
+    return value
+
+
+def job_spec(body) -> dict:
+    """
+    Validates a job request.
+
+    :param body: dict, decoded JSON request
+    :return: dict with model, tonic, la (as plain features), target, seed
+    :raise ValueError: if the request can't be run
+    """
+    if not isinstance(body, dict):
+        raise ValueError("request must be a JSON object")
+    kind = body.get("model", "B")
+    if kind not in MODELS:
+        raise ValueError(f"model must be one of {', '.join(MODELS)}")
+    tonic = _integer(body, "tonic", 0)
+    la = body.get("la")
+    target = body.get("target")
+    if target is not None and not isinstance(target, str):
+        raise ValueError("target must be a string of chord names")
+    if kind == "dissertation":
+        if la is not None:
+            if not isinstance(la, list) or not all(
+                    isinstance(cf, int) and not isinstance(cf, bool) for cf in la):
+                raise ValueError("la must be a list of integer cf values")
+            la = tuple(la)
+    else:
+        tebe = model.TEBE if kind == "A" else modelB.TEBE
+        if la is None:
+            la = transpose(tebe, tonic)
+        if "target" not in body:
+            target = transpose(tebe, tonic)
+        if isinstance(la, list) and all(isinstance(name, str) for name in la):
+            la = ' '.join(la)
+        if not isinstance(la, str):
+            raise ValueError("la must be a string or list of chord names")
+        try:
+            stufen = surface_stufen(la, tonic)
+        except KeyError as e:
+            raise ValueError(f"unknown Stufe name {e}") from None
+        if len(stufen) < 2:
+            raise ValueError("You need more than 2 Stufen to compose")
+        la = tuple((s.c5, s.is_major, s.is_dim) for s in stufen)
+    seed = _integer(body, "seed", None)
+    if seed is None:
+        seed = random.getrandbits(64)
+    return {"model": kind, "tonic": tonic, "la": la, "target": target,
+            "seed": seed}
+
+
+class Server:
+    """
+    asyncio front end over a warm process pool.
+    """
+    def __init__(self, workers=None, chunk=100, window=0.005, max_batch=256):
+        """
+        default ctor
+        :param workers: number of worker processes, defaults to all cores
+        :param chunk: max attempts per unit of a job
+        :param window: seconds a batch waits for more small units
+        :param max_batch: attempts per batch before it's sent regardless
+        """
+        if chunk < 1:
+            raise ValueError(f"chunk must be at least 1, not {chunk}")
+        self.workers = workers or os.cpu_count() or 1
+        self.chunk = chunk
+        self.window = window
+        self.max_batch = max_batch
+        self.pool = None
+        self.server = None
+        self.address = None
+        # job id -> task streaming it
+        self.jobs = dict()
+        self._ids = itertools.count(1)
+        self._queue = None
+        self._slots = None
+        self._tasks = set()
+        self._handlers = set()
+        # worker calls made and units run, i.e. how well batching does
+        self.batches = 0
+        self.units = 0
+
+    async def start(self, host="127.0.0.1", port=0, path=None):
+        """
+        Starts the pool and listens on host:port, or on a Unix socket
+        at path if given. Returns once every worker is warm.
+
+        :return: address listened on, (host, port) or path
+        """
+        loop = asyncio.get_running_loop()
+        self.pool = ProcessPoolExecutor(self.workers, initializer=warm)
+        await asyncio.gather(*(loop.run_in_executor(self.pool, _run, [])
+                               for _ in range(self.workers)))
+        self._queue = asyncio.Queue()
+        # batches in flight; while all are busy, units queue up and
+        # go out together
+        self._slots = asyncio.Semaphore(self.workers)
+        self._spawn(self._batcher())
+
+        if path is not None:
+            self.server = await asyncio.start_unix_server(self._handle, path)
+            self.address = path
+        else:
+            self.server = await asyncio.start_server(self._handle, host, port)
+            self.address = self.server.sockets[0].getsockname()[:2]
+        return self.address
+
+    async def close(self):
+        if self.server is not None:
+            self.server.close()
+        # cancelled jobs still end their responses
+        for task in self.jobs.values():
+            task.cancel()
+        await asyncio.gather(*self._handlers, return_exceptions=True)
+        if self.server is not None:
+            await self.server.wait_closed()
+        for task in self._tasks:
+            task.cancel()
+        if self.pool is not None:
+            self.pool.shutdown(cancel_futures=True)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    def _spawn(self, coro):
+        task = asyncio.ensure_future(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    async def submit(self, op, *args):
+        """
+        Queues one unit for the next batch.
+
+        :param op: "derive", "search" or "stats"
+        :return: the unit's result
+        """
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait(((op, args), future))
+        return await future
+
+    async def _batcher(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await self._slots.acquire()
+            batch = [await self._queue.get()]
+            # seeds are the last argument of every unit
+            size = len(batch[0][0][1][3])
+            deadline = loop.time() + self.window
+            while size < self.max_batch:
+                try:
+                    item = self._queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        item = await asyncio.wait_for(self._queue.get(), timeout)
+                    except asyncio.TimeoutError:
+                        break
+                batch.append(item)
+                size += len(item[0][1][3])
+            # units whose job was cancelled while queued
+            batch = [(unit, future) for unit, future in batch
+                     if not future.cancelled()]
+            if batch:
+                self._spawn(self._dispatch(batch))
+            else:
+                self._slots.release()
+
+    async def _dispatch(self, batch):
+        loop = asyncio.get_running_loop()
+        self.batches += 1
+        self.units += len(batch)
+        try:
+            results = await loop.run_in_executor(
+                self.pool, _run, [unit for unit, future in batch])
+        except Exception as e:
+            for unit, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+        else:
+            for (unit, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+        finally:
+            self._slots.release()
+
+    async def _ordered(self, units):
+        """
+        Runs units with up to two per worker in flight, yielding
+        their results in order. Closing the generator cancels the
+        units still pending.
+
+        :param units: iterable of (op, args)
+        :return: async generator of results
+        """
+        pending = collections.deque()
+        try:
+            for op, args in units:
+                pending.append(asyncio.ensure_future(self.submit(op, *args)))
+                if len(pending) >= 2 * self.workers:
+                    yield await pending.popleft()
+            while pending:
+                yield await pending.popleft()
+        finally:
+            for task in pending:
+                task.cancel()
+
+    def _units(self, op, spec, n, chunk, *extra):
+        stream = attempt_seeds(spec["seed"])
+        while n is None or n > 0:
+            size = chunk if n is None else min(chunk, n)
+            if n is not None:
+                n -= size
+            yield op, (spec["model"], spec["tonic"], spec["la"],
+                       list(itertools.islice(stream, size))) + extra
+
+    async def derive(self, spec, n=1):
+        """
+        :param spec: dict, from job_spec
+        :param n: int, derivations
+        :return: async generator of dict, one per derivation
+        """
+        units = self._ordered(self._units("derive", spec, n, self.chunk))
+        async with contextlib.aclosing(units):
+            async for results in units:
+                for seed, success, spelled in results:
+                    yield {"seed": seed, "success": success, "spelled": spelled}
+
+    async def search(self, spec, max_attempts=None):
+        """
+        Runs attempts until one spells out the target (or, without a
+        target, any surface). Attempts run in parallel but the hit
+        reported is the first in seed order, so a search is
+        reproducible from its seed.
+
+        :param spec: dict, from job_spec
+        :param max_attempts: int, give up after this many
+        :return: async generator of dict, progress then the outcome
+        """
+        units = self._ordered(self._units("search", spec, max_attempts,
+                                          self.chunk, spec["target"]))
+        attempts = 0
+        async with contextlib.aclosing(units):
+            async for made, hit in units:
+                attempts += made
+                if hit is not None:
+                    seed, spelled = hit
+                    yield {"found": True, "attempts": attempts,
+                           "seed": seed, "spelled": spelled}
+                    return
+                yield {"attempts": attempts}
+        yield {"found": False, "attempts": attempts}
+
+    async def stats(self, spec, n=10000, every=1000):
+        """
+        :param spec: dict, from job_spec
+        :param n: int, derivations
+        :param every: int, attempts between reports
+        :return: async generator of MonteCarlo reports
+        """
+        run = MonteCarlo(None, None, target=spec["target"])
+        units = self._ordered(self._units("stats", spec, n, min(every, self.chunk),
+                                          spec["target"]))
+        reported = 0
+        async with contextlib.aclosing(units):
+            async for attempts, crashes, hits, counts in units:
+                run.attempts += attempts
+                run.crashes += crashes
+                run.hits += hits
+                for surface, count in counts.items():
+                    run.histogram.add(surface, count)
+                if run.attempts - reported >= every or run.attempts == n:
+                    reported = run.attempts
+                    yield run.report()
+
+    def job(self, path, body):
+        """
+        :param path: str, "/derive", "/search" or "/stats"
+        :param body: dict, decoded JSON request
+        :return: dict from job_spec, async generator of dict
+        :raise ValueError: if the request can't be run
+        :raise LookupError: if there's no such job type
+        """
+        if path not in ("/derive", "/search", "/stats"):
+            raise LookupError(path)
+        spec = job_spec(body)
+        if path == "/derive":
+            return spec, self.derive(spec, n=_integer(body, "n", 1, minimum=0))
+        if path == "/search":
+            return spec, self.search(spec, _integer(body, "max_attempts",
+                                                    None, minimum=0))
+        # a unit of 0 attempts would never finish
+        return spec, self.stats(spec, n=_integer(body, "n", 10000, minimum=0),
+                                every=_integer(body, "every", 1000, minimum=1))
+
+    def health(self) -> dict:
+        return {"ok": True, "workers": self.workers, "jobs": sorted(self.jobs),
+                "batches": self.batches, "units": self.units}
+
+    async def _handle(self, reader, writer):
+        self._handlers.add(asyncio.current_task())
+        try:
+            try:
+                method, path, body = await _read_request(reader)
+            except (ValueError, asyncio.IncompleteReadError):
+                return await _respond(writer, 400, {"error": "bad request"})
+
+            if method == "GET" and path == "/health":
+                return await _respond(writer, 200, self.health())
+            if method == "DELETE" and path.startswith("/jobs/"):
+                task = self.jobs.get(path[len("/jobs/"):])
+                if task is not None:
+                    task.cancel()
+                return await _respond(writer, 200 if task else 404,
+                                      {"cancelled": task is not None})
+            if method != "POST":
+                return await _respond(writer, 404, {"error": "not found"})
+            try:
+                spec, lines = self.job(path, json.loads(body or b"{}"))
+            except LookupError:
+                return await _respond(writer, 404, {"error": "not found"})
+            except ValueError as e:
+                return await _respond(writer, 400, {"error": str(e)})
+            await self._stream(reader, writer, spec, lines)
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+            self._handlers.discard(asyncio.current_task())
+
+    async def _stream(self, reader, writer, spec, lines):
+        job = str(next(self._ids))
+        task = asyncio.ensure_future(self._write_lines(job, spec, writer, lines))
+        self.jobs[job] = task
+        # the client sends nothing more, so a read returning means
+        # it hung up
+        gone = asyncio.ensure_future(reader.read())
+        try:
+            await asyncio.wait((task, gone), return_when=asyncio.FIRST_COMPLETED)
+            if not task.done():
+                task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+        finally:
+            gone.cancel()
+            del self.jobs[job]
+
+    async def _write_lines(self, job, spec, writer, lines):
+        writer.write(b"HTTP/1.1 200 OK\r\n"
+                     b"Content-Type: application/x-ndjson\r\n"
+                     b"Transfer-Encoding: chunked\r\n"
+                     b"X-Job: " + job.encode() + b"\r\n"
+                     b"Connection: close\r\n\r\n")
+        # the job's seed, drawn at random if the request had none
+        _write_chunk(writer, {"job": job, "seed": spec["seed"]})
+        try:
+            async with contextlib.aclosing(lines):
+                async for line in lines:
+                    _write_chunk(writer, line)
+                    await writer.drain()
+        except asyncio.CancelledError:
+            _write_chunk(writer, {"cancelled": True})
+        except Exception as e:
+            _write_chunk(writer, {"error": repr(e)})
+        writer.write(b"0\r\n\r\n")
+        await writer.drain()
+
+
+async def _read_request(reader):
+    """
+    :return: method, path, body bytes
+    :raise ValueError: if it isn't an HTTP request
+    """
+    method, path, version = (await reader.readline()).decode("latin-1").split()
+    length = 0
+    while True:
+        line = (await reader.readline()).decode("latin-1").strip()
+        if not line:
+            break
+        name, _, value = line.partition(":")
+        if name.strip().lower() == "content-length":
+            length = int(value)
+    body = await reader.readexactly(length) if length else b""
+    return method, path.split("?")[0], body
+
+
+def _write_chunk(writer, line):
+    data = json.dumps(line).encode() + b"\n"
+    writer.write(b"%x\r\n" % len(data) + data + b"\r\n")
+
+
+async def _respond(writer, status, payload):
+    data = json.dumps(payload).encode() + b"\n"
+    reason = {200: "OK", 400: "Bad Request", 404: "Not Found"}[status]
+    writer.write(f"HTTP/1.1 {status} {reason}\r\n"
+                 f"Content-Type: application/json\r\n"
+                 f"Content-Length: {len(data)}\r\n"
+                 f"Connection: close\r\n\r\n".encode() + data)
+    await writer.drain()
+
+
+async def request(method, path, body=None, address=("127.0.0.1", 8765)):
+    """
+    Minimal client: sends one request and yields the JSON lines of
+    the response as they arrive.
+
+    :param method: str, e.g. "POST"
+    :param path: str, e.g. "/derive"
+    :param body: dict, JSON request
+    :param address: (host, port), or the path of a Unix socket
+    :return: async generator of (status, dict)
+    """
+    if isinstance(address, str):
+        reader, writer = await asyncio.open_unix_connection(address)
+    else:
+        reader, writer = await asyncio.open_connection(*address)
+    data = b"" if body is None else json.dumps(body).encode()
+    writer.write(f"{method} {path} HTTP/1.1\r\nHost: localhost\r\n"
+                 f"Content-Type: application/json\r\n"
+                 f"Content-Length: {len(data)}\r\n\r\n".encode() + data)
+    try:
+        status = int((await reader.readline()).split()[1])
+        chunked = False
+        while True:
+            line = (await reader.readline()).strip().lower()
+            if not line:
+                break
+            chunked |= line == b"transfer-encoding: chunked"
+        if not chunked:
+            yield status, json.loads(await reader.read())
+            return
+        while True:
+            size = int((await reader.readline()).strip(), 16)
+            if size == 0:
+                return
+            chunk = await reader.readexactly(size + 2)
+            yield status, json.loads(chunk[:-2])
+    finally:
+        writer.close()
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(
+        description="Serve derivations from a warm worker pool.")
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=8765)
+    ap.add_argument("--unix", help="listen on a Unix socket at this path")
+    ap.add_argument("--workers", type=positive_int)
+    ap.add_argument("--chunk", type=positive_int, default=100,
+                    help="max attempts per worker unit")
+    args = ap.parse_args(argv)
+
+    async def serve():
+        async with Server(workers=args.workers, chunk=args.chunk) as server:
+            address = await server.start(args.host, args.port, args.unix)
+            print(f"serving on {address} with {server.workers} workers")
+            await server.server.serve_forever()
+
+    # a kill with SIGTERM shuts the pool down like Ctrl-C
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,211 @@
+"""
+solver.py
+
+Exact probability that one derivation (Composer.derive or
+ComposerB.derive) spells out a target surface, by treating derive() as
+a Markov chain over stages and summing over it with dynamic
+programming instead of sampling.
+
+A stage is reduced to what its future depends on:
+    - the Lexical Array as a multiset of Stufen
+    - the Workspace as a multiset of SO signatures, where an SO that
+      still spells out a contiguous segment of target is kept as its
+      leaves and the projection of its left daughter (all that
+      Filter reads of a tree built over it), and any other SO only
+      as the features Agree reads of it (nothing, for Model A's
+      free Merge)
+so equivalent stages are solved once. Derivations reach the target
+when a Merge builds an SO spelling it out that passes Filter.
+
+Attempts until a hit are geometric, so the expected number of
+tebe_search attempts is 1 / probability:
+
+    solution = Solver(Composer(), tebe_lexical_array(), TEBE).solve()
+"""
+
+import collections
+import math
+from collections import namedtuple
+from fractions import Fraction
+
+from model import Composer, Stufe, SyntacticObject
+
+# probability: P(one derivation spells out target),
+# expected_attempts: 1 / probability, states: distinct stages solved
+Solution = namedtuple("Solution",
+                      ["probability", "expected_attempts", "states"])
+
+
+class Solver:
+    """
+    Markov-chain solver for one model, Lexical Array and target.
+    """
+    def __init__(self, model, la, target, exact=False):
+        """
+        default ctor
+        :param model: Composer or ComposerB
+        :param la: collection of Stufe objs
+        :param target: str, spelled out surface
+        :param exact: bool, compute with Fractions instead of floats
+        """
+        self.model = model
+        self.target = tuple(target.split())
+        self.one = Fraction(1) if exact else 1.0
+
+        # distinct Stufen of la, and the multiset as counts of each
+        self.types = list(dict.fromkeys(la))
+        counts = collections.Counter(la)
+        self.la = tuple(counts[s] for s in self.types)
+
+        # every contiguous segment of target
+        n = len(self.target)
+        self.segments = {self.target[i:j] for i in range(n)
+                         for j in range(i + 1, n + 1)}
+        # free Merge: SO's off target are interchangeable
+        self.free = type(model).can_merge is Composer.can_merge
+
+        # signature -> an SO (or Stufe) with that signature
+        self.rep = dict()
+        self._merged = dict()
+        self._agree = dict()
+        self.memo = dict()
+
+    def signature(self, so):
+        """
+        :param so: Stufe or SyntacticObject
+        :return: hashable signature of so
+        """
+        if tuple(s.name for s in so.leaves) in self.segments:
+            if isinstance(so, Stufe):
+                sig = (so.leaves, None)
+            else:
+                # latter object projects syntactic features
+                sig = (so.leaves, so.items[0].leaves[-1])
+        elif self.free:
+            sig = 'off'
+        elif isinstance(so, Stufe):
+            sig = ('off', so)
+        else:
+            sig = ('off', so.c5, so.c3)
+        self.rep.setdefault(sig, so)
+        return sig
+
+    def merged(self, a, b):
+        """
+        :param a: signature of the first SO
+        :param b: signature of the second SO
+        :return: signature of their Merge, and whether it is a hit
+        """
+        key = (a, b)
+        if key not in self._merged:
+            so = SyntacticObject(self.rep[a], self.rep[b])
+            hit = (a != 'off' and b != 'off'
+                   and tuple(s.name for s in so.leaves) == self.target
+                   and self.model.filter(so))
+            self._merged[key] = (self.signature(so), hit)
+        return self._merged[key]
+
+    def agree(self, a, b) -> bool:
+        key = (a, b)
+        if key not in self._agree:
+            self._agree[key] = self.model.can_merge(self.rep[a], self.rep[b])
+        return self._agree[key]
+
+    def select(self, la, workspace, i):
+        """
+        :return: stage after Selecting the i-th Stufe type
+        """
+        la = la[:i] + (la[i] - 1,) + la[i + 1:]
+        workspace = collections.Counter(dict(workspace))
+        workspace[self.signature(self.types[i])] += 1
+        return la, frozenset(workspace.items())
+
+    def probability(self, la, workspace):
+        """
+        P(a derivation from this stage spells out target).
+
+        :param la: tuple of int, count of each Stufe type left
+        :param workspace: frozenset of (signature, count)
+        :return: float or Fraction
+        """
+        key = (la, workspace)
+        if key in self.memo:
+            return self.memo[key]
+
+        remaining = sum(la)
+        size = sum(n for sig, n in workspace)
+
+        selected = 0 * self.one
+        if remaining:
+            for i, n in enumerate(la):
+                if n:
+                    selected += self.one * n / remaining \
+                                * self.probability(*self.select(la, workspace, i))
+
+        # ordered pairs of SO's that may Merge, by signature
+        pairs = list()
+        if size >= 2:
+            for a, na in workspace:
+                for b, nb in workspace:
+                    weight = na * (nb - (a == b))
+                    if weight and self.agree(a, b):
+                        pairs.append((weight, a, b))
+        total = sum(w for w, a, b in pairs)
+
+        merged = 0 * self.one
+        for weight, a, b in pairs:
+            sig, hit = self.merged(a, b)
+            if hit:
+                p = self.one
+            else:
+                rest = collections.Counter(dict(workspace))
+                rest[a] -= 1
+                rest[b] -= 1
+                rest[sig] += 1
+                rest = frozenset((s, n) for s, n in rest.items() if n)
+                p = self.probability(la, rest)
+            merged += self.one * weight / total * p
+
+        # the coin flip picks Select or Merge; a flip that can't
+        # act is a no-op and is flipped again
+        if remaining and total:
+            p = (selected + merged) / 2
+        elif remaining:
+            p = selected
+        else:
+            # finished, crashed, or Merge only
+            p = merged
+        self.memo[key] = p
+        return p
+
+    def solve(self) -> Solution:
+        """
+        :return: Solution
+        """
+        # set up (select 2)
+        start = (self.la, frozenset())
+        p = 0 * self.one
+        total = sum(self.la)
+        for i, n in enumerate(self.la):
+            if not n:
+                continue
+            first = self.select(*start, i)
+            for j, m in enumerate(first[0]):
+                if m:
+                    p += self.one * n / total * m / (total - 1) \
+                         * self.probability(*self.select(*first, j))
+        expected = 1 / p if p else math.inf
+        return Solution(p, expected, len(self.memo))
+
+
+def solve(model, la, target, exact=False) -> Solution:
+    """
+    :param model: Composer or ComposerB
+    :param la: collection of Stufe objs
+    :param target: str, spelled out surface
+    :param exact: bool, see Solver
+    :return: Solution
+    """
+    if len(la) < 2:
+        raise ValueError("You need more than 2 Stufen to compose")
+    return Solver(model, la, target, exact=exact).solve()
@@ -0,0 +1,230 @@
+"""
+stats.py
+
+Monte Carlo statistics over stochastic derivations. Derivation outcomes
+are streamed into a histogram of spelled out surfaces instead of being
+kept around. The histogram is exact until the number of distinct
+surfaces passes a memory cap, after which it falls back to a count-min
+sketch plus a bounded table of heavy hitters.
+
+Rates are reported with Wilson score confidence intervals, so a run can
+be stopped once it has converged.
+"""
+
+import hashlib
+import itertools
+import math
+from array import array
+
+
+def wilson(successes, trials, z=1.96) -> (float, float):
+    """
+    Wilson score interval for a binomial proportion.
+
+    :param successes: int
+    :param trials: int
+    :param z: float, normal quantile (1.96 for 95%)
+    :return: (float, float)
+    """
+    if trials == 0:
+        return 0.0, 1.0
+    p = successes / trials
+    denom = 1 + z * z / trials
+    center = (p + z * z / (2 * trials)) / denom
+    half = z * math.sqrt(p * (1 - p) / trials
+                         + z * z / (4 * trials * trials)) / denom
+    return max(0.0, center - half), min(1.0, center + half)
+
+
+class CountMinSketch:
+    """
+    Approximate counts in fixed memory. Estimates never undercount,
+    and overcount by at most e/width of the total with probability
+    1 - exp(-depth).
+    """
+    def __init__(self, width=2048, depth=4):
+        self.width = width
+        self.depth = depth
+        self.rows = [array('Q', bytes(8 * width)) for _ in range(depth)]
+
+    def _columns(self, key):
+        digest = hashlib.blake2b(key.encode(), digest_size=8 * self.depth)
+        digest = digest.digest()
+        for i in range(self.depth):
+            yield int.from_bytes(digest[8 * i:8 * i + 8], 'little') % self.width
+
+    def add(self, key, n=1):
+        for row, col in zip(self.rows, self._columns(key)):
+            row[col] += n
+
+    def estimate(self, key) -> int:
+        return min(row[col] for row, col in zip(self.rows, self._columns(key)))
+
+
+class SurfaceHistogram:
+    """
+    Counts of spelled out surfaces with bounded memory. Exact while
+    at most cap surfaces are distinct; past that, counts come from a
+    count-min sketch and only the cap heaviest surfaces are tracked.
+    """
+    def __init__(self, cap=10000, width=2048, depth=4):
+        """
+        default ctor
+        :param cap: max number of surfaces held in the table
+        :param width: count-min sketch width
+        :param depth: count-min sketch depth
+        """
+        self.cap = cap
+        self.width = width
+        self.depth = depth
+        self.counts = dict()
+        self.total = 0
+        # None while exact
+        self.sketch = None
+
+    @property
+    def exact(self) -> bool:
+        return self.sketch is None
+
+    def add(self, surface, n=1):
+        self.total += n
+        if self.sketch is None:
+            self.counts[surface] = self.counts.get(surface, 0) + n
+            if len(self.counts) > self.cap:
+                self._overflow()
+            return
+
+        self.sketch.add(surface, n)
+        if surface in self.counts:
+            self.counts[surface] += n
+        else:
+            self.counts[surface] = self.sketch.estimate(surface)
+            if len(self.counts) > self.cap:
+                self._evict()
+
+    def _overflow(self):
+        # switch to the sketch, seeded with the exact counts so far
+        self.sketch = CountMinSketch(self.width, self.depth)
+        for surface, n in self.counts.items():
+            self.sketch.add(surface, n)
+        self._evict()
+
+    def _evict(self):
+        # keep the heavier half, amortizing the sort over cap/2 adds
+        keep = sorted(self.counts.items(), key=lambda kv: kv[1],
+                      reverse=True)[:max(1, self.cap // 2)]
+        self.counts = dict(keep)
+
+    def estimate(self, surface) -> int:
+        if surface in self.counts:
+            return self.counts[surface]
+        if self.sketch is None:
+            return 0
+        return self.sketch.estimate(surface)
+
+    def most_common(self, k=10) -> list:
+        return sorted(self.counts.items(), key=lambda kv: kv[1],
+                      reverse=True)[:k]
+
+
+class MonteCarlo:
+    """
+    Streams the outcomes of repeated derivations into running
+    statistics: crash rate, hit rate and a surface histogram.
+    A surface is counted once per derivation in which it is
+    spelled out, so counts / attempts estimate probabilities.
+    """
+    def __init__(self, model, la, target=None, cap=10000):
+        """
+        default ctor
+        :param model: Composer (any model with attempts())
+        :param la: collection of Stufe objs
+        :param target: str; if None, a hit is any filter-passing SO
+        :param cap: histogram memory cap, see SurfaceHistogram
+        """
+        self.model = model
+        self.la = la
+        self.target = target
+        self.histogram = SurfaceHistogram(cap=cap)
+        self.attempts = 0
+        self.crashes = 0
+        self.hits = 0
+
+    def update(self, derivations, success):
+        """
+        Adds the outcome of one derivation.
+
+        :param derivations: collection of SyntacticObject
+        :param success: bool
+        """
+        self.attempts += 1
+        if not success:
+            self.crashes += 1
+        spelled = {d.spell_out() for d in derivations}
+        for surface in spelled:
+            self.histogram.add(surface)
+        if self.target is None:
+            self.hits += len(spelled) > 0
+        else:
+            self.hits += self.target in spelled
+
+    def run(self, n, every=1000, tol=None):
+        """
+        Runs up to n derivations, yielding a report every `every`
+        attempts and at the end. Stops early once the hit rate's
+        confidence interval is narrower than tol.
+
+        :param n: int, max derivations
+        :param every: int
+        :param tol: float, half-width of the hit rate interval
+        :return: generator of dict
+        """
+        attempts = itertools.islice(self.model.attempts(self.la), n)
+        return self.feed(attempts, every=every, tol=tol)
+
+    def feed(self, attempts, every=1000, tol=None):
+        """
+        Consumes a stream of lazy derivations (Composer.attempts),
+        yielding a report every `every` attempts and when the stream
+        ends. Stops pulling attempts once the hit rate's confidence
+        interval is narrower than tol.
+
+        :param attempts: iterable of model.Derivation
+        :param every: int
+        :param tol: float, half-width of the hit rate interval
+        :return: generator of dict
+        """
+        i = 0
+        for i, derivation in enumerate(attempts, 1):
+            derivations = list(derivation)
+            self.update(derivations, derivation.success)
+            if i % every == 0:
+                report = self.report()
+                yield report
+                lo, hi = report["hit_ci"]
+                if tol is not None and self.hits and (hi - lo) / 2 < tol:
+                    return
+        if i % every != 0:
+            yield self.report()
+
+    def report(self, k=10) -> dict:
+        """
+        :param k: number of most common surfaces to include
+        :return: dict of running statistics
+        """
+        top = list()
+        for surface, count in self.histogram.most_common(k):
+            lo, hi = wilson(count, self.attempts)
+            top.append({"surface": surface, "count": count,
+                        "rate": count / self.attempts, "ci": (lo, hi)})
+        return {
+            "attempts": self.attempts,
+            "crash_rate": self.crashes / max(self.attempts, 1),
+            "crash_ci": wilson(self.crashes, self.attempts),
+            "hits": self.hits,
+            "hit_rate": self.hits / max(self.attempts, 1),
+            "hit_ci": wilson(self.hits, self.attempts),
+            "distinct": len(self.histogram.counts),
+            "exact": self.histogram.exact,
+            "surfaces": top,
+        }
@@ -9,6 +9,10 @@ Takes mathematical inspiration from Collins & Stabler (2011).
 
 import random
 
+import numpy as np
+
+from tracer import Tracer
+
 
 class Stufe:
     # Circle of Fifths in sharps, octave equivalence
@@ -51,24 +55,95 @@ class SyntacticObject:
         self.ct = m2.ct
 
     def __str__(self):
-        # recursively access contained stufen
-        return f"[{str(self.items[0])}, {str(self.items[1])}]"
+        # access contained stufen without recursion, so generate_v3's
+        # deep trees print
+        parts = list()
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            if isinstance(node, str):
+                parts.append(node)
+            elif isinstance(node, SyntacticObject):
+                stack.extend(("]", node.items[1], ", ", node.items[0], "["))
+            else:
+                parts.append(str(node))
+        return ''.join(parts)
 
     def __repr__(self):
-        return f"[{str(self.items[0])}, {str(self.items[1])}]"
+        return str(self)
 
 
 class Model:
-    def __init__(self, western=True):
+    class Lexicon:
+        """
+        A lexicon with Merge options precomputed over it, once per Model
+        parameterization (western/rock). Stufen are indexed by
+        position in stufen, which is sorted by (cf, ct).
+        """
+        def __init__(self, stufen):
+            """
+            default ctor
+            :param stufen: collection of Stufe
+            """
+            self.stufen = sorted(stufen, key=lambda s: (s.cf, s.ct))
+            self.by_cf = {s.cf: s for s in self.stufen}
+            self.cf = np.array([s.cf for s in self.stufen], dtype=np.int64)
+            # merge_negative -> Transitions
+            self.transitions = dict()
+
+    class Transitions:
+        """
+        Merge options over a Lexicon, for one parameterization. For the
+        projecting Stufe i of an SO, option k (k < count[i]) Merges it
+        with Stufe other[i, k], the SO being the right daughter if
+        right[i, k] and the left otherwise; the result projects Stufe
+        project[i, k]. merges[i] lists the same options as tuples
+        (other, right, project), in get_possible_merges order.
+        """
+        def __init__(self, model, lexicon):
+            """
+            default ctor
+            :param model: Model
+            :param lexicon: Model.Lexicon
+            """
+            stufen = lexicon.stufen
+            n = len(stufen)
+            index = {id(s): i for i, s in enumerate(stufen)}
+
+            self.merges = list()
+            for i, s in enumerate(stufen):
+                options = list()
+                for m1, m2 in model.get_possible_merges(s, lexicon.by_cf):
+                    right = m2 is s
+                    # latter object projects syntactic features
+                    options.append((index[id(m1 if right else m2)], right,
+                                    index[id(m2)]))
+                self.merges.append(options)
+
+            width = max([len(o) for o in self.merges] + [1])
+            self.count = np.array([len(o) for o in self.merges], dtype=np.int64)
+            self.other = np.zeros((n, width), dtype=np.int64)
+            self.right = np.zeros((n, width), dtype=bool)
+            self.project = np.zeros((n, width), dtype=np.int64)
+            for i, options in enumerate(self.merges):
+                for k, (other, right, project) in enumerate(options):
+                    self.other[i, k] = other
+                    self.right[i, k] = right
+                    self.project[i, k] = project
+
+    def __init__(self, western=True, tracer=None):
         # options for Western Tonality and Rock merge parameters
         self.merge_negative = western
+        # derivation events, silent if None
+        self.tracer = tracer or Tracer()
 
         self.stufen = {Stufe(i, i) for i in range(-12, 13)}
+        # (cf, ct) of each Stufe -> Lexicon
+        self._lexicons = dict()
 
         # fixme: test
-        print("Stufen\n======")
-        for s in self.stufen:
-            print(s)
+        if self.tracer.enabled:
+            self.tracer.emit('stufen', stufen=self.stufen)
 
     def agree(self, s1, s2):
         """
@@ -117,13 +192,57 @@ class Model:
 
         if self.merge_negative:
             if (root.items[0].cf == tonic_cf and  # tonic prolongation
-                    root.items[1].items[0] == tonic_cf + 1):
+                    isinstance(root.items[1], SyntacticObject) and
+                    root.items[1].items[0].cf == tonic_cf + 1):
                 # Tonic Prolongation, Dominant Prolongation, Tonic Completion
                 return True
         else:
             # TODO: Rock music
             return False
 
+    def filter_batch(self, cf, left_cf, right_is_so, right_left_cf):
+        """
+        filter over arrays of roots, one element per root.
+
+        :param cf: cf of the root
+        :param left_cf: cf of the left daughter
+        :param right_is_so: whether the right daughter is an SO
+        :param right_left_cf: cf of the right daughter's left daughter
+                              (ignored unless right_is_so)
+        :return: np.ndarray of bool
+        """
+        if self.merge_negative:
+            # Tonic Prolongation, Dominant Prolongation, Tonic Completion
+            return (left_cf == cf) & right_is_so & (right_left_cf == cf + 1)
+        # TODO: Rock music
+        return np.zeros(np.shape(cf), dtype=bool)
+
+    def lexicon(self, stufen=None) -> Lexicon:
+        """
+        Lexicon (with lexicon_by_cf) for stufen, built once and reused.
+
+        :param stufen: collection of Stufe; self.stufen if None
+        :return: Model.Lexicon
+        """
+        if not stufen:
+            stufen = self.stufen
+        key = tuple(sorted((s.cf, s.ct) for s in stufen))
+        if key not in self._lexicons:
+            self._lexicons[key] = self.Lexicon(stufen)
+        return self._lexicons[key]
+
+    def transitions(self, lexicon) -> Transitions:
+        """
+        Merge options over lexicon for the current
+        parameterization (merge_negative), built once and reused.
+
+        :param lexicon: Model.Lexicon
+        :return: Model.Transitions
+        """
+        if self.merge_negative not in lexicon.transitions:
+            lexicon.transitions[self.merge_negative] = self.Transitions(self, lexicon)
+        return lexicon.transitions[self.merge_negative]
+
     def get_agreeable_features(self, stufe):
         """
         Determines stufen that would be legally Merge-able
@@ -184,7 +303,7 @@ class Model:
 
         return merges_TO + merges_FROM
 
-    def generate_v3(self, n=10, lexicon=None):
+    def generate_v3(self, n=10, lexicon=None, max_steps=None):
         """
         Stochastically generates an ordering of stufen using Merge.
         Uses a stochastic, Agree-driven Select style. That is,
@@ -195,51 +314,169 @@ class Model:
         :param n: number of syntactic objects to generate
         :lexicon: ordered collection of Stufe; all that you want available
                   for the generation. If "None" then uses all available
+        :param max_steps: Merges before giving up, None for no limit
         :return: SyntacticObject
         """
 
         # begin
-        if not lexicon:
-            lexicon = self.stufen
-
-        lexicon_by_cf = {s.cf: s for s in lexicon}
+        lexicon = self.lexicon(lexicon)
+        stufen = lexicon.stufen
+        # Merge options by projecting Stufe, as get_possible_merges
+        t = self.transitions(lexicon)
         # TODO: add thirds relationship
 
-        # randomly add two stufen to the workspace (initial Select)
-        workspace = random.sample(lexicon, 2)
+        # randomly add two stufen to the workspace (initial Select),
+        # keeping the index of the Stufe each SO projects
+        proj = random.sample(range(len(stufen)), 2)
+        workspace = [stufen[i] for i in proj]
 
         num_generated = 0
         completed = list()
+        steps = 0
         while num_generated < n:
+            # a walk that neither crashes nor passes Filter never ends
+            if max_steps is not None and steps >= max_steps:
+                return completed
+            steps += 1
             current_i = random.choice(range(len(workspace)))
             current = workspace[current_i]
 
-            merges = self.get_possible_merges(current, lexicon_by_cf)
+            merges = t.merges[proj[current_i]]
 
             # crash clause
             if len(merges) == 0:
-                print("Derivation Crashed")
-                print("current stage: ")
-                print(workspace)
+                if self.tracer.enabled:
+                    self.tracer.emit('end', success=False, workspace=workspace)
                 return completed
 
-            choice = random.choice(merges)
+            other, right, project = random.choice(merges)
 
-            m = self.merge(choice[0], choice[1])
+            if right:
+                m = self.merge(stufen[other], current)
+            else:
+                m = self.merge(current, stufen[other])
             workspace[current_i] = m
+            proj[current_i] = project
 
             # check for completed derivations
             if self.filter(m):
                 # "Transfer"
                 completed.append(m)
                 num_generated += 1
-            else:
-                print("stage")
-                print(workspace)
-                print()
+                if self.tracer.enabled:
+                    self.tracer.emit('transfer', so=m)
+            elif self.tracer.enabled:
+                self.tracer.emit('stage', workspace=workspace)
+
+        return completed
+
+    def generate_batch(self, n=10, walks=1024, max_steps=10000, lexicon=None,
+                       seed=None):
+        """
+        generate_v3 run as many independent walks at once over the
+        precomputed Merge options, with Filter applied in vector form.
+        Each walk starts like generate_v3 and at every step Merges
+        one of its two workspace SO's with a random agreeing Stufe;
+        a walk with no possible Merge crashes and stops. Only the
+        filter-passing SO's are built as objects, by replaying their
+        walk.
+
+        :param n: number of syntactic objects to generate, over all walks
+        :param walks: number of walks run in lockstep
+        :param max_steps: steps per walk before giving up
+        :param lexicon: collection of Stufe, see generate_v3
+        :param seed: int or np.random.Generator
+        :return: list of SyntacticObject
+        """
+        rng = np.random.default_rng(seed)
+        lexicon = self.lexicon(lexicon)
+        t = self.transitions(lexicon)
+        cf = lexicon.cf
+        every = np.arange(walks)
 
+        # randomly add two stufen to the workspace (initial Select)
+        size = len(lexicon.stufen)
+        first = rng.integers(size, size=walks)
+        second = rng.integers(size - 1, size=walks)
+        second += second >= first
+        start = np.stack([first, second], axis=1)
+
+        # per walk and workspace slot: projecting Stufe, whether it's
+        # an SO, and what filter reads of it
+        proj = start.copy()
+        is_so = np.zeros((walks, 2), dtype=bool)
+        left_cf = np.zeros((walks, 2), dtype=np.int64)
+        right_is_so = np.zeros((walks, 2), dtype=bool)
+        right_left_cf = np.zeros((walks, 2), dtype=np.int64)
+        alive = np.ones(walks, dtype=bool)
+
+        # choices made, to rebuild the SO's that pass
+        slots = np.zeros((max_steps, walks), dtype=np.int8)
+        picks = np.zeros((max_steps, walks), dtype=np.int8)
+        hits = list()
+        found = 0
+
+        for step in range(max_steps):
+            if found >= n or not alive.any():
+                break
+            slot = rng.integers(2, size=walks)
+            current = proj[every, slot]
+            count = t.count[current]
+            # crash clause
+            alive &= count > 0
+            k = (rng.random(walks) * count).astype(np.int64)
+            slots[step] = slot
+            picks[step] = k
+
+            rows = np.nonzero(alive)[0]
+            slot, current, k = slot[rows], current[rows], k[rows]
+            other = t.other[current, k]
+            right = t.right[current, k]
+            # SO as right daughter: the Stufe is the left one
+            new_left = np.where(right, cf[other], cf[current])
+            new_right_is_so = right & is_so[rows, slot]
+            new_right_left = left_cf[rows, slot]
+
+            proj[rows, slot] = t.project[current, k]
+            is_so[rows, slot] = True
+            left_cf[rows, slot] = new_left
+            right_is_so[rows, slot] = new_right_is_so
+            right_left_cf[rows, slot] = new_right_left
+
+            passed = self.filter_batch(cf[proj[rows, slot]], new_left,
+                                       new_right_is_so, new_right_left)
+            for w in rows[passed]:
+                hits.append((step, w))
+            found += int(passed.sum())
+
+        completed = [self._replay(lexicon, t, start[w], slots[:step + 1, w],
+                                  picks[:step + 1, w])
+                     for step, w in hits[:n]]
+        if self.tracer.enabled:
+            for m in completed:
+                self.tracer.emit('transfer', so=m)
         return completed
 
+    def _replay(self, lexicon, t, start, slots, picks):
+        """
+        Rebuilds the SO a generate_batch walk has in its Merged slot
+        after its last step.
+
+        :return: SyntacticObject
+        """
+        stufen = lexicon.stufen
+        workspace = [stufen[start[0]], stufen[start[1]]]
+        proj = list(start)
+        for slot, k in zip(slots, picks):
+            current = proj[slot]
+            stufe = stufen[t.other[current, k]]
+            if t.right[current, k]:
+                workspace[slot] = self.merge(stufe, workspace[slot])
+            else:
+                workspace[slot] = self.merge(workspace[slot], stufe)
+            proj[slot] = t.project[current, k]
+        return workspace[slots[-1]]
+
     def spell_out(self, generated):
         """
         Prints the generated compositions in a pretty way.
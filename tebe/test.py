@@ -7,12 +7,14 @@ A simple test of the Tebe generative model.
 """
 
 from tebe import dissertation
+from tracer import PrintTracer
 
 def main():
 
-    composer = dissertation.Model()
+    composer = dissertation.Model(tracer=PrintTracer())
 
-    compositions = composer.generate_v3(n=1)
+    # the Ursatz Filter may never pass, so bound the walk
+    compositions = composer.generate_v3(n=1, max_steps=100)
 
     composer.spell_out(compositions)
 
@@ -0,0 +1,111 @@
+"""
+test_batch.py
+
+batch.BatchComposer against model.Composer: both engines should give
+the same distribution of spelled out surfaces. Likewise the tebe
+dissertation Model's generate_batch against generate_v3.
+
+    python -m pytest test_batch.py
+"""
+
+import collections
+import math
+import random
+
+from batch import BatchComposer
+from model import Composer, Stufe
+from tebe import dissertation
+
+LA = [Stufe(0), Stufe(0), Stufe(1), Stufe(-1), Stufe(0, major=False)]
+RUNS = 20000
+
+
+def histogram(runs) -> collections.Counter:
+    """
+    :param runs: iterable of lists of surfaces, one list per derivation
+    :return: Counter of surface -> derivations spelling it out
+    """
+    counts = collections.Counter()
+    for spelled in runs:
+        counts.update(set(spelled))
+    return counts
+
+
+def test_batch_histogram_matches_composer():
+    composer = Composer(rng=random.Random(0))
+    serial = list()
+    successes = 0
+    for _ in range(RUNS):
+        derivations, success = composer.derive(LA)
+        serial.append([so.spell_out() for so in derivations])
+        successes += success
+    batched, success = BatchComposer(seed=0).derive(LA, k=RUNS)
+
+    expected = histogram(serial)
+    found = histogram(batched)
+    assert len(expected) > 10
+    for surface in expected.keys() | found.keys():
+        p = (expected[surface] + found[surface]) / (2 * RUNS)
+        # two binomial proportions, within 5 standard errors
+        bound = 5 * math.sqrt(2 * p * (1 - p) / RUNS) + 1 / RUNS
+        assert abs(expected[surface] - found[surface]) / RUNS <= bound, surface
+
+    p = (successes + success.sum()) / (2 * RUNS)
+    assert abs(successes - success.sum()) / RUNS \
+        <= 5 * math.sqrt(2 * p * (1 - p) / RUNS) + 1 / RUNS
+
+
+class Cadence(dissertation.Model):
+    """
+    The dissertation Model with a Filter that some walks pass: a root
+    whose right daughter is an SO headed a fifth above it, on every
+    third cf. The Ursatz Filter can't be passed, as Agree never Merges
+    Stufen with equal cf.
+    """
+    def filter(self, root):
+        right = root.items[1]
+        return isinstance(right, dissertation.SyntacticObject) \
+            and right.items[0].cf == root.cf + 1 and root.cf % 3 == 0
+
+    def filter_batch(self, cf, left_cf, right_is_so, right_left_cf):
+        return right_is_so & (right_left_cf == cf + 1) & (cf % 3 == 0)
+
+
+def first_hit(completed):
+    """
+    :param completed: list of dissertation.SyntacticObject, n=1
+    :return: (cf, Stufen up to 6) of the walk's first hit, None if none
+    """
+    if not completed:
+        return None
+    size = 0
+    stack = [completed[0]]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, dissertation.Stufe):
+            size += 1
+        else:
+            stack.extend(node.items)
+    return completed[0].cf, min(size, 6)
+
+
+def test_generate_batch_matches_generate_v3():
+    model = Cadence()
+    runs, steps = 4000, 20
+    random.seed(0)
+    serial = collections.Counter(
+        first_hit(model.generate_v3(n=1, max_steps=steps))
+        for _ in range(runs))
+    # a walk at a time, so each hit is its walk's first
+    batched = collections.Counter(
+        first_hit(model.generate_batch(n=1, walks=1, max_steps=steps,
+                                       seed=seed))
+        for seed in range(runs))
+    assert len(serial) > 10 and serial[None] < runs / 2
+
+    # chi-square test of homogeneity, within 5 standard deviations
+    keys = serial.keys() | batched.keys()
+    chi2 = sum((serial[k] - batched[k]) ** 2 / (serial[k] + batched[k])
+               for k in keys)
+    df = len(keys) - 1
+    assert chi2 <= df + 5 * math.sqrt(2 * df)
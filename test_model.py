@@ -0,0 +1,162 @@
+"""
+test_model.py
+
+Exhaustive enumeration (Composer.Chart) against brute force over
+small Lexical Arrays, with the Ursatz and with other Filters; and
+Select and Merge staying O(1) as the Lexical Array grows.
+
+    python -m pytest test_model.py
+"""
+
+import itertools
+import random
+import time
+
+import pytest
+
+import model
+import modelB
+from model import Composer, Stufe, SyntacticObject
+from modelB import ComposerB
+
+
+def brute_force(composer, la) -> set:
+    """
+    Every distinct SO passing Filter over la, by building every tree
+    over every sub-multiset without memoizing by signature.
+
+    :param composer: Composer or ComposerB
+    :param la: list of Stufe
+    :return: set of SyntacticObject
+    """
+    # sub-multiset (sorted tuple of positions' Stufen) -> set of trees
+    trees = dict()
+
+    def over(items):
+        if items in trees:
+            return trees[items]
+        if len(items) == 1:
+            found = {items[0]}
+        else:
+            found = set()
+            positions = range(len(items))
+            for size in range(1, len(items)):
+                for left in itertools.combinations(positions, size):
+                    a = tuple(items[i] for i in left)
+                    b = tuple(items[i] for i in positions if i not in left)
+                    for so1 in over(a):
+                        for so2 in over(b):
+                            if composer.can_merge(so1, so2):
+                                found.add(SyntacticObject(so1, so2))
+        trees[items] = found
+        return found
+
+    key = lambda s: (s.c5, s.is_major, s.is_dim)
+    passing = set()
+    for size in range(2, len(la) + 1):
+        for sub in set(itertools.combinations(sorted(la, key=key), size)):
+            passing.update(so for so in over(sub) if composer.filter(so))
+    return passing
+
+
+def random_la(rng, n) -> list:
+    # a cadence, so some trees pass Filter, plus n random Stufen
+    return [Stufe(0), Stufe(1), Stufe(0)] + [
+        Stufe(c5=rng.randint(-1, 2), major=rng.random() < 0.7,
+              dim=rng.random() < 0.3) for _ in range(n)]
+
+
+LEXICAL_ARRAYS = [
+    [Stufe(0), Stufe(1), Stufe(0)],
+    [Stufe(0), Stufe(0), Stufe(1), Stufe(-1), Stufe(0, major=False)],
+    [Stufe(0), Stufe(1), Stufe(1), Stufe(0), Stufe(2)],
+] + [random_la(random.Random(seed), 3) for seed in range(4)]
+
+# the Ursatz, and Filters that pass trees of other shapes
+FILTERS = [None, "c5 == tonic",
+           "leftmost_c5 == tonic + 1 and right_left_c5 is None",
+           "right_left_c5 == c5 - 1 and c3 == 4"]
+
+
+@pytest.mark.parametrize("model_cls", [Composer, ComposerB])
+@pytest.mark.parametrize("filter_expr", FILTERS)
+@pytest.mark.parametrize("la", LEXICAL_ARRAYS)
+def test_chart_matches_brute_force(model_cls, filter_expr, la):
+    composer = model_cls(filter_expr=filter_expr)
+    expected = brute_force(composer, la)
+    assert composer.count_derivations(la) == len(expected)
+    enumerated = list(composer.enumerate_derivations(la))
+    assert len(enumerated) == len(set(enumerated))
+    assert set(enumerated) == expected
+
+
+def test_tebe_counts():
+    assert Composer().count_derivations(model.tebe_lexical_array()) == 46393596
+    assert ComposerB().count_derivations(modelB.tebe_lexical_array()) == 97051
+
+
+def test_stufe_is_immutable():
+    s = Stufe(c5=2, major=False)
+    assert Stufe(c5=2, major=False) is s
+    with pytest.raises(AttributeError):
+        s.c5 = 3
+    with pytest.raises(AttributeError):
+        del s.name
+    assert (s.c5, s.name) == (2, 'b')
+
+
+def test_composer_b_index_stays_consistent():
+    rng = random.Random(0)
+    composer = ComposerB(rng=random.Random(1))
+    stage = composer.Stage(la=random_la(rng, 60))
+    while len(stage.la) > 0 or len(stage.workspace) > 1:
+        if stage.la and (rng.random() < 0.5 or len(stage.workspace) < 2):
+            composer.select(rng.choice(stage.la), stage)
+        else:
+            # explicit Merge, by item, of tokens that may be the same SO
+            composer.merge(*rng.sample(stage.workspace, 2), stage)
+        where = dict()
+        for i, so in enumerate(stage.workspace):
+            where.setdefault(so, set()).add(i)
+        assert stage.where == where
+        for sig, bucket in stage.buckets.items():
+            assert all(stage.signature(so) == sig for so in bucket)
+            for i, so in enumerate(bucket):
+                assert i in stage.slots[so]
+        assert sum(map(len, stage.buckets.values())) == len(stage.workspace)
+        pairs = sum(composer.agree(a, b)
+                    for i, a in enumerate(stage.workspace)
+                    for j, b in enumerate(stage.workspace) if i != j)
+        assert composer.count_mergables(stage) == pairs
+
+
+@pytest.mark.parametrize("model_cls", [Composer, ComposerB])
+def test_select_and_merge_scale(model_cls):
+    """
+    Seconds per Select and Merge over a Lexical Array of n Stufen,
+    half of them already Selected, against 2n, 4n, ... 32n: flat if they
+    are O(1), where removing tokens by search made derivations quadratic.
+    """
+    def per_op(n, ops=500):
+        rng = random.Random(n)
+        composer = model_cls(rng=random.Random(0))
+        la = [Stufe(c5=rng.randint(-1, 6), major=rng.random() < 0.7)
+              for _ in range(n)]
+        best = float('inf')
+        for _ in range(5):
+            stage = composer.Stage(la=la)
+            for _ in range(n // 2):
+                composer.select_random(stage)
+            start = time.perf_counter()
+            for _ in range(ops):
+                composer.select_random(stage)
+                if model_cls is Composer:
+                    composer.merge_random(stage)
+                else:
+                    composer.merge(*composer.sample_mergable(stage), stage)
+            best = min(best, time.perf_counter() - start)
+        return best / ops
+
+    small = per_op(2000)
+    for n in (4000, 8000, 16000, 32000, 64000):
+        assert per_op(n) < 1.5 * small, n
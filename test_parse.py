@@ -0,0 +1,150 @@
+"""
+test_parse.py
+
+parse.Parser against exhaustive enumeration: a surface is derivable
+iff some tree Composer.enumerate_derivations yields spells it out,
+and parse.Forest holds exactly those trees. Also the parse.py command
+line.
+
+    python -m pytest test_parse.py
+"""
+
+import collections
+import itertools
+import json
+import math
+import random
+
+import pytest
+
+import parse
+from model import Composer, Stufe, SyntacticObject
+from modelB import ComposerB
+from parse import Parser
+
+LA = [Stufe(0), Stufe(0), Stufe(1), Stufe(-1), Stufe(2), Stufe(0, major=False)]
+# the Ursatz, and Filters that pass trees of other shapes
+FILTERS = [None, "c5 == tonic", "leftmost_c5 == tonic + 1 and right_left_c5 is None"]
+
+
+def by_surface(model, la) -> dict:
+    """
+    :return: dict of leaves -> set of trees passing Filter
+    """
+    trees = collections.defaultdict(set)
+    for so in model.enumerate_derivations(la):
+        trees[so.leaves].add(so)
+    return trees
+
+
+def surfaces(la):
+    """
+    Every distinct ordering of every sub-multiset of la of 2 or more.
+    """
+    for size in range(2, len(la) + 1):
+        yield from set(itertools.permutations(la, size))
+
+
+def agrees(model, so) -> bool:
+    """
+    Whether every Merge in so is licensed.
+    """
+    stack = [so]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, SyntacticObject):
+            if not model.can_merge(*node.items):
+                return False
+            stack.extend(node.items)
+    return True
+
+
+@pytest.mark.parametrize("model_cls", [Composer, ComposerB])
+@pytest.mark.parametrize("filter_expr", FILTERS)
+def test_parser_matches_enumeration(model_cls, filter_expr):
+    model = model_cls(filter_expr=filter_expr)
+    parser = Parser(model)
+    trees = by_surface(model, LA)
+    assert trees
+    for surface in surfaces(LA):
+        witness = parser.parse(surface)
+        assert (witness is not None) == (surface in trees), surface
+        if witness is not None:
+            assert witness.leaves == surface
+            assert model.filter(witness)
+            assert agrees(model, witness)
+            assert witness in trees[surface]
+
+
+def left_branchings(so) -> int:
+    """
+    Number of Merges in so whose left daughter is an SO, the cost
+    Forest gives a tree by default.
+    """
+    cost = 0
+    stack = [so]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, SyntacticObject):
+            cost += isinstance(node.items[0], SyntacticObject)
+            stack.extend(node.items)
+    return cost
+
+
+@pytest.mark.parametrize("model_cls", [Composer, ComposerB])
+@pytest.mark.parametrize("filter_expr", FILTERS)
+def test_forest_matches_enumeration(model_cls, filter_expr):
+    model = model_cls(filter_expr=filter_expr)
+    parser = Parser(model)
+    trees = by_surface(model, LA)
+    for surface in surfaces(LA):
+        forest = parser.forest(surface)
+        expected = trees.get(surface, set())
+        assert forest.total == len(expected), surface
+        ranked = list(forest.best())
+        assert len(ranked) == len(expected)
+        assert {so for cost, so in ranked} == expected
+        costs = [cost for cost, so in ranked]
+        assert costs == sorted(costs)
+        assert costs == [left_branchings(so) for cost, so in ranked]
+        if expected:
+            assert forest.sample(random.Random(0)) in expected
+        else:
+            assert forest.sample(random.Random(0)) is None
+
+
+@pytest.mark.parametrize("model_cls", [Composer, ComposerB])
+def test_forest_samples_uniformly(model_cls):
+    model = model_cls()
+    trees = by_surface(model, LA)
+    surface = max(trees, key=lambda s: len(trees[s]))
+    forest = Parser(model).forest(surface)
+    assert forest.total > 2
+    runs = 20000
+    rng = random.Random(0)
+    counts = collections.Counter(forest.sample(rng) for _ in range(runs))
+    assert set(counts) == trees[surface]
+    p = 1 / forest.total
+    for so, found in counts.items():
+        # within 5 standard errors
+        assert abs(found / runs - p) <= 5 * math.sqrt(p * (1 - p) / runs)
+
+
+def test_parse_chord_names():
+    parser = Parser(ComposerB())
+    assert parser.derivable("C F G C")
+    assert not parser.derivable("G C C")
+    parser = Parser(Composer(filter_expr="c5 == tonic"))
+    assert parser.parse("G C").leaves == (Stufe(1), Stufe(0))
+    assert parser.forest("C G C").total == 2
+
+
+def test_main_skips_unknown_chords(tmp_path, capsys):
+    progressions = tmp_path / "progressions.txt"
+    progressions.write_text("C F G C\nC X G C\nG C C\n")
+    assert parse.main([str(progressions)]) == 0
+    out, err = capsys.readouterr()
+    rows = [json.loads(line) for line in out.splitlines()]
+    assert [(r["surface"], r["derivable"]) for r in rows] \
+        == [("C F G C", True), ("G C C", False)]
+    assert "'C X G C'" in err and "'X'" in err
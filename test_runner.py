@@ -0,0 +1,75 @@
+"""
+test_runner.py
+
+runner.py from its command line: the dissertation model's lexicon of
+cf values, and a run stopped at a checkpoint and resumed writing what
+an uninterrupted run writes.
+
+    python -m pytest test_runner.py
+"""
+
+import json
+
+import pytest
+
+import runner
+
+
+def events(path) -> list:
+    with open(path) as f:
+        return [json.loads(line) for line in f]
+
+
+def test_dissertation_lexicon(tmp_path):
+    lexicon = tmp_path / "lex.txt"
+    lexicon.write_text("0 1 2 -1\n")
+    out = tmp_path / "out.jsonl"
+    assert runner.main(["--model", "dissertation", "--lexicon", str(lexicon),
+                        "--max-attempts", "10", "--workers", "1",
+                        "--seed", "1", "--out", str(out)]) == 0
+    start, *rest, end = events(out)
+    assert start["model"] == "dissertation" and start["seed"] == 1
+    assert end["event"] == "end" and end["attempts"] == 10
+
+
+def test_dissertation_lexicon_rejects_chord_names(tmp_path, capsys):
+    lexicon = tmp_path / "lex.txt"
+    lexicon.write_text("0 G 2\n")
+    with pytest.raises(SystemExit) as exit:
+        runner.main(["--model", "dissertation", "--lexicon", str(lexicon),
+                     "--max-attempts", "10", "--workers", "1"])
+    assert exit.value.code == 2
+    assert "cf values must be integers" in capsys.readouterr().err
+
+
+def test_resume_matches_uninterrupted_run(tmp_path):
+    # checkpointed after every unit; the resumed run has more workers
+    args = ["--model", "A", "--lexicon", str(tmp_path / "lex.txt"),
+            "--target", "C G C", "--seed", "3", "--hits", "0",
+            "--workers", "1", "--chunk", "10", "--every", "0"]
+    (tmp_path / "lex.txt").write_text("C G C\n")
+
+    whole = tmp_path / "whole.jsonl"
+    assert runner.main(args + ["--max-attempts", "60", "--out", str(whole)]) == 0
+
+    ckpt = str(tmp_path / "run.ckpt")
+    parts = tmp_path / "parts.jsonl"
+    assert runner.main(args + ["--max-attempts", "30", "--checkpoint", ckpt,
+                               "--out", str(parts)]) == 0
+    assert events(parts)[-1]["attempts"] == 30
+    assert runner.main(["--resume", "--checkpoint", ckpt, "--workers", "2",
+                        "--chunk", "10", "--hits", "0", "--every", "0",
+                        "--max-attempts", "60", "--out", str(parts)]) == 0
+
+    expected, found = events(whole), events(parts)
+    starts = [e for e in found if e["event"] == "start"]
+    assert [(e["resumed"], e["attempts"]) for e in starts] == [(False, 0), (True, 30)]
+    # the first run's end line was written after its checkpoint
+    assert [e["event"] for e in found].count("end") == 1
+
+    def hits(lines):
+        return [e for e in lines if e["event"] == "hit"]
+    assert len(hits(expected)) > 0
+    assert hits(found) == hits(expected)
+    del expected[-1]["elapsed"], found[-1]["elapsed"]
+    assert found[-1] == expected[-1]
@@ -0,0 +1,112 @@
+"""
+test_server.py
+
+server.Server end to end over HTTP on localhost, with two workers:
+streamed jobs, request validation, cancellation and batching.
+
+    python -m pytest test_server.py
+"""
+
+import asyncio
+
+import pytest
+
+from server import Server, request
+
+CADENCE = {"model": "A", "la": "C G C", "target": "C G C", "seed": 1}
+
+
+def serve(check, **kwargs):
+    """
+    Runs check(server, address) against a fresh Server on a free port.
+
+    :param check: async callable
+    :param kwargs: for Server
+    """
+    async def main():
+        async with Server(workers=2, **kwargs) as server:
+            address = await server.start(port=0)
+            await check(server, address)
+    asyncio.run(main())
+
+
+async def lines(address, method, path, body=None) -> list:
+    """
+    :return: list of (status, dict), every line of the response
+    """
+    return [line async for line in request(method, path, body, address)]
+
+
+def test_streams_results():
+    async def check(server, address):
+        derived = await lines(address, "POST", "/derive", dict(CADENCE, n=3))
+        assert [status for status, line in derived] == [200] * 4
+        head, *results = [line for status, line in derived]
+        assert head["seed"] == 1 and "job" in head
+        assert len(results) == 3
+        assert all(set(r) == {"seed", "success", "spelled"} for r in results)
+        # attempts are seeded from the job's seed
+        again = await lines(address, "POST", "/derive", dict(CADENCE, n=3))
+        assert [line for status, line in again][1:] == results
+
+        found = await lines(address, "POST", "/search",
+                            dict(CADENCE, max_attempts=1000))
+        outcome = found[-1][1]
+        assert outcome["found"] and "C G C" in outcome["spelled"]
+
+        reports = await lines(address, "POST", "/stats",
+                              dict(CADENCE, n=200, every=100))
+        reports = [line for status, line in reports][1:]
+        assert len(reports) == 2
+        assert reports[-1]["attempts"] == 200
+
+        dissertation = await lines(address, "POST", "/derive",
+                                   {"model": "dissertation", "la": [0, 1, 2, -1],
+                                    "n": 2, "seed": 1})
+        assert len(dissertation) == 3
+    serve(check)
+
+
+@pytest.mark.parametrize("body", [
+    dict(CADENCE, tonic=[1]),
+    dict(CADENCE, n=-1),
+    dict(CADENCE, la="C X C"),
+    {"model": "dissertation", "la": ["0", "1"]},
+])
+def test_rejects_bad_requests(body):
+    async def check(server, address):
+        (status, line), = await lines(address, "POST", "/derive", body)
+        assert status == 400 and "error" in line
+        assert server.jobs == {}
+    serve(check)
+
+
+def test_cancels_jobs():
+    async def check(server, address):
+        stream = request("POST", "/stats", dict(CADENCE, n=10 ** 9, every=100),
+                         address)
+        status, head = await stream.__anext__()
+        assert status == 200
+        assert head["job"] in server.health()["jobs"]
+        (status, line), = await lines(address, "DELETE", f"/jobs/{head['job']}")
+        assert status == 200 and line["cancelled"]
+        rest = [line async for status, line in stream]
+        assert rest[-1] == {"cancelled": True}
+        (status, health), = await lines(address, "GET", "/health")
+        assert health["jobs"] == []
+
+        (status, line), = await lines(address, "DELETE", "/jobs/nonesuch")
+        assert status == 404 and not line["cancelled"]
+    serve(check)
+
+
+def test_batches_small_units():
+    async def check(server, address):
+        jobs = [lines(address, "POST", "/derive", dict(CADENCE, n=1, seed=seed))
+                for seed in range(20)]
+        for derived in await asyncio.gather(*jobs):
+            assert len(derived) == 2
+        (status, health), = await lines(address, "GET", "/health")
+        assert health["units"] == 20
+        assert health["batches"] < health["units"]
+    serve(check, window=0.05)
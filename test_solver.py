@@ -0,0 +1,54 @@
+"""
+test_solver.py
+
+solver.Solver against sampled derivations.
+
+    python -m pytest test_solver.py
+"""
+
+import math
+import random
+
+import pytest
+
+from model import Composer, Stufe
+from modelB import ComposerB
+from solver import Solver, solve
+
+CASES = [
+    ([Stufe(0), Stufe(1), Stufe(0)], "C G C"),
+    ([Stufe(0), Stufe(1), Stufe(-1), Stufe(0)], "C F G C"),
+    ([Stufe(0), Stufe(0), Stufe(1), Stufe(0, major=False)], "C a G C"),
+]
+RUNS = 20000
+
+
+def sampled(model, la, target) -> float:
+    """
+    Fraction of RUNS derivations that spell out target.
+    """
+    hits = 0
+    for _ in range(RUNS):
+        derivations, success = model.derive(la)
+        hits += any(so.spell_out() == target for so in derivations)
+    return hits / RUNS
+
+
+@pytest.mark.parametrize("model_cls", [Composer, ComposerB])
+@pytest.mark.parametrize("la, target", CASES)
+def test_solver_matches_sampling(model_cls, la, target):
+    p = solve(model_cls(), la, target).probability
+    assert 0 < p < 1
+    found = sampled(model_cls(rng=random.Random(0)), la, target)
+    # within 5 standard errors
+    assert abs(found - p) <= 5 * math.sqrt(p * (1 - p) / RUNS)
+
+
+@pytest.mark.parametrize("model_cls", [Composer, ComposerB])
+def test_exact_matches_float(model_cls):
+    la, target = CASES[1]
+    exact = Solver(model_cls(), la, target, exact=True).solve()
+    approx = Solver(model_cls(), la, target).solve()
+    assert math.isclose(float(exact.probability), approx.probability,
+                        rel_tol=1e-12)
+    assert exact.expected_attempts == 1 / exact.probability
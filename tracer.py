@@ -0,0 +1,209 @@
+"""
+tracer.py
+
+Event sinks for the derivation loops of the composer models. Models
+emit events (each stage, Transfer of a filter-passing SO, the end of a
+derivation) to a tracer instead of printing. The default Tracer is
+silent; call sites check `tracer.enabled` first, so a silent tracer
+costs one attribute lookup and stage strings are only built when a
+sink actually consumes the event.
+
+    PrintTracer   the old verbose terminal output
+    JSONLTracer   one JSON object per line, buffered
+    BinaryTracer  length-prefixed records, buffered; see read_binary()
+"""
+
+import io
+import json
+import struct
+import sys
+
+MAGIC = b"GLAMTRC1"
+# event names with a one-byte code in binary traces
+EVENTS = ('stage', 'transfer', 'end', 'stufen')
+_RECORD = struct.Struct('<BI')
+
+
+def describe(value):
+    """
+    JSON-able description of a value in an event: stages become their
+    lexical array and workspace, SO's and Stufen their string.
+
+    :param value: any
+    :return: JSON-able value
+    """
+    if hasattr(value, 'workspace') and hasattr(value, 'la'):
+        return {'la': [describe(s) for s in value.la],
+                'workspace': [describe(so) for so in value.workspace]}
+    if isinstance(value, (list, tuple, set)):
+        return [describe(v) for v in value]
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    return str(value)
+
+
+class Tracer:
+    """
+    Silent sink, and base class for the others.
+    """
+    enabled = False
+
+    def emit(self, event, **fields):
+        """
+        :param event: str, event name
+        :param fields: event contents (Stage, SO, ...), formatted by the sink
+        """
+        pass
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class PrintTracer(Tracer):
+    """
+    Prints events to the terminal, as verbose derivations used to.
+    """
+    enabled = True
+
+    def __init__(self, file=None):
+        self.file = file
+
+    def emit(self, event, **fields):
+        out = self.file or sys.stdout
+        if event == 'stage' and 'stage' in fields:
+            stage = fields['stage']
+            print(f"Stage #{fields['i']}:", file=out)
+            print("<{" + ', '.join(map(str, stage.la)) + "}, {"
+                  + ', '.join(map(str, stage.workspace)) + "}>", file=out)
+            print(file=out)
+        elif event == 'stage':
+            print("stage", file=out)
+            print(fields['workspace'], file=out)
+            print(file=out)
+        elif event == 'end':
+            if fields['success']:
+                print("Derivation finished", file=out)
+            else:
+                print("Derivation crashed", file=out)
+            if 'workspace' in fields:
+                print("current stage: ", file=out)
+                print(fields['workspace'], file=out)
+        elif event == 'stufen':
+            print("Stufen\n======", file=out)
+            for s in fields['stufen']:
+                print(s, file=out)
+        else:
+            print(event, *(f"{k}={describe(v)}" for k, v in fields.items()),
+                  file=out)
+
+
+class _BufferedTracer(Tracer):
+    """
+    Sink that encodes events as they're emitted and writes them
+    out in batches.
+    """
+    enabled = True
+
+    def __init__(self, file, buffer=1024, mode='w'):
+        """
+        :param file: path or open file
+        :param buffer: events held before writing
+        """
+        if isinstance(file, (str, bytes)) or hasattr(file, '__fspath__'):
+            self.file = open(file, mode)
+            self._owned = True
+        else:
+            self.file = file
+            self._owned = False
+        self.buffer = buffer
+        self.pending = list()
+
+    def encode(self, event, fields):
+        raise NotImplementedError
+
+    def emit(self, event, **fields):
+        self.pending.append(self.encode(event, fields))
+        if len(self.pending) >= self.buffer:
+            self.flush()
+
+    def flush(self):
+        if self.pending:
+            self.file.write(self.pending[0][:0].join(self.pending))
+            self.pending.clear()
+        self.file.flush()
+
+    def close(self):
+        self.flush()
+        if self._owned:
+            self.file.close()
+
+
+class JSONLTracer(_BufferedTracer):
+    """
+    Buffered JSON lines, one object per event.
+    """
+    def __init__(self, file, buffer=1024):
+        super().__init__(file, buffer=buffer, mode='w')
+
+    def encode(self, event, fields):
+        record = {'event': event}
+        for k, v in fields.items():
+            record[k] = describe(v)
+        return json.dumps(record) + '\n'
+
+
+class BinaryTracer(_BufferedTracer):
+    """
+    Buffered binary trace: a magic header, then per event a one-byte
+    event code (255 if the name isn't in EVENTS), a 4-byte length and
+    a UTF-8 JSON payload.
+    """
+    def __init__(self, file, buffer=1024):
+        super().__init__(file, buffer=buffer, mode='wb')
+        self.file.write(MAGIC)
+
+    def encode(self, event, fields):
+        record = dict()
+        if event in EVENTS:
+            code = EVENTS.index(event)
+        else:
+            code = 255
+            record['event'] = event
+        for k, v in fields.items():
+            record[k] = describe(v)
+        payload = json.dumps(record, separators=(',', ':')).encode()
+        return _RECORD.pack(code, len(payload)) + payload
+
+
+def read_binary(file):
+    """
+    Reads the events of a BinaryTracer trace.
+
+    :param file: path or binary file
+    :return: generator of dict, with the event name under 'event'
+    """
+    if not isinstance(file, io.IOBase):
+        with open(file, 'rb') as f:
+            yield from read_binary(f)
+        return
+
+    if file.read(len(MAGIC)) != MAGIC:
+        raise ValueError("not a binary trace")
+    while True:
+        header = file.read(_RECORD.size)
+        if len(header) < _RECORD.size:
+            return
+        code, size = _RECORD.unpack(header)
+        record = json.loads(file.read(size))
+        if code != 255:
+            record['event'] = EVENTS[code]
+        yield record
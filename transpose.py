@@ -0,0 +1,186 @@
+"""
+transpose.py
+
+Transposition of Stufen, trees, surfaces and results between keys, so
+a result computed in one key can be relabeled for the other eleven
+instead of being derived again.
+
+Transposing by k adds k to every c5. Filter looks for the Composer's
+tonic, so a derivation from la with tonic t and one from la + k with
+tonic t + k make the same choices and build the same trees up to
+labels, as long as Agree is unchanged by the shift. Model A's free
+Merge always is. Model B's Agree compares raw c5 with c3, which is kept
+mod 12, so it is invariant for some but not all shifts of a given
+Lexical Array; invariant() checks a shift before its results are
+reused.
+
+The canonical form of a Lexical Array in a key, relative(), is its
+Stufen as c5 relative to the tonic with their quality. Relative c5 is
+left unreduced, since Agree reads raw c5 differences (Tebe's F is -1,
+not 11), and keys are equal mod 12.
+
+    results = sweep(lambda m, la: solve(m, la, transpose(TEBE, m.tonic)),
+                    Composer(), tebe_lexical_array())
+"""
+
+import copy
+
+from model import Stufe, SyntacticObject
+
+# surface name -> (c5 mod 12, major, dim)
+NAMES = {Stufe(c5, major, dim).name: (c5, major, dim)
+         for c5 in range(12)
+         for major, dim in ((True, False), (False, False), (False, True))}
+
+
+def transpose_stufe(stufe, k) -> Stufe:
+    return Stufe(stufe.c5 + k, stufe.is_major, stufe.is_dim)
+
+
+def transpose_tree(so, k):
+    """
+    Rebuilds so with every Stufe transposed by k, without recursion.
+    Shared subtrees are transposed once.
+
+    :param so: SyntacticObject or Stufe
+    :param k: int
+    :return: SyntacticObject or Stufe
+    """
+    built = dict()
+    stack = [so]
+    while stack:
+        node = stack[-1]
+        if node in built:
+            stack.pop()
+        elif isinstance(node, Stufe):
+            built[node] = transpose_stufe(node, k)
+            stack.pop()
+        else:
+            m1, m2 = node.items
+            if m1 in built and m2 in built:
+                built[node] = SyntacticObject(built[m1], built[m2])
+                stack.pop()
+            else:
+                stack.extend(m for m in (m2, m1) if m not in built)
+    return built[so]
+
+
+def transpose_surface(surface, k) -> str:
+    """
+    :param surface: str, spelled out surface
+    :param k: int
+    :return: str
+    :raise KeyError: if surface has a token that isn't a Stufe name
+    """
+    out = list()
+    for name in surface.split():
+        c5, major, dim = NAMES[name]
+        out.append(Stufe(c5 + k, major, dim).name)
+    return ' '.join(out)
+
+
+def transpose(value, k):
+    """
+    Relabels a result for the key k fifths away: Stufen and trees are
+    transposed, strings that spell out a surface are relabeled and
+    containers (lists, tuples, namedtuples, dicts, sets) are
+    transposed item by item. Anything else is returned as is.
+
+    :param value: any
+    :param k: int
+    :return: value in the new key
+    """
+    if k == 0:
+        return value
+    if isinstance(value, Stufe):
+        return transpose_stufe(value, k)
+    if isinstance(value, SyntacticObject):
+        return transpose_tree(value, k)
+    if isinstance(value, str):
+        try:
+            return transpose_surface(value, k)
+        except KeyError:
+            return value
+    if isinstance(value, dict):
+        return type(value)((transpose(key, k), transpose(v, k))
+                           for key, v in value.items())
+    if isinstance(value, tuple) and hasattr(value, '_fields'):
+        return type(value)(*(transpose(v, k) for v in value))
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return type(value)(transpose(v, k) for v in value)
+    return value
+
+
+def relative(la, tonic=0) -> tuple:
+    """
+    Canonical form of la modulo transposition: the sorted multiset
+    of (c5 - tonic, major, dim).
+
+    :param la: collection of Stufe objs
+    :param tonic: int
+    :return: tuple
+    """
+    return tuple(sorted((s.c5 - tonic, s.is_major, s.is_dim) for s in la))
+
+
+def invariant(model, la, k) -> bool:
+    """
+    Whether derivations from la and from la transposed by k differ
+    only by labels, i.e. whether model's Agree holds between the same
+    pairs of SO's before and after the shift. Agree only reads the
+    projecting Stufe of an SO (and whether it is one), so checking
+    every pair of Stufen in la as leaves and as SO's covers it.
+
+    :param model: Composer or ComposerB
+    :param la: collection of Stufe objs
+    :param k: int
+    :return: bool
+    """
+    stufen = set(la)
+    for s1 in stufen:
+        t1 = transpose_stufe(s1, k)
+        for s2 in stufen:
+            t2 = transpose_stufe(s2, k)
+            if model.can_merge(s1, s2) != model.can_merge(t1, t2):
+                return False
+            if model.can_merge(s1, SyntacticObject(s2, s2)) \
+                    != model.can_merge(t1, SyntacticObject(t2, t2)):
+                return False
+    return True
+
+
+def in_key(model, tonic):
+    """
+    :param model: Composer or ComposerB
+    :param tonic: int
+    :return: shallow copy of model with Filter looking for tonic
+    """
+    moved = copy.copy(model)
+    moved.tonic = tonic
+    return moved
+
+
+def sweep(run, model, la, keys=range(12)) -> dict:
+    """
+    run(model, la) for la transposed to every key, computing it once
+    and relabeling for each key where the shift leaves the model
+    invariant (and running it again where it doesn't). run must make
+    the same choices for transposed input, e.g. by seeding its RNG,
+    and take the key from model.tonic (e.g. to transpose a target).
+
+    :param run: callable (model, la) -> result
+    :param model: Composer or ComposerB, in the key of la
+    :param la: collection of Stufe objs
+    :param keys: tonics to sweep over
+    :return: dict, tonic -> result
+    """
+    base = run(model, la)
+    results = dict()
+    for tonic in keys:
+        k = tonic - model.tonic
+        if invariant(model, la, k):
+            results[tonic] = transpose(base, k)
+        else:
+            results[tonic] = run(in_key(model, tonic),
+                                 [transpose_stufe(s, k) for s in la])
+    return results
@@ -0,0 +1,185 @@
+"""
+treestore.py
+
+Compact columnar store for derived trees. Instead of a chain of
+SyntacticObject and Stufe instances (hundreds of bytes per node), every
+internal node is a row in a few flat arrays, about 10 bytes per node:
+
+    left, right   child references; a leaf is stored as -(stufe id + 1)
+    proj          flyweight id of the projecting Stufe
+    first         flyweight id of the leftmost Stufe
+
+Stufen are flyweights: each distinct (c5, quality) gets a one-byte id
+in the store's table. The table is keyed by exact c5 rather than c5 mod
+12, since Model B's Agree reads the unreduced value (Tebe's F is c5 = -1),
+so a store holds up to 256 distinct Stufen.
+
+Filter and spell-out work directly on the arrays, and trees convert to
+and from SyntacticObject without recursion.
+"""
+
+from array import array
+
+from model import Stufe, SyntacticObject
+
+
+class TreeStore:
+    """
+    Append-only store of SyntacticObject trees.
+    """
+    def __init__(self):
+        # flyweight table
+        self.stufen = list()
+        self._ids = dict()
+        # internal nodes
+        self.left = array('i')
+        self.right = array('i')
+        self.proj = array('B')
+        self.first = array('B')
+        # root node of every stored tree
+        self.roots = array('i')
+
+    def __len__(self):
+        return len(self.roots)
+
+    def stufe_id(self, stufe) -> int:
+        """
+        Flyweight id of stufe, registering it if new.
+
+        :param stufe: Stufe
+        :return: int
+        """
+        key = (stufe.c5, stufe.is_major, stufe.is_dim)
+        if key not in self._ids:
+            if len(self.stufen) == 256:
+                raise ValueError("a TreeStore holds at most 256 distinct Stufen")
+            self._ids[key] = len(self.stufen)
+            self.stufen.append(Stufe(*key))
+        return self._ids[key]
+
+    def _proj(self, ref) -> int:
+        return -ref - 1 if ref < 0 else self.proj[ref]
+
+    def _first(self, ref) -> int:
+        return -ref - 1 if ref < 0 else self.first[ref]
+
+    def add(self, so) -> int:
+        """
+        Stores a tree. Subtrees that occur twice in it (the same
+        interned object) are stored once.
+
+        :param so: SyntacticObject
+        :return: int, index of the tree in the store
+        """
+        refs = dict()
+        stack = [so]
+        while stack:
+            node = stack[-1]
+            if node in refs:
+                stack.pop()
+                continue
+            if isinstance(node, Stufe):
+                refs[node] = -self.stufe_id(node) - 1
+                stack.pop()
+                continue
+            m1, m2 = node.items
+            if m1 not in refs or m2 not in refs:
+                stack.extend(m for m in (m2, m1) if m not in refs)
+                continue
+            stack.pop()
+            r1, r2 = refs[m1], refs[m2]
+            refs[node] = len(self.left)
+            self.left.append(r1)
+            self.right.append(r2)
+            # latter object projects syntactic features
+            self.proj.append(self._proj(r2))
+            self.first.append(self._first(r1))
+
+        self.roots.append(refs[so])
+        return len(self.roots) - 1
+
+    def extend(self, sos):
+        for so in sos:
+            self.add(so)
+
+    def filter(self, i, tonic=0) -> bool:
+        """
+        Composer.filter (the Ursatz at the root) on the i-th tree, in O(1).
+
+        :param i: int
+        :param tonic: int, see Composer
+        :return: bool
+        """
+        root = self.roots[i]
+        if root < 0:
+            return False
+        c5 = self.stufen
+        right = self.right[root]
+        return (c5[self.proj[root]].c5 == tonic
+                and right >= 0
+                and c5[self._proj(self.left[right])].c5 == tonic + 1
+                and c5[self.first[root]].c5 == tonic)
+
+    def filtered(self, tonic=0):
+        """
+        :param tonic: int, see Composer
+        :return: generator of indices of trees that pass filter
+        """
+        return (i for i in range(len(self.roots)) if self.filter(i, tonic))
+
+    def leaves(self, i) -> list:
+        """
+        Flyweight ids of the surface Stufen of the i-th tree, in order.
+
+        :param i: int
+        :return: list of int
+        """
+        out = list()
+        stack = [self.roots[i]]
+        while stack:
+            ref = stack.pop()
+            if ref < 0:
+                out.append(-ref - 1)
+            else:
+                stack.append(self.right[ref])
+                stack.append(self.left[ref])
+        return out
+
+    def spell_out(self, i) -> str:
+        """
+        Surface chords of the i-th tree, as SyntacticObject.spell_out.
+
+        :param i: int
+        :return: str
+        """
+        return ' '.join(self.stufen[s].name for s in self.leaves(i))
+
+    def __getitem__(self, i):
+        """
+        The i-th tree as a SyntacticObject.
+
+        :param i: int
+        :return: SyntacticObject or Stufe
+        """
+        built = dict()
+        stack = [self.roots[i]]
+        while stack:
+            ref = stack[-1]
+            if ref < 0:
+                built[ref] = self.stufen[-ref - 1]
+                stack.pop()
+                continue
+            r1, r2 = self.left[ref], self.right[ref]
+            if r1 not in built or r2 not in built:
+                stack.extend(r for r in (r2, r1) if r not in built)
+                continue
+            stack.pop()
+            built[ref] = SyntacticObject(built[r1], built[r2])
+        return built[self.roots[i]]
+
+    def nbytes(self) -> int:
+        """
+        :return: int, bytes held by the arrays
+        """
+        return sum(a.itemsize * len(a) for a in
+                   (self.left, self.right, self.proj, self.first, self.roots))